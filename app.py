@@ -1,23 +1,47 @@
 """Streamlit App"""
 
-import openai
+import time
+import uuid
+from datetime import datetime
+
+import altair as alt
+import pandas as pd
 import streamlit as st
-from langchain.schema import Document
 from streamlit_chat import message
 
-from rabbithole import summarize_document
-from rabbithole.embedding import embed_document
-from rabbithole.keywords import get_document_keywords
-from rabbithole.loader import load_file, SUPPORTED_IMG_FILE_TYPES
+from rabbithole.bundle import BUNDLE_DIR, BUNDLE_SUFFIX, bundle_bytes, bundle_path, find_bundles, read_bundle
+from rabbithole.cache import get_cache
+from rabbithole.chat import ChatSession, SessionIndex
+from rabbithole.dedup import clear_upload
+from rabbithole.incremental import SessionGraph
+from rabbithole.jobs import JOBS_POLL_SECONDS, get_job_queue, get_worker_pool
+from rabbithole.keywords import get_corpus_keywords
+from rabbithole.loader import SUPPORTED_IMG_FILE_TYPES, read_bytes
+from rabbithole.metrics import get_metrics, get_tracer
 from rabbithole.mp3 import SUPPORTED_AV_FILE_TYPES
-from rabbithole.planner import generate_plan
+from rabbithole.ordering import order_plan
+from rabbithole.pipeline import STAGES
+from rabbithole.planner import PLANNER, generate_plan
+from rabbithole.summarize import SUMMARY_MODE
 
 # Session variables
-for state_var in ["uploaded_files", "documents", "embeddings", "keywords", "summaries"]:
+for state_var in ["documents", "embeddings", "keywords", "summaries"]:
     if state_var not in st.session_state:
         st.session_state[state_var] = {}
+if "uploaded_files" not in st.session_state:
+    st.session_state.uploaded_files = []
+if "graph" not in st.session_state:
+    st.session_state.graph = SessionGraph(STAGES)
 if "plan" not in st.session_state:
     st.session_state.plan = None
+if "chat" not in st.session_state:
+    st.session_state.chat = ChatSession()
+if "jobs" not in st.session_state:
+    st.session_state.jobs = {}
+if "attached" not in st.session_state:
+    st.session_state.attached = set()
+if "traces" not in st.session_state:
+    st.session_state.traces = {}
 if "processed" not in st.session_state:
     st.session_state.processed = False
 if "bot_messages" not in st.session_state:
@@ -29,104 +53,275 @@ if "user_messages" not in st.session_state:
 
 
 def generate_response(prompt):
-    """Generate a response to a prompt using the GPT-3.5 Turbo model"""
+    """Answer a question from the uploaded documents using the GPT-4 model, showing the tokens as they arrive"""
     st.session_state['user_messages'].append(prompt)
 
-    messages = []
-    # Alternate between bot and the assistant until the conversation is over
-    msg_idx = 0
-    while True:
-        if len(st.session_state['bot_messages']) > msg_idx:
-            messages.append({"role": "assistant", "content": st.session_state['bot_messages'][msg_idx]})
-        else:
-            break
-        if len(st.session_state['user_message']) > msg_idx:
-            messages.append({"role": "user", "content": st.session_state['user_messages'][msg_idx]})
-        else:
-            break
-        msg_idx += 1
-    print(messages)
-    completion = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=messages
-    )
-    response = completion.choices[0].message.content
+    placeholder = st.empty()
+    response = ""
+    with get_tracer().run("chat"):
+        for delta in st.session_state.chat.ask(prompt):
+            response += delta
+            placeholder.markdown(response + "▌")
+    placeholder.empty()
     st.session_state['bot_messages'].append(response)
     print(response)
 
 
-def load_files_with_spinner(files: list) -> dict[str, list[Document]]:
+def submit_files(files: list):
     """
-    Load a list of files and return a list of dictionaries of Document objects.
-    Display a loading animation while loading each file.
-    :param files: List of files to load.
-    :return: List of dictionaries of Document objects.
+    Queue the processing of the new or changed files on the worker pool.
+    Loading, embedding, keyword extraction and summarization run in the worker processes, so they continue
+    when the page is refreshed, and uploading the same files again picks up the running jobs.
+    The jobs of one upload merge the chunks that repeat across its files.
+    :param files: List of files to process.
     """
-    # Combine the results into a single dictionary
-    documents = {}
-    for file in files:
-        with st.spinner(f'Loading {file.name}...'):
-            documents[file.name] = load_file(file)
-            print(file.name, [len(doc.page_content) for doc in documents[file.name]])
-    return documents
+    graph: SessionGraph = st.session_state.graph
+    settings = {"summary_mode": st.session_state.summary_mode}
+    files = graph.update(files, settings=settings)
+
+    get_worker_pool()
+    queue = get_job_queue()
+    st.session_state.upload = uuid.uuid4().hex
+    st.session_state.jobs = {file.name: queue.submit(file.name, read_bytes(file), settings,
+                                                     upload=st.session_state.upload)
+                             for file in files}
+    st.session_state.attached = set()
+    st.session_state.traces = {}
 
 
-def embed_documents_with_spinner(documents: dict[str, list[Document]]) -> dict[str, list[list[float]]]:
+def poll_jobs() -> bool:
     """
-    Embed a list of documents and return a list of dictionaries of embeddings.
-    Display a loading animation while embedding each document.
-    :param documents: List of documents to embed.
-    :return: List of dictionaries of embeddings.
+    Display the progress of every queued file and attach the results of the finished ones to the session.
+    :return: Whether every job finished
     """
-    # Combine the results into a single dictionary
-    embeddings = {}
-    for doc_name, doc_text in documents.items():
-        with st.spinner(f'Embedding {doc_name}...'):
-            embeddings[doc_name] = embed_document([doc.page_content for doc in doc_text])
-    return embeddings
+    graph: SessionGraph = st.session_state.graph
+    queue = get_job_queue()
+    jobs = queue.get(list(st.session_state.jobs.values()))
+
+    pending = False
+    for file_name, job_id in st.session_state.jobs.items():
+        job = jobs.get(job_id)
+        if job is None:
+            st.error(f"{file_name}: the job was deleted")
+            continue
 
+        stages = ", ".join(f"{stage} ({elapsed:.1f}s)" for stage, elapsed in job.stages.items())
+        if job.pending:
+            pending = True
+            st.info(f"{file_name}: {job.status}{': ' + stages if stages else ''}...")
+            continue
+
+        if job_id not in st.session_state.attached:
+            results = queue.result(job_id)
+            # Spans and counters recorded in the worker process
+            trace = results.pop("trace", None)
+            if trace is not None:
+                st.session_state.traces[file_name] = trace
+            for stage, result in results.items():
+                graph.set_result(file_name, stage, result)
+            for stage, error in job.errors.items():
+                graph.set_error(file_name, stage, error)
+            st.session_state.attached.add(job_id)
+
+        if job.finished_ok:
+            st.success(f"{file_name}: {stages}")
+        else:
+            st.error(f"{file_name}: " + ", ".join(f"{stage} failed: {error}" for stage, error in job.errors.items()))
+    return not pending
 
-def extract_keywords_with_spinner(embeddings: dict[str, list[list[float]]]):
+
+def finish_processing(rank_keywords: bool = True):
     """
-    Extract keywords from a list of embeddings and return a list of keywords.
-    Display a loading animation while extracting each keyword.
-    :param embeddings: List of embeddings to extract keywords from.
-    :return: List of keywords.
+    Attach the results of every file to the session, and display the keywords and summaries.
+    :param rank_keywords: Rank the keywords of every file against the whole upload
     """
-    # Combine the results into a single dictionary
-    keywords = {}
-    for doc_name, doc_embeddings in embeddings.items():
-        with st.spinner(f'Extracting keywords from {doc_name}...'):
-            keywords[doc_name] = get_document_keywords(doc_embeddings)
-    return keywords
+    graph: SessionGraph = st.session_state.graph
+    st.session_state.jobs = {}
+    # The chunks the jobs of the upload shared for deduplication
+    if st.session_state.get("upload") is not None:
+        clear_upload(get_job_queue().path, st.session_state.upload)
+        st.session_state.upload = None
+    # Show the jobs of the upload as one run in the debug panel
+    if st.session_state.traces:
+        get_tracer().merge(st.session_state.traces, "upload")
+        st.session_state.traces = {}
+
+    # Results of every file in upload order, reused or recomputed
+    st.session_state.documents = graph.results("load")
+    st.session_state.embeddings = graph.results("embed")
+    st.session_state.summaries = graph.results("summarize")
+
+    # Rank the keywords of every file against the whole upload, with one batched query for all the chunks.
+    # The keywords ranked per file stay in the graph for when the upload changes
+    if rank_keywords:
+        corpus_keywords = {}
+        if len(st.session_state.embeddings) > 1:
+            try:
+                with st.spinner("Extracting keywords..."):
+                    corpus_keywords = get_corpus_keywords(st.session_state.embeddings)
+            except Exception as error:
+                st.warning(f"Keeping the keywords of each file: {error}")
+        graph.set_corpus_keywords(corpus_keywords)
+    st.session_state.keywords = graph.keywords()
+
+    # Index the chunks of every file for the chat
+    st.session_state.chat.index = SessionIndex.from_results(st.session_state.documents, st.session_state.embeddings)
+
+    # Display the keywords and summaries
+    for doc_name, doc_keywords in st.session_state.keywords.items():
+        st.header(doc_name)
+        st.caption("Keywords: " + ", ".join(doc_keywords))
+        st.write(st.session_state.summaries.get(doc_name, ""))
+        st.divider()
+
+    # What dropping the repeated chunks saved
+    reports = list(graph.results("dedup").values())
+    if any(report["kept"] < report["chunks"] for report in reports):
+        totals = {key: sum(report[key] for report in reports) for key in reports[0]}
+        st.caption(f"{totals['chunks'] - totals['kept']} of {totals['chunks']} chunks repeat other chunks. "
+                   f"Saved {totals['tokens_saved']} tokens, {totals['embeddings_saved']} embeddings, "
+                   f"{totals['keyword_queries_saved']} keyword queries and {totals['summary_calls_saved']} "
+                   f"summarization calls.")
 
+    st.session_state.processed = True
+    st.success('Summarization completed.')
 
-def generate_summary_with_spinner(documents: dict[str, list[Document]]) -> dict[str, list[list[float]]]:
+
+def open_session(graph: SessionGraph):
     """
-    Embed a list of documents and return a list of dictionaries of embeddings.
-    Display a loading animation while embedding each document.
-    :param documents: List of documents to embed.
-    :return: List of dictionaries of embeddings.
+    Replace the session with a saved one, without processing anything again
+    :param graph: Session graph read from a bundle
     """
-    summaries = {}
-    for doc_name, doc_text in documents.items():
-        with st.spinner(f'Summarizing {doc_name}...'):
-            summaries[doc_name] = summarize_document(doc_text)
-    return summaries
+    st.session_state.graph = graph
+    st.session_state.plan = graph.plan
+    st.session_state.uploaded_files = []
+    finish_processing(rank_keywords=False)
+
+
+def session_bundle() -> bytes:
+    """Serialize the session for a download, once per set of results and plan."""
+    graph: SessionGraph = st.session_state.graph
+    key = (graph.current_plan_key(), graph.plan_key)
+    if st.session_state.get("bundle_key") != key:
+        st.session_state.bundle = bundle_bytes(graph)
+        st.session_state.bundle_key = key
+    return st.session_state.bundle
+
+
+def display_plan_entry(entry: dict):
+    """Display the plan of one document."""
+    for doc_name, doc_data in entry.items():
+        st.subheader(doc_name)
+        st.write(f"**Background Concepts**")
+        for concept in doc_data.get("Background Concepts", []):
+            st.write(f"- {concept}")
+        st.write(f"**Key Concepts**")
+        for concept in doc_data.get("Key Concepts", []):
+            st.write(f"- {concept}")
+        st.write(f"**Further Reading**")
+        for concept in doc_data.get("Further Reading", []):
+            st.write(f"- {concept}")
+    st.write("")
 
 
 def generate_plan_with_spinner() -> dict:
-    """Generate a logical plan to study the uploaded documents."""
-    with st.spinner("Generating plan..."):
-        plan = generate_plan(st.session_state.summaries, st.session_state.keywords)
+    """Generate a logical plan to study the uploaded documents, displaying each document's plan as it arrives."""
+    with st.spinner("Generating plan..."), get_tracer().run("plan"):
+        if st.session_state.planner == "ordering":
+            plan = order_plan(st.session_state.summaries, st.session_state.keywords, st.session_state.embeddings,
+                              on_entry=display_plan_entry)
+        else:
+            plan = generate_plan(st.session_state.summaries, st.session_state.keywords, on_entry=display_plan_entry)
+    st.session_state.graph.set_plan(plan, settings={"planner": st.session_state.planner})
     return plan
 
 
+def display_debug_panel():
+    """Display the timeline and counters of a recent traced run."""
+    tracer = get_tracer()
+    runs = sorted(tracer.finished_runs(), key=lambda run: -run.start)[:10]
+    if not runs:
+        st.caption("No runs traced yet.")
+        return
+
+    run = st.selectbox(
+        "Run", runs,
+        format_func=lambda run: f"{run.name} at {datetime.fromtimestamp(run.start):%H:%M:%S} "
+                                f"({run.end - run.start:.1f}s)",
+    )
+    spans = tracer.spans(run.run_id)
+    timeline = pd.DataFrame([{
+        "span": span.name,
+        "thread": span.thread,
+        "start": span.start - run.start,
+        "end": span.end - run.start,
+        "duration": span.duration,
+        "details": ", ".join(f"{key}={value}" for key, value in span.attributes.items()),
+        "error": span.error or "",
+    } for span in spans])
+    st.altair_chart(
+        alt.Chart(timeline).mark_bar().encode(
+            x=alt.X("start", title="seconds"), x2="end", y=alt.Y("thread", sort=None), color="span",
+            tooltip=["span", "duration", "details", "error"],
+        ),
+        use_container_width=True,
+    )
+
+    # Where the time went, by span name
+    st.dataframe(
+        timeline.groupby("span")["duration"].agg(["count", "sum", "max"]).sort_values("sum", ascending=False)
+    )
+    st.dataframe(pd.DataFrame([
+        {"counter": name, "labels": ", ".join(f"{key}={value}" for key, value in labels), "value": value}
+        for (name, labels), value in sorted(tracer.counters(run.run_id).items())
+    ]))
+
+
 st.set_page_config(page_title="RabbitHole", page_icon="🐇", layout="wide")
 
 st.title("RabbitHole")
 
-if not st.session_state.processed:
+st.sidebar.selectbox(
+    "Summary mode", ["refine", "map_reduce"], key="summary_mode",
+    index=["refine", "map_reduce"].index(SUMMARY_MODE),
+    help="refine summarizes the chunks one after another; map_reduce summarizes them in parallel and merges the "
+         "summaries, which is much faster for long documents.",
+)
+
+st.sidebar.selectbox(
+    "Planner", ["llm", "ordering"], key="planner",
+    index=["llm", "ordering"].index(PLANNER),
+    help="llm plans all documents in one GPT-4 prompt; ordering orders the documents locally from their embeddings "
+         "and refines each document's plan with a short LLM call, which scales to large upload sets.",
+)
+
+with st.sidebar.expander("Cache"):
+    cache = get_cache()
+    st.caption(f"{cache.size() / 1024 ** 2:.1f} MB of {cache.max_bytes / 1024 ** 2:.0f} MB used")
+    for namespace, counts in cache.stats().items():
+        st.caption(f"{namespace}: {counts['hits']} hits, {counts['misses']} misses")
+
+with st.sidebar.expander("Metrics"):
+    for name, stats in get_metrics().summary().items():
+        st.caption(f"{name}: last {stats['last']:.2f}, mean {stats['mean']:.2f} over {stats['count']}")
+
+with st.sidebar.expander("Jobs"):
+    job_counts = get_job_queue().counts()
+    st.caption(", ".join(f"{n} {status}" for status, n in sorted(job_counts.items())) or "No jobs yet")
+
+if st.sidebar.checkbox("Debug panel", help="Show the timeline of the latest traced runs."):
+    with st.expander("Debug", expanded=True):
+        display_debug_panel()
+
+if not st.session_state.processed and st.session_state.jobs:
+    # The workers are processing the files. Poll until every job finished
+    if poll_jobs():
+        finish_processing()
+    else:
+        time.sleep(JOBS_POLL_SECONDS)
+        st.experimental_rerun()
+
+elif not st.session_state.processed:
     uploaded_files = st.file_uploader("Upload content",
                                       type=["docx", "pdf", "txt", *SUPPORTED_IMG_FILE_TYPES, *SUPPORTED_AV_FILE_TYPES],
                                       accept_multiple_files=True)
@@ -136,60 +331,54 @@ if not st.session_state.processed:
             st.warning("Please upload a file first.")
             st.stop()
 
-        # Check if uploaded files have changed
-        uploaded_files_changed = False
-        if len(uploaded_files) != len(st.session_state.uploaded_files):
-            uploaded_files_changed = True
-        else:
-            for new_file, old_file in zip(uploaded_files, st.session_state.uploaded_files):
-                if new_file != old_file:
-                    uploaded_files_changed = True
-                    break
-
-        if uploaded_files_changed:
-            st.session_state.uploaded_files = uploaded_files
-
-            # Load the text from the uploaded PDF files
-            st.session_state.documents = load_files_with_spinner(st.session_state.uploaded_files)
-            st.session_state.embeddings = embed_documents_with_spinner(st.session_state.documents)
-            st.session_state.keywords = extract_keywords_with_spinner(st.session_state.embeddings)
-            st.session_state.summaries = generate_summary_with_spinner(st.session_state.documents)
-
-        # Display the keywords and summaries
-        for doc_name, doc_keywords in st.session_state.keywords.items():
-            st.header(doc_name)
-            st.caption("Keywords: " + ", ".join(doc_keywords))
-            st.write(st.session_state.summaries[doc_name])
-            st.divider()
-
-        st.session_state.processed = True
-        st.success('Summarization completed.')
+        # Load, embed, extract keywords and summarize the new or changed files on the worker pool
+        st.session_state.uploaded_files = uploaded_files
+        submit_files(st.session_state.uploaded_files)
+        if st.session_state.jobs:
+            st.experimental_rerun()
+        finish_processing()
+
+    # Open a session saved from the app or built with `python -m rabbithole.bundle build`
+    session_file = st.file_uploader("Or open a saved session", type=[BUNDLE_SUFFIX.lstrip(".")])
+    session_name = st.selectbox("Or a session bundle on the server", [""] + find_bundles(),
+                                help=f"Bundles saved in {BUNDLE_DIR} on the server.")
+    if st.button("Open session"):
+        if session_file is None and not session_name:
+            st.warning("Please choose a session first.")
+            st.stop()
+        try:
+            # Bundles on the server are memory-mapped, so their embeddings are read from disk as they are used
+            open_session(read_bundle(read_bytes(session_file) if session_file is not None
+                                     else bundle_path(session_name)))
+        except (OSError, ValueError) as error:
+            st.error(f"Could not open the session: {error}")
 
 if st.session_state.processed:
     st.header("Loaded Files")
-    for file in st.session_state.uploaded_files:
-        st.write(file.name)
+    for file_name in st.session_state.graph.records:
+        st.write(file_name)
+    if st.button("Add or change files"):
+        st.session_state.processed = False
+        st.experimental_rerun()
 
-    # Display the plan
+    # Display the plan, regenerating it only when the files changed.
+    # A new plan is displayed document by document while it streams in
     st.header("Study Plan")
-    if st.session_state.plan is None:
-        plan = generate_plan_with_spinner()
-        st.session_state.plan = plan
+    if st.session_state.graph.plan_stale(settings={"planner": st.session_state.planner}):
+        st.session_state.plan = generate_plan_with_spinner()
+        plan = st.session_state.plan
+        streamed = True
     else:
         plan = st.session_state.plan
-    for data in plan.get("plan", []):
-        for doc_name, doc_data in data.items():
-            st.subheader(doc_name)
-            st.write(f"**Background Concepts**")
-            for concept in doc_data.get("Background Concepts", []):
-                st.write(f"- {concept}")
-            st.write(f"**Key Concepts**")
-            for concept in doc_data.get("Key Concepts", []):
-                st.write(f"- {concept}")
-            st.write(f"**Further Reading**")
-            for concept in doc_data.get("Further Reading", []):
-                st.write(f"- {concept}")
-        st.write("")
+        streamed = False
+    if isinstance(plan.get("plan"), str):
+        st.error(plan["plan"])
+    elif not streamed:
+        for data in plan.get("plan", []):
+            display_plan_entry(data)
+
+    st.download_button("Save session", data=session_bundle(), file_name=f"rabbithole-session{BUNDLE_SUFFIX}",
+                       help="Save the processed files and the plan, to open them later without processing again.")
 
     st.header("Chat")
     # Iterate through the bot and user message and print them alternatively
@@ -0,0 +1,83 @@
+"""Benchmark of peak memory and time: moviepy/pydub chunking vs. streaming ffmpeg chunking"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from rabbithole.mp3 import FFMPEG_BINARY
+
+
+def make_audio(path: str, minutes: float):
+    """Write a synthetic recording: a tone over noise, with one second of silence every 20 seconds"""
+    seconds = int(minutes * 60)
+    subprocess.run(
+        [FFMPEG_BINARY, "-nostdin", "-loglevel", "error", "-y",
+         "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+         "-f", "lavfi", "-i", f"anoisesrc=d={seconds}:a=0.05",
+         "-filter_complex", "[0][1]amix,volume='if(lt(mod(t,20),1),0,1)':eval=frame", path],
+        check=True,
+    )
+
+
+def run_legacy(source: str) -> int:
+    """convert_to_mp3 + chunk_mp3: full decode/encode passes with the whole PCM stream in memory"""
+    from rabbithole.mp3 import chunk_mp3, convert_to_mp3
+
+    chunks = chunk_mp3(convert_to_mp3(source))
+    return sum(os.path.getsize(chunk) for chunk in chunks)
+
+
+def run_streaming(source: str) -> int:
+    """stream_chunks: one decode pass through a pipe, chunks encoded in memory"""
+    from rabbithole.mp3 import stream_chunks
+
+    return sum(len(chunk.getvalue()) for chunk in stream_chunks(source))
+
+
+def measure(method: str, source: str) -> dict:
+    """Run one method in a fresh interpreter and collect its time and peak RSS"""
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.audio_chunking", "--run", method, source],
+        check=True, stdout=subprocess.PIPE, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--minutes", type=float, nargs="+", default=[10, 30, 60])
+    parser.add_argument("--format", default="mp4", help="Container of the synthetic recording")
+    parser.add_argument("--run", nargs=2, metavar=("METHOD", "SOURCE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        method, source = args.run
+        start = time.perf_counter()
+        total_bytes = {"legacy": run_legacy, "streaming": run_streaming}[method](source)
+        print(json.dumps({
+            "seconds": time.perf_counter() - start,
+            "bytes": total_bytes,
+            # ru_maxrss is in KiB on Linux
+            "python_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "children_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        }))
+        sys.exit(0)
+
+    print(f"{'minutes':>8} {'method':>10} {'time (s)':>9} {'python RSS (MB)':>16} {'child RSS (MB)':>16}")
+    for minutes in args.minutes:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            audio = os.path.join(temp_dir, f"recording.{args.format}")
+            make_audio(audio, minutes)
+            for method in ("legacy", "streaming"):
+                result = measure(method, audio)
+                print(f"{minutes:>8g} {method:>10} {result['seconds']:>9.1f} "
+                      f"{result['python_rss_mb']:>16.0f} {result['children_rss_mb']:>16.0f}")
+        finally:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,42 @@
+"""Benchmark of bulk-loading throughput into a local stand-in vector store"""
+
+import argparse
+import os
+import tempfile
+
+import numpy as np
+
+from rabbithole.fakes import FakeVectorStore
+from rabbithole.wikipedia import Checkpoint, PineconeSink, bulk_load
+
+# Let the fake store run unthrottled
+os.environ.setdefault("RABBITHOLE_PINECONE_RPS", "100000")
+os.environ.setdefault("RABBITHOLE_PINECONE_BURST", "100000")
+os.environ.setdefault("RABBITHOLE_PINECONE_CONCURRENCY", "256")
+
+
+def make_rows(num_rows: int, dim: int = 768, seed: int = 0):
+    """Synthetic rows shaped like the Cohere Wikipedia dataset, cycling through a pool of vectors"""
+    pool = np.random.default_rng(seed).standard_normal((1024, dim), dtype=np.float32)
+    for i in range(num_rows):
+        yield {"id": i, "emb": pool[i % len(pool)],
+               "title": f"Article {i}", "url": f"https://simple.wikipedia.org/wiki?curid={i}"}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds per fake upsert")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="Probability of a failed upsert")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'vectors/sec':>12} {'failed batches':>15}")
+    for workers in args.workers:
+        store = FakeVectorStore(latency=args.latency, error_rate=args.error_rate)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            checkpoint = Checkpoint(os.path.join(temp_dir, "checkpoint.json"), settings={"batch_size": args.batch_size})
+            stats = bulk_load(make_rows(args.rows), PineconeSink(index=store), batch_size=args.batch_size,
+                              workers=workers, checkpoint=checkpoint, total=args.rows)
+        print(f"{workers:>8} {stats['vectors_per_second']:>12.0f} {len(stats['failed']):>15}")
@@ -0,0 +1,129 @@
+"""Benchmark of the import time of the rabbithole modules, from `python -X importtime`
+
+Every module is imported in a fresh interpreter, several times, and the fastest run is kept. Reports the
+cumulative import time of each module and the heaviest packages it pulls in, and compares two reports:
+
+    python -m benchmarks.imports --output before.json
+    python -m benchmarks.imports --compare before.json after.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Entry points of the app, the worker processes and the command line tools
+MODULES = (
+    "rabbithole",
+    "rabbithole.loader",
+    "rabbithole.pipeline",
+    "rabbithole.jobs",
+    "rabbithole.chat",
+    "rabbithole.summarize",
+    "rabbithole.transcribe",
+    "rabbithole.vecstore",
+)
+
+
+def import_times(module: str) -> tuple[float, dict[str, float]]:
+    """
+    Import a module in a fresh interpreter
+    :param module: Module to import
+    :return: Total import time in milliseconds, and the cumulative import time of every package imported
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    total, packages = 0.0, {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package, with nested imports indented
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        milliseconds = int(cumulative) / 1000
+        if not name.startswith("  "):
+            total += milliseconds
+        # A package is imported once, and its cumulative time includes every module it imports
+        if "." not in name.strip() and not name.strip().startswith("_"):
+            packages[name.strip()] = milliseconds
+    return total, packages
+
+
+def measure(modules: tuple[str, ...], repeat: int, top: int) -> dict[str, dict]:
+    """
+    Measure the import time of every module
+    :param modules: Modules to import
+    :param repeat: Number of imports per module. The fastest is kept
+    :param top: Number of heaviest packages reported per module
+    :return: {"total_ms", "heaviest"} by module
+    """
+    results = {}
+    for module in modules:
+        total, packages = min((import_times(module) for _ in range(repeat)), key=lambda run: run[0])
+        heaviest = sorted(((name, ms) for name, ms in packages.items() if name not in ("rabbithole", "site")),
+                          key=lambda item: -item[1])
+        results[module] = {"total_ms": total, "heaviest": heaviest[:top]}
+    return results
+
+
+def compare(baseline_path: str, current_path: str, threshold: float) -> bool:
+    """
+    Print the change of every module's import time between two reports
+    :param baseline_path: Report of the baseline commit
+    :param current_path: Report of the new commit
+    :param threshold: Relative change counted as a regression, e.g. 0.1
+    :return: Whether any module regressed
+    """
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(current_path, "r", encoding="utf-8") as f:
+        current = json.load(f)
+
+    print(f"Baseline {baseline['meta']['commit']} vs. {current['meta']['commit']}")
+    print(f"{'module':>24} {'before (ms)':>12} {'after (ms)':>11} {'change':>8}")
+    regressed = False
+    for module, stats in current["results"].items():
+        old = baseline["results"].get(module)
+        if old is None:
+            print(f"{module:>24} {'new':>12} {stats['total_ms']:>11.0f}")
+            continue
+        change = (stats["total_ms"] - old["total_ms"]) / old["total_ms"] if old["total_ms"] else 0.0
+        regressed |= change > threshold
+        print(f"{module:>24} {old['total_ms']:>12.0f} {stats['total_ms']:>11.0f} {change:>+8.0%}"
+              f"{'  REGRESSION' if change > threshold else ''}")
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=list(MODULES))
+    parser.add_argument("--repeat", type=int, default=3, help="Imports per module. The fastest is kept")
+    parser.add_argument("--top", type=int, default=5, help="Heaviest packages reported per module")
+    parser.add_argument("--output", default=None,
+                        help="Report path. Defaults to benchmarks/results/imports-<commit>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="Compare two reports")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change reported as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, threshold=args.threshold) else 0)
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], check=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = "unknown"
+
+    results = measure(tuple(args.modules), args.repeat, args.top)
+    report = {"meta": {"commit": commit, "python": sys.version.split()[0]}, "results": results}
+
+    output = args.output or os.path.join("benchmarks", "results", f"imports-{commit}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'module':>24} {'import (ms)':>12}  heaviest packages")
+    for module, stats in results.items():
+        heaviest = ", ".join(f"{name} {ms:.0f}" for name, ms in stats["heaviest"])
+        print(f"{module:>24} {stats['total_ms']:>12.0f}  {heaviest}")
+    print(f"Report written to {output}")
@@ -0,0 +1,77 @@
+"""Micro-benchmark of keyword TF-IDF scoring"""
+
+import argparse
+import random
+import time
+from collections import Counter
+from heapq import nlargest
+from math import log
+
+from rabbithole.keywords import score_keywords
+
+
+def score_keywords_loop(results: list[list[dict]], n: int = 10) -> list[str]:
+    """Reference implementation: the per-occurrence Python loop score_keywords replaced"""
+    keywords = [
+        [
+            vector.get("metadata").get("title")
+            for vector in result if vector.get("metadata")
+        ]
+        for result in results
+    ]
+
+    keyword_weight = Counter()
+    document_frequency = Counter()
+    num_documents = len(keywords)
+
+    for kw_list in keywords:
+        document_frequency.update(set(kw_list))
+
+    for kw_list in keywords:
+        num_keywords = len(kw_list)
+        for keyword in kw_list:
+            tf = 1 / num_keywords
+            idf = log(num_documents / document_frequency[keyword])
+            keyword_weight[keyword] += tf * idf
+
+    return nlargest(n, keyword_weight, key=keyword_weight.get)
+
+
+def make_results(num_chunks: int, top_k: int = 30, vocabulary: int = 20_000, seed: int = 0) -> list[list[dict]]:
+    """Synthetic vector store matches with a Zipf-like title distribution"""
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(vocabulary)]
+    return [
+        [
+            {"id": str(title), "score": rng.random(), "metadata": {"title": f"Title {title}", "url": ""}}
+            for title in rng.choices(range(vocabulary), weights=weights, k=top_k)
+        ]
+        for _ in range(num_chunks)
+    ]
+
+
+def time_call(func, *args, repeat: int = 5, **kwargs) -> float:
+    """Best wall-clock time of several calls in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, nargs="+", default=[100, 1000, 5000, 20000])
+    parser.add_argument("--top-k", type=int, default=30)
+    parser.add_argument("-n", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'chunks':>8} {'loop (ms)':>10} {'numpy (ms)':>11} {'speedup':>8}")
+    for num_chunks in args.chunks:
+        results = make_results(num_chunks, top_k=args.top_k)
+        assert score_keywords(results, n=args.n) == score_keywords_loop(results, n=args.n)
+
+        loop_time = time_call(score_keywords_loop, results, n=args.n)
+        numpy_time = time_call(score_keywords, results, n=args.n)
+        print(f"{num_chunks:>8} {loop_time * 1e3:>10.1f} {numpy_time * 1e3:>11.1f} {loop_time / numpy_time:>7.1f}x")
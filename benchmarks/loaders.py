@@ -0,0 +1,81 @@
+"""Benchmark of time and temporary disk usage: temp-file PDF loading vs. in-memory single-pass loading"""
+
+import argparse
+import io
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import fitz
+from langchain.document_loaders import PyMuPDFLoader, TextLoader
+from langchain.text_splitter import TokenTextSplitter
+
+WORDS = "learning model data network theory function system energy matrix vector graph process".split()
+
+
+def make_pdf(num_pages: int, words_per_page: int = 500, seed: int = 0) -> bytes:
+    """Synthetic text PDF"""
+    rng = random.Random(seed)
+    with fitz.open() as pdf:
+        for _ in range(num_pages):
+            page = pdf.new_page()
+            text = " ".join(rng.choices(WORDS, k=words_per_page))
+            page.insert_textbox(fitz.Rect(36, 36, 576, 806), text, fontsize=8)
+        return pdf.tobytes()
+
+
+def load_pdf_temp_files(data: bytes) -> int:
+    """Reference implementation: the temp-file, split-twice PDF path the in-memory loader replaced"""
+    text_splitter = TokenTextSplitter(encoding_name="cl100k_base", chunk_size=1000, chunk_overlap=100)
+
+    temp_file = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+    temp_file.write(data)
+    temp_file.close()
+    pdf_doc = PyMuPDFLoader(file_path=temp_file.name).load_and_split(text_splitter=text_splitter)
+
+    temp_file = tempfile.NamedTemporaryFile(suffix=".txt", delete=False)
+    temp_file.write("\n".join([page.page_content for page in pdf_doc]).encode())
+    temp_file.close()
+
+    return len(TextLoader(file_path=temp_file.name, encoding="utf-8").load_and_split(text_splitter=text_splitter))
+
+
+def load_pdf_in_memory(data: bytes) -> int:
+    """In-memory single-pass loader"""
+    from rabbithole.loader import iter_documents
+
+    file = io.BytesIO(data)
+    file.name = "benchmark.pdf"
+    return sum(1 for _ in iter_documents(file))
+
+
+def disk_usage(directory: str) -> int:
+    """Total size of the files in a directory tree"""
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory) for name in names
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, nargs="+", default=[50, 300, 1000])
+    args = parser.parse_args()
+
+    print(f"{'pages':>6} {'method':>10} {'time (s)':>9} {'chunks':>7} {'temp files left (KB)':>21}")
+    for num_pages in args.pages:
+        pdf_data = make_pdf(num_pages)
+        for name, method in (("temp files", load_pdf_temp_files), ("in memory", load_pdf_in_memory)):
+            # Route temporary files to a fresh directory to measure what is left behind
+            tempfile.tempdir = tempfile.mkdtemp()
+            try:
+                start = time.perf_counter()
+                num_chunks = method(pdf_data)
+                elapsed = time.perf_counter() - start
+                print(f"{num_pages:>6} {name:>10} {elapsed:>9.2f} {num_chunks:>7} "
+                      f"{disk_usage(tempfile.tempdir) / 1024:>21.0f}")
+            finally:
+                shutil.rmtree(tempfile.tempdir)
+                tempfile.tempdir = None
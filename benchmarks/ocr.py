@@ -0,0 +1,73 @@
+"""Benchmark of OCR throughput: serial page-by-page OCR vs. rendering in order and OCRing on the process pool"""
+
+import argparse
+import io
+import random
+import sys
+import time
+
+import fitz
+
+WORDS = "learning model data network theory function system energy matrix vector graph process".split()
+
+
+def make_scanned_pdf(num_pages: int, words_per_page: int = 300, seed: int = 0) -> bytes:
+    """Synthetic scanned PDF: every page is an image of text, without a text layer"""
+    rng = random.Random(seed)
+    with fitz.open() as text_pdf, fitz.open() as scanned:
+        for _ in range(num_pages):
+            page = text_pdf.new_page()
+            page.insert_textbox(fitz.Rect(36, 36, 576, 806), " ".join(rng.choices(WORDS, k=words_per_page)),
+                                fontsize=11)
+            image = page.get_pixmap(dpi=150, colorspace=fitz.csGRAY).tobytes("png")
+            scanned.new_page(width=page.rect.width, height=page.rect.height).insert_image(page.rect, stream=image)
+        return scanned.tobytes()
+
+
+def ocr_serial(data: bytes, dpi: int) -> int:
+    """Reference implementation: render and OCR one page after another in the calling process"""
+    import pytesseract
+    from PIL import Image
+
+    from rabbithole.ocr import OCR_LANG, TESSERACT_CMD
+
+    pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+    characters = 0
+    with fitz.open(stream=data, filetype="pdf") as pdf:
+        for page in pdf:
+            image = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY).tobytes("png")
+            with Image.open(io.BytesIO(image)) as image:
+                characters += len(pytesseract.image_to_string(image, lang=OCR_LANG))
+    return characters
+
+
+def ocr_pool(data: bytes, dpi: int) -> int:
+    """Pages rendered in order and OCRed in parallel on the process pool"""
+    from rabbithole.ocr import pdf_page_texts
+
+    return sum(len(text) for text in pdf_page_texts(data, dpi=dpi))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--dpi", type=int, nargs="+", default=[150, 200, 300])
+    args = parser.parse_args()
+
+    from rabbithole.ocr import get_ocr_pool, ocr_workers, tesseract_available
+
+    if not tesseract_available():
+        sys.exit("tesseract is not installed. Set TESSERACT_CMD to its path")
+    # Start the pool processes before timing
+    get_ocr_pool().submit(len, b"").result()
+
+    print(f"OCR processes: {ocr_workers()}")
+    print(f"{'pages':>6} {'dpi':>5} {'method':>7} {'time (s)':>9} {'pages/s':>8} {'characters':>11}")
+    for num_pages in args.pages:
+        pdf_data = make_scanned_pdf(num_pages)
+        for dpi in args.dpi:
+            for name, method in (("serial", ocr_serial), ("pool", ocr_pool)):
+                start = time.perf_counter()
+                characters = method(pdf_data, dpi)
+                elapsed = time.perf_counter() - start
+                print(f"{num_pages:>6} {dpi:>5} {name:>7} {elapsed:>9.2f} {num_pages / elapsed:>8.2f} {characters:>11}")
@@ -0,0 +1,352 @@
+"""End-to-end benchmark of the rabbithole stages with offline fakes for every provider
+
+Runs load_file, embed_document, get_document_keywords, summarize_document, transcribe and generate_plan over
+synthetic corpora of text, PDF and audio files, with local fakes standing in for Cohere, Pinecone, OpenAI and
+Whisper. Writes a JSON report of per-stage latency, throughput and peak memory, and compares two reports:
+
+    python -m benchmarks.run --sizes small medium --output before.json
+    python -m benchmarks.run --compare before.json after.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+import numpy as np
+
+# Keep the fakes unthrottled, and the run isolated from the user's cache
+for _provider in ("COHERE", "PINECONE", "OPENAI", "WHISPER"):
+    os.environ.setdefault(f"RABBITHOLE_{_provider}_RPS", "100000")
+    os.environ.setdefault(f"RABBITHOLE_{_provider}_BURST", "100000")
+    os.environ.setdefault(f"RABBITHOLE_{_provider}_CONCURRENCY", "64")
+os.environ["RABBITHOLE_CACHE_DIR"] = tempfile.mkdtemp(prefix="rabbithole-benchmark-")
+os.environ["RABBITHOLE_VECSTORE"] = "pinecone"
+
+import rabbithole.embedding  # noqa: E402
+import rabbithole.vecstore  # noqa: E402
+from rabbithole.cache import Cache  # noqa: E402
+from rabbithole.embedding import EmbeddingService, embed_document  # noqa: E402
+from rabbithole.fakes import FakeChatServer, FakeEmbeddings, FakeLLM, FakeTranscriber, FakeVectorStore  # noqa: E402
+from rabbithole.keywords import get_document_keywords  # noqa: E402
+from rabbithole.loader import iter_documents  # noqa: E402
+from rabbithole.metrics import get_tracer  # noqa: E402
+from rabbithole.mp3 import FFMPEG_BINARY  # noqa: E402
+from rabbithole.planner import generate_plan  # noqa: E402
+from rabbithole.summarize import summarize_document  # noqa: E402
+from rabbithole.transcribe import transcribe  # noqa: E402
+
+WORDS = ("learning model data network theory function system energy matrix vector graph process cell protein "
+         "market price law court history empire language grammar planet orbit field force wave particle").split()
+
+# Number of files and their length per corpus size
+CORPORA = {
+    "small": {"text": (2, 2_000), "pdf": (1, 10), "audio": (1, 1.0)},  # (files, words | pages | minutes)
+    "medium": {"text": (8, 5_000), "pdf": (3, 50), "audio": (2, 5.0)},
+    "large": {"text": (32, 10_000), "pdf": (8, 200), "audio": (4, 15.0)},
+}
+
+# Number of synthetic Wikipedia articles in the fake keyword index
+WIKIPEDIA_ARTICLES = 5_000
+
+
+def make_text(num_words: int, rng: random.Random) -> str:
+    """Synthetic text with paragraphs"""
+    words = rng.choices(WORDS, k=num_words)
+    return "\n\n".join(" ".join(words[i:i + 120]) for i in range(0, num_words, 120))
+
+
+def make_pdf(num_pages: int, rng: random.Random, words_per_page: int = 500) -> bytes:
+    """Synthetic text PDF"""
+    import fitz
+
+    with fitz.open() as pdf:
+        for _ in range(num_pages):
+            page = pdf.new_page()
+            page.insert_textbox(fitz.Rect(36, 36, 576, 806), " ".join(rng.choices(WORDS, k=words_per_page)),
+                                fontsize=8)
+        return pdf.tobytes()
+
+
+def make_audio(path: str, minutes: float):
+    """Synthetic recording: a tone over noise, with one second of silence every 20 seconds"""
+    seconds = int(minutes * 60)
+    subprocess.run(
+        [FFMPEG_BINARY, "-nostdin", "-loglevel", "error", "-y",
+         "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+         "-f", "lavfi", "-i", f"anoisesrc=d={seconds}:a=0.05",
+         "-filter_complex", "[0][1]amix,volume='if(lt(mod(t,20),1),0,1)':eval=frame", path],
+        check=True,
+    )
+
+
+def make_corpus(size: str, directory: str, seed: int = 0) -> dict[str, list]:
+    """
+    Write a synthetic corpus
+    :param size: Corpus size, a key of CORPORA
+    :param directory: Directory for the audio files
+    :param seed: Random seed
+    :return: {"documents": in-memory text and PDF files, "audio": [(path, seconds)]}
+    """
+    rng = random.Random(seed)
+    spec = CORPORA[size]
+    documents = []
+    for i in range(spec["text"][0]):
+        file = io.BytesIO(make_text(spec["text"][1], rng).encode("utf-8"))
+        file.name = f"text_{i}.txt"
+        documents.append(file)
+    for i in range(spec["pdf"][0]):
+        file = io.BytesIO(make_pdf(spec["pdf"][1], rng))
+        file.name = f"paper_{i}.pdf"
+        documents.append(file)
+
+    audio = []
+    if shutil.which(FFMPEG_BINARY):
+        for i in range(spec["audio"][0]):
+            path = os.path.join(directory, f"lecture_{i}.mp3")
+            make_audio(path, spec["audio"][1])
+            audio.append((path, spec["audio"][1] * 60))
+    else:
+        print(f"{FFMPEG_BINARY} not found: skipping the audio corpus")
+    return {"documents": documents, "audio": audio}
+
+
+def install_fakes(latency: float, error_rate: float, seed: int = 0) -> FakeEmbeddings:
+    """
+    Route the Cohere and Pinecone clients to fakes
+    :return: Fake embedding client
+    """
+    embeddings = FakeEmbeddings(latency=latency, error_rate=error_rate, seed=seed)
+    rabbithole.embedding._service = EmbeddingService(client=embeddings,
+                                                     cache=Cache(tempfile.mkdtemp(prefix="rabbithole-benchmark-")))
+
+    store = FakeVectorStore(latency=latency, error_rate=error_rate, seed=seed)
+    titles = [f"Article {i} on {WORDS[i % len(WORDS)]}" for i in range(WIKIPEDIA_ARTICLES)]
+    store.vectors["wikipedia"] = {
+        str(i): (embeddings.embed(title), {"title": title, "url": f"https://simple.wikipedia.org/wiki?curid={i}"})
+        for i, title in enumerate(titles)
+    }
+    rabbithole.vecstore._index = store
+    return embeddings
+
+
+def measure(name: str, unit: str, calls: list[tuple[Callable[[], Any], float]]) -> dict:
+    """
+    Run the calls of a stage one after another and collect their statistics
+    :param name: Stage name
+    :param unit: Unit of work, e.g. "chunks"
+    :param calls: (call, units of work) of every call
+    :return: Stage statistics
+    """
+    latencies, errors, units = [], 0, 0.0
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    with get_tracer().run(name) as run:
+        for call, call_units in calls:
+            call_start = time.perf_counter()
+            try:
+                call()
+                units += call_units
+            except Exception as e:
+                errors += 1
+                print(f"{name}: {type(e).__name__}: {e}")
+            latencies.append(time.perf_counter() - call_start)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+
+    return {
+        "calls": len(calls),
+        "errors": errors,
+        "unit": unit,
+        "units": units,
+        "seconds": seconds,
+        "latency_mean": float(np.mean(latencies)) if latencies else 0.0,
+        "latency_p50": float(np.percentile(latencies, 50)) if latencies else 0.0,
+        "latency_p95": float(np.percentile(latencies, 95)) if latencies else 0.0,
+        "throughput": units / seconds if seconds else 0.0,
+        "peak_memory_mb": peak / 1024 ** 2,
+        # API calls, tokens, cache hits... recorded by the stage's instrumentation
+        "counters": {
+            counter + "".join(f"[{key}={value}]" for key, value in labels): value
+            for (counter, labels), value in sorted(get_tracer().counters(run.run_id).items())
+        },
+    }
+
+
+def run_size(size: str, args) -> dict[str, dict]:
+    """Run every stage over one corpus size"""
+    with tempfile.TemporaryDirectory(prefix="rabbithole-benchmark-") as directory:
+        corpus = make_corpus(size, directory, seed=args.seed)
+        install_fakes(args.latency, args.error_rate, seed=args.seed)
+        results = {}
+
+        documents = {}
+
+        def load(file):
+            documents[file.name] = list(iter_documents(file))
+
+        results["load_file"] = measure("load_file", "files", [(lambda f=f: load(f), 1) for f in corpus["documents"]])
+        num_chunks = {name: len(chunks) for name, chunks in documents.items()}
+
+        embeddings = {}
+
+        def embed(name):
+            embeddings[name] = embed_document([doc.page_content for doc in documents[name]])
+
+        results["embed_document"] = measure("embed_document", "chunks",
+                                            [(lambda n=n: embed(n), num_chunks[n]) for n in documents])
+
+        keywords = {}
+
+        def extract(name):
+            keywords[name] = get_document_keywords(embeddings[name])
+
+        results["get_document_keywords"] = measure("get_document_keywords", "chunks",
+                                                   [(lambda n=n: extract(n), num_chunks[n]) for n in embeddings])
+
+        summaries = {}
+        for mode in ("refine", "map_reduce"):
+            llm = FakeLLM(latency=args.llm_latency, error_rate=args.error_rate, seed=args.seed)
+
+            def summarize(name, mode=mode, llm=llm):
+                summaries[name] = summarize_document(documents[name], mode=mode, llm=llm)
+
+            results[f"summarize_document[{mode}]"] = measure(
+                f"summarize_document[{mode}]", "chunks", [(lambda n=n: summarize(n), num_chunks[n]) for n in documents]
+            )
+
+        if corpus["audio"]:
+            transcriber = FakeTranscriber(latency=args.latency * 10, error_rate=args.error_rate, seed=args.seed)
+            results["transcribe"] = measure("transcribe", "audio seconds", [
+                (lambda path=path: transcribe(path, transcriber=transcriber), seconds)
+                for path, seconds in corpus["audio"]
+            ])
+
+        plan = {"plan": [
+            {name: {"Background Concepts": words[:3], "Key Concepts": words[3:7], "Further Reading": words[7:]}}
+            for name, words in keywords.items()
+        ]}
+        with FakeChatServer(reply=json.dumps(plan), ttft=args.llm_latency, token_latency=args.token_latency,
+                            error_rate=args.error_rate, seed=args.seed) as server:
+            results["generate_plan"] = measure("generate_plan", "documents", [(
+                lambda: generate_plan(summaries, keywords, api_base=server.url, api_key="benchmark"), len(keywords)
+            )])
+    return results
+
+
+def git_revision() -> dict:
+    """Commit and working tree state of the benchmarked code"""
+    def git(*command: str) -> str:
+        try:
+            return subprocess.run(["git", *command], check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                  text=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ""
+
+    return {"commit": git("rev-parse", "--short", "HEAD") or "unknown",
+            "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def print_report(report: dict):
+    """Print the results of a report as a table"""
+    print(f"{'size':>7} {'stage':>30} {'calls':>6} {'errors':>6} {'p50 (s)':>8} {'p95 (s)':>8} "
+          f"{'throughput':>22} {'peak (MB)':>10}")
+    for size, stages in report["results"].items():
+        for stage, stats in stages.items():
+            print(f"{size:>7} {stage:>30} {stats['calls']:>6} {stats['errors']:>6} {stats['latency_p50']:>8.3f} "
+                  f"{stats['latency_p95']:>8.3f} {stats['throughput']:>10.1f} {stats['unit'] + '/s':<11} "
+                  f"{stats['peak_memory_mb']:>10.1f}")
+
+
+def compare(baseline_path: str, current_path: str, threshold: float) -> bool:
+    """
+    Print the change of every stage between two reports
+    :param baseline_path: Report of the baseline commit
+    :param current_path: Report of the new commit
+    :param threshold: Relative change counted as a regression, e.g. 0.1
+    :return: Whether any stage regressed
+    """
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(current_path, "r", encoding="utf-8") as f:
+        current = json.load(f)
+
+    print(f"Baseline {baseline['meta']['commit']} vs. {current['meta']['commit']}")
+    print(f"{'size':>7} {'stage':>30} {'p50':>9} {'throughput':>11} {'peak memory':>12}")
+
+    def change(old: float, new: float) -> float:
+        return (new - old) / old if old else 0.0
+
+    regressed = False
+    for size, stages in current["results"].items():
+        for stage, stats in stages.items():
+            old = baseline["results"].get(size, {}).get(stage)
+            if old is None:
+                print(f"{size:>7} {stage:>30} {'new':>9}")
+                continue
+            changes = (change(old["latency_p50"], stats["latency_p50"]),
+                       change(old["throughput"], stats["throughput"]),
+                       change(old["peak_memory_mb"], stats["peak_memory_mb"]))
+            # Higher latency and memory, and lower throughput, are regressions
+            stage_regressed = changes[0] > threshold or changes[1] < -threshold or changes[2] > threshold
+            regressed |= stage_regressed
+            print(f"{size:>7} {stage:>30} {changes[0]:>+9.0%} {changes[1]:>+11.0%} {changes[2]:>+12.0%}"
+                  f"{'  REGRESSION' if stage_regressed else ''}")
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", choices=list(CORPORA), default=["small", "medium"])
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per fake Cohere and Pinecone call")
+    parser.add_argument("--llm-latency", type=float, default=0.2,
+                        help="Seconds per fake LLM call, and time to first token of the fake chat server")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="Seconds per streamed fake chat token")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of a failed fake provider call")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None,
+                        help="Report path. Defaults to benchmarks/results/<commit>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="Compare two reports")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change reported as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, threshold=args.threshold) else 0)
+
+    revision = git_revision()
+    report = {
+        "meta": {
+            **revision,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        },
+        "results": {},
+    }
+
+    # Peak memory is traced for the whole run, which slows pure-Python code equally in every report
+    tracemalloc.start()
+    for size in args.sizes:
+        print(f"Running the {size} corpus...")
+        report["results"][size] = run_size(size, args)
+    tracemalloc.stop()
+
+    output = args.output or os.path.join("benchmarks", "results", f"{revision['commit']}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print_report(report)
+    print(f"Report written to {output}")
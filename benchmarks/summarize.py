@@ -0,0 +1,43 @@
+"""Benchmark of refine vs. map-reduce summarization latency and LLM calls with a fake LLM"""
+
+import argparse
+import os
+import random
+import time
+
+from langchain.schema import Document
+
+# Let the fake LLM run unthrottled
+os.environ.setdefault("RABBITHOLE_OPENAI_RPS", "1000")
+os.environ.setdefault("RABBITHOLE_OPENAI_BURST", "1000")
+os.environ.setdefault("RABBITHOLE_OPENAI_CONCURRENCY", "64")
+
+from rabbithole.fakes import FakeLLM  # noqa: E402
+from rabbithole.summarize import summarize_document  # noqa: E402
+
+WORDS = "learning model data network theory function system energy matrix vector graph process".split()
+
+
+def make_document(num_chunks: int, words_per_chunk: int = 700, seed: int = 0) -> list[Document]:
+    """Synthetic document of roughly 1000-token chunks"""
+    rng = random.Random(seed)
+    return [
+        Document(page_content=" ".join(rng.choices(WORDS, k=words_per_chunk)))
+        for _ in range(num_chunks)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per fake LLM call")
+    args = parser.parse_args()
+
+    print(f"{'chunks':>7} {'mode':>11} {'time (s)':>9} {'calls':>6}")
+    for num_chunks in args.chunks:
+        document = make_document(num_chunks)
+        for mode in ("refine", "map_reduce"):
+            llm = FakeLLM(latency=args.latency)
+            start = time.perf_counter()
+            summarize_document(document, mode=mode, llm=llm)
+            print(f"{num_chunks:>7} {mode:>11} {time.perf_counter() - start:>9.2f} {llm.calls:>6}")
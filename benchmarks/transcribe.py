@@ -0,0 +1,49 @@
+"""Benchmark of serial vs. concurrent chunk transcription with a stub transcriber"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from rabbithole.fakes import FakeTranscriber
+from rabbithole.transcribe import transcribe_chunks
+
+
+def make_chunks(directory: str, num_chunks: int, size: int = 1024) -> list[str]:
+    """Write placeholder audio chunk files"""
+    chunks = []
+    for i in range(num_chunks):
+        path = os.path.join(directory, f"chunk_{i:03d}.mp3")
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        chunks.append(path)
+    return chunks
+
+
+def run(chunks: list[str], latency: float, max_workers: int) -> tuple[float, float]:
+    """Time to the first segment and to the full transcript in seconds"""
+    transcriber = FakeTranscriber(latency=latency)
+    start = time.perf_counter()
+    first = None
+    segments = []
+    for segment in transcribe_chunks(chunks, transcriber=transcriber, max_workers=max_workers):
+        first = first or time.perf_counter() - start
+        segments.append(segment)
+    assert len(segments) == len(chunks)
+    return first, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, default=6, help="Number of 10-minute chunks (6 = one hour)")
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds per stub transcription call")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        audio_chunks = make_chunks(temp_dir, args.chunks)
+
+        print(f"{'workers':>8} {'first (s)':>10} {'total (s)':>10}")
+        for workers in args.workers:
+            first_segment, total = run(audio_chunks, args.latency, workers)
+            print(f"{workers:>8} {first_segment:>10.2f} {total:>10.2f}")
@@ -1,3 +1,10 @@
 """rabbithole package"""
 
-from .summarize import summarize_document
+
+def __getattr__(name: str):
+    # Imported on first use, so that importing a submodule does not load langchain
+    if name == "summarize_document":
+        from .summarize import summarize_document
+
+        return summarize_document
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,341 @@
+"""rabbithole.ann module"""
+
+import argparse
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from rabbithole.vecstore import LOCAL_BLOCK_SIZE, LOCAL_INDEX_DIR, LocalIndex
+
+# Number of inverted lists probed per query
+ANN_NPROBE = int(os.getenv("RABBITHOLE_ANN_NPROBE", "16"))
+
+# Number of candidates re-scored with the exact vectors (0 disables re-ranking)
+ANN_RERANK = int(os.getenv("RABBITHOLE_ANN_RERANK", "0"))
+
+# Every PQ sub-quantizer has 256 centroids so codes fit in a uint8
+PQ_CENTROIDS = 256
+
+
+def kmeans(x: np.ndarray, k: int, n_iter: int = 20, seed: int = 0) -> np.ndarray:
+    """
+    Lloyd's k-means with squared euclidean distance
+    :param x: (n, d) training vectors
+    :param k: Number of centroids
+    :param n_iter: Number of iterations
+    :param seed: Random seed for the initial centroids
+    :return: (k, d) centroids
+    """
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=np.float32)
+    if x.shape[0] < k:
+        raise ValueError(f"Need at least {k} training vectors. Got {x.shape[0]}")
+
+    centroids = x[rng.choice(x.shape[0], size=k, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = assign(x, centroids)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, x)
+        counts = np.bincount(assignments, minlength=k)
+
+        # Re-seed empty clusters with random training vectors
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = x[rng.choice(x.shape[0], size=int(empty.sum()), replace=False)]
+
+    return centroids
+
+
+def assign(x: np.ndarray, centroids: np.ndarray, block_size: int = 16384) -> np.ndarray:
+    """
+    Assign every vector to its nearest centroid
+    :param x: (n, d) vectors
+    :param centroids: (k, d) centroids
+    :param block_size: Number of vectors assigned per matrix multiply
+    :return: (n,) centroid indices
+    """
+    norms = (centroids ** 2).sum(axis=1)
+    out = np.empty(x.shape[0], dtype=np.int64)
+    for start in range(0, x.shape[0], block_size):
+        block = np.asarray(x[start: start + block_size], dtype=np.float32)
+        # argmin ||x - c||^2 == argmax 2 x.c - ||c||^2
+        out[start: start + block_size] = np.argmax(2 * block @ centroids.T - norms, axis=1)
+    return out
+
+
+class IVFPQIndex:
+    """
+    Inverted file index with product-quantized residuals
+
+    Vectors are partitioned by a coarse k-means quantizer into n_lists inverted lists.
+    The residual of every vector to its list centroid is split into n_subvectors pieces,
+    each encoded as one byte by its own 256-centroid codebook.
+
+    Queries are scored by dot product, like the exact LocalIndex:
+    q.x ~= q.c + sum_j q_j.codebook_j[code_j], so one lookup table per query serves every list.
+    """
+
+    def __init__(self, centroids: np.ndarray, codebooks: np.ndarray, list_offsets: np.ndarray,
+                 codes: np.ndarray, rows: np.ndarray, exact: LocalIndex | None = None):
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.list_offsets = list_offsets
+        self.codes = codes
+        self.rows = rows
+        self.exact = exact
+
+    @property
+    def n_lists(self) -> int:
+        return self.centroids.shape[0]
+
+    @property
+    def n_subvectors(self) -> int:
+        return self.codebooks.shape[0]
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    @classmethod
+    def train(cls, exact: LocalIndex, n_lists: int = 1024, n_subvectors: int = 96,
+              n_train: int = 100_000, n_iter: int = 20, seed: int = 0) -> "IVFPQIndex":
+        """
+        Train the quantizers on a sample of an exact index and encode all of its vectors
+        :param exact: Exact index to build from
+        :param n_lists: Number of inverted lists (coarse centroids)
+        :param n_subvectors: Number of PQ sub-quantizers. Must divide the vector dimension
+        :param n_train: Number of vectors sampled for training
+        :param n_iter: Number of k-means iterations
+        :param seed: Random seed
+        :return: Trained and populated index
+        """
+        n, dim = exact.embeddings.shape
+        if dim % n_subvectors:
+            raise ValueError(f"n_subvectors ({n_subvectors}) must divide the vector dimension ({dim})")
+        sub_dim = dim // n_subvectors
+
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(n, size=min(n_train, n), replace=False))
+        sample = np.asarray(exact.embeddings[sample_rows], dtype=np.float32)
+
+        print(f"Training coarse quantizer with {n_lists} lists on {len(sample)} vectors...")
+        centroids = kmeans(sample, n_lists, n_iter=n_iter, seed=seed)
+
+        residuals = sample - centroids[assign(sample, centroids)]
+        codebooks = np.empty((n_subvectors, PQ_CENTROIDS, sub_dim), dtype=np.float32)
+        for j in tqdm(range(n_subvectors), desc="Training sub-quantizers", unit="subvector"):
+            codebooks[j] = kmeans(residuals[:, j * sub_dim: (j + 1) * sub_dim], PQ_CENTROIDS,
+                                  n_iter=n_iter, seed=seed + j + 1)
+
+        lists = np.empty(n, dtype=np.int64)
+        codes = np.empty((n, n_subvectors), dtype=np.uint8)
+        for start in tqdm(range(0, n, LOCAL_BLOCK_SIZE), desc="Encoding vectors", unit="block"):
+            block = np.asarray(exact.embeddings[start: start + LOCAL_BLOCK_SIZE], dtype=np.float32)
+            block_lists = assign(block, centroids)
+            lists[start: start + len(block)] = block_lists
+            codes[start: start + len(block)] = encode(block - centroids[block_lists], codebooks)
+
+        # Group the codes by inverted list
+        rows = np.argsort(lists, kind="stable")
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(lists, minlength=n_lists), out=list_offsets[1:])
+
+        return cls(centroids, codebooks, list_offsets, codes[rows], rows, exact=exact)
+
+    def save(self, path: str | Path):
+        """
+        Save the index as .npy files in a directory
+        :param path: Directory to save to
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in ("centroids", "codebooks", "list_offsets", "codes", "rows"):
+            np.save(path / f"{name}.npy", getattr(self, name))
+
+    @classmethod
+    def load(cls, path: str | Path, exact: LocalIndex | None = None) -> "IVFPQIndex":
+        """
+        Load an index saved with IVFPQIndex.save, memory-mapping the codes
+        :param path: Directory to load from
+        :param exact: Exact index holding the metadata and full vectors
+        :return: Loaded index
+        """
+        path = Path(path)
+        return cls(
+            centroids=np.load(path / "centroids.npy"),
+            codebooks=np.load(path / "codebooks.npy"),
+            list_offsets=np.load(path / "list_offsets.npy"),
+            codes=np.load(path / "codes.npy", mmap_mode="r"),
+            rows=np.load(path / "rows.npy", mmap_mode="r"),
+            exact=exact,
+        )
+
+    def search(self, vectors, top_k: int, nprobe: int = ANN_NPROBE,
+               rerank: int = ANN_RERANK) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the approximate top_k highest scoring rows for every query vector
+        :param vectors: (m, dim) query vectors
+        :param top_k: Number of results per query
+        :param nprobe: Number of inverted lists scanned per query
+        :param rerank: Number of candidates re-scored with the exact vectors (0 disables re-ranking)
+        :return: (scores, rows) arrays of shape (m, top_k), sorted by descending score.
+        Rows are padded with -1 when fewer than top_k candidates are found.
+        """
+        queries = np.asarray(vectors, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        nprobe = min(nprobe, self.n_lists)
+        sub_dim = self.codebooks.shape[2]
+
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(coarse, -nprobe, axis=1)[:, -nprobe:]
+
+        # (m, n_subvectors, 256) inner products of each query piece with each codeword
+        luts = np.einsum("mjd,jcd->mjc", queries.reshape(len(queries), self.n_subvectors, sub_dim), self.codebooks)
+        subvectors = np.arange(self.n_subvectors)
+
+        out_scores = np.full((len(queries), top_k), -np.inf, dtype=np.float32)
+        out_rows = np.full((len(queries), top_k), -1, dtype=np.int64)
+        for qi, lists in enumerate(probes):
+            spans = [np.arange(self.list_offsets[li], self.list_offsets[li + 1]) for li in lists]
+            positions = np.concatenate(spans)
+            if not len(positions):
+                continue
+
+            scores = luts[qi][subvectors, self.codes[positions]].sum(axis=1)
+            scores += np.repeat(coarse[qi, lists], [len(span) for span in spans])
+            rows = self.rows[positions]
+
+            if rerank and self.exact is not None:
+                k = min(max(rerank, top_k), len(scores))
+                candidates = np.sort(rows[np.argpartition(scores, -k)[-k:]])
+                rows = candidates
+                scores = np.asarray(self.exact.embeddings[candidates], dtype=np.float32) @ queries[qi]
+
+            k = min(top_k, len(scores))
+            best = np.argpartition(scores, -k)[-k:]
+            best = best[np.argsort(-scores[best], kind="stable")]
+            out_scores[qi, :k] = scores[best]
+            out_rows[qi, :k] = rows[best]
+
+        return out_scores, out_rows
+
+    def query(self, vectors, top_k: int, nprobe: int = ANN_NPROBE, rerank: int = ANN_RERANK) -> list[list[dict]]:
+        """
+        Query the index with a batch of vectors
+        :param vectors: (m, dim) query vectors
+        :param top_k: Number of matches per query
+        :param nprobe: Number of inverted lists scanned per query
+        :param rerank: Number of candidates re-scored with the exact vectors (0 disables re-ranking)
+        :return: Pinecone-style matches ({"id", "score", "metadata"}) for every query
+        """
+        if self.exact is None:
+            raise ValueError("IVFPQIndex needs its exact index to resolve match metadata")
+
+        scores, rows = self.search(vectors, top_k, nprobe=nprobe, rerank=rerank)
+        return [
+            [
+                {"id": self.exact.ids[row], "score": float(score), "metadata": self.exact.metadata[row]}
+                for score, row in zip(row_scores, row_rows) if row >= 0
+            ]
+            for row_scores, row_rows in zip(scores.tolist(), rows.tolist())
+        ]
+
+
+def encode(residuals: np.ndarray, codebooks: np.ndarray) -> np.ndarray:
+    """
+    Product-quantize residual vectors
+    :param residuals: (n, dim) residuals
+    :param codebooks: (n_subvectors, 256, sub_dim) codebooks
+    :return: (n, n_subvectors) uint8 codes
+    """
+    n_subvectors, _, sub_dim = codebooks.shape
+    codes = np.empty((residuals.shape[0], n_subvectors), dtype=np.uint8)
+    for j in range(n_subvectors):
+        codes[:, j] = assign(residuals[:, j * sub_dim: (j + 1) * sub_dim], codebooks[j])
+    return codes
+
+
+def build_ivfpq(local_dir: str = LOCAL_INDEX_DIR, n_lists: int = 1024, n_subvectors: int = 96,
+                n_train: int = 100_000) -> IVFPQIndex:
+    """
+    Build an IVF-PQ index next to a local exact index
+    :param local_dir: Directory of the local exact index. The ANN index is saved to local_dir/ivfpq
+    :param n_lists: Number of inverted lists
+    :param n_subvectors: Number of PQ sub-quantizers
+    :param n_train: Number of vectors sampled for training
+    :return: Built index
+    """
+    index = IVFPQIndex.train(LocalIndex(local_dir), n_lists=n_lists, n_subvectors=n_subvectors, n_train=n_train)
+    index.save(Path(local_dir) / "ivfpq")
+    print(f"Saved IVF-PQ index with {len(index)} vectors to {Path(local_dir) / 'ivfpq'}")
+    return index
+
+
+def recall_report(index: IVFPQIndex, queries: np.ndarray, top_k: int = 30,
+                  nprobes: tuple[int, ...] = (1, 4, 16, 64), rerank: int = 0) -> list[dict]:
+    """
+    Measure recall@k and queries/sec of the ANN index against exact search
+    :param index: ANN index with its exact index attached
+    :param queries: (m, dim) query vectors
+    :param top_k: Number of results per query
+    :param nprobes: nprobe values to evaluate
+    :param rerank: Number of candidates re-scored with the exact vectors
+    :return: One {"nprobe", "recall", "qps"} row per nprobe value, plus an exact baseline row
+    """
+    start = time.perf_counter()
+    _, truth = index.exact.search(queries, top_k)
+    exact_qps = len(queries) / (time.perf_counter() - start)
+    report = [{"nprobe": "exact", "recall": 1.0, "qps": exact_qps}]
+
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        _, found = index.search(queries, top_k, nprobe=nprobe, rerank=rerank)
+        qps = len(queries) / (time.perf_counter() - start)
+
+        hits = sum(len(set(f.tolist()) & set(t.tolist())) for f, t in zip(found, truth))
+        report.append({"nprobe": nprobe, "recall": hits / truth.size, "qps": qps})
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and evaluate the IVF-PQ keyword index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build the IVF-PQ index from a local exact index")
+    build_parser.add_argument("--local-dir", default=LOCAL_INDEX_DIR)
+    build_parser.add_argument("--lists", type=int, default=1024)
+    build_parser.add_argument("--subvectors", type=int, default=96)
+    build_parser.add_argument("--train", type=int, default=100_000)
+
+    report_parser = subparsers.add_parser("report", help="Report recall@k and QPS against exact search")
+    report_parser.add_argument("--local-dir", default=LOCAL_INDEX_DIR)
+    report_parser.add_argument("--queries", type=int, default=1000)
+    report_parser.add_argument("--top-k", type=int, default=30)
+    report_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    report_parser.add_argument("--rerank", type=int, default=0)
+    report_parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_ivfpq(args.local_dir, n_lists=args.lists, n_subvectors=args.subvectors, n_train=args.train)
+    else:
+        exact_index = LocalIndex(args.local_dir)
+        ann_index = IVFPQIndex.load(Path(args.local_dir) / "ivfpq", exact=exact_index)
+
+        # Perturbed corpus vectors stand in for document chunk embeddings
+        generator = np.random.default_rng(args.seed)
+        sample = generator.choice(len(exact_index), size=args.queries, replace=False)
+        query_vectors = np.asarray(exact_index.embeddings[np.sort(sample)], dtype=np.float32)
+        query_vectors += generator.normal(scale=query_vectors.std() * 0.5, size=query_vectors.shape)
+
+        print(f"{'nprobe':>8} {'recall@' + str(args.top_k):>10} {'QPS':>10}")
+        for row in recall_report(ann_index, query_vectors, top_k=args.top_k,
+                                 nprobes=tuple(args.nprobe), rerank=args.rerank):
+            print(f"{row['nprobe']:>8} {row['recall']:>10.3f} {row['qps']:>10.1f}")
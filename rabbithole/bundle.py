@@ -0,0 +1,316 @@
+"""rabbithole.bundle module"""
+
+import argparse
+import io
+import json
+import os
+import struct
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO
+
+import numpy as np
+
+from rabbithole.incremental import FileRecord, SessionGraph
+from rabbithole.pipeline import STAGES
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+# Precision of the embeddings stored in bundles: "float16" halves the size, "float32" keeps them exact
+BUNDLE_DTYPE = os.getenv("RABBITHOLE_BUNDLE_DTYPE", "float16")
+
+# Directory of the bundles the app can open from the server
+BUNDLE_DIR = os.getenv("RABBITHOLE_BUNDLE_DIR", "bundles")
+
+BUNDLE_SUFFIX = ".rhb"
+BUNDLE_VERSION = 1
+
+_MAGIC = b"RHBUNDLE"
+_HEADER = struct.Struct("<8sIQ")  # Magic, version, header length
+# Sections start at multiples of this many bytes, so every array can be viewed in place
+_ALIGNMENT = 64
+
+
+def _align(offset: int) -> int:
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def write_bundle(graph: SessionGraph, file: BinaryIO, dtype: str = BUNDLE_DTYPE):
+    """
+    Write the results of a session to a bundle
+    :param graph: Session graph holding the stage results of every file and the study plan
+    :param file: Binary file to write to
+    :param dtype: Precision of the stored embeddings, "float16" or "float32"
+
+    A bundle is a JSON header followed by columnar sections: one (chunks, dim) embedding matrix for the chunks
+    of every file, the byte offsets of the chunk texts, and the UTF-8 chunk texts one after another.
+    The header holds the file records, the chunk metadata, the keywords, summaries and other stage results,
+    the study plan, and the position of every section.
+    """
+    files, metadata, texts, blocks = [], [], [], []
+    for record in graph.records.values():
+        documents = record.results.get("load", [])
+        vectors = record.results.get("embed")
+        embedded = vectors is not None and len(vectors) == len(documents) and len(documents) > 0
+        files.append({
+            "name": record.name,
+            "digest": record.digest,
+            "settings": record.settings,
+            "errors": record.errors,
+            "loaded": "load" in record.results,
+            "chunks": len(documents),
+            "embedded": embedded or (vectors is not None and not len(documents)),
+            # Keywords, summaries, deduplication reports...
+            "results": {stage: result for stage, result in record.results.items() if stage not in ("load", "embed")},
+        })
+        metadata.extend(doc.metadata for doc in documents)
+        texts.extend(doc.page_content.encode("utf-8") for doc in documents)
+        if embedded:
+            blocks.append(np.asarray(vectors))
+
+    embeddings = np.concatenate(blocks).astype(dtype) if blocks else np.zeros((0, 0), dtype=dtype)
+    text_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in texts], out=text_offsets[1:])
+
+    sections = {"embeddings": embeddings, "text_offsets": text_offsets}
+    header = {
+        "version": BUNDLE_VERSION,
+        "created": time.time(),
+        "files": files,
+        "metadata": metadata,
+        "plan": graph.plan,
+        "plan_key": graph.plan_key,
+        "sections": {},
+    }
+
+    # Place the sections after the header. The header does not know its own length yet, so its section
+    # offsets are relative to the end of the aligned header
+    offset = 0
+    for name, array in sections.items():
+        header["sections"][name] = {"offset": offset, "dtype": array.dtype.str, "shape": list(array.shape)}
+        offset = _align(offset + array.nbytes)
+    header["sections"]["text"] = {"offset": offset, "length": int(text_offsets[-1])}
+
+    encoded = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    start = _align(_HEADER.size + len(encoded))
+    file.write(_HEADER.pack(_MAGIC, BUNDLE_VERSION, len(encoded)))
+    file.write(encoded)
+    position = _HEADER.size + len(encoded)
+    for name, array in sections.items():
+        section_start = start + header["sections"][name]["offset"]
+        file.write(b"\0" * (section_start - position))
+        file.write(np.ascontiguousarray(array).tobytes())
+        position = section_start + array.nbytes
+    file.write(b"\0" * (start + header["sections"]["text"]["offset"] - position))
+    for text in texts:
+        file.write(text)
+
+
+def save_bundle(graph: SessionGraph, path: str | Path, dtype: str = BUNDLE_DTYPE):
+    """
+    Save the results of a session to a bundle file
+    :param graph: Session graph
+    :param path: Bundle path. Written to a temporary file first, so an interrupted save keeps the old bundle
+    :param dtype: Precision of the stored embeddings, "float16" or "float32"
+    """
+    path = Path(path)
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, "wb") as f:
+        write_bundle(graph, f, dtype=dtype)
+    os.replace(temp_path, path)
+
+
+def bundle_bytes(graph: SessionGraph, dtype: str = BUNDLE_DTYPE) -> bytes:
+    """
+    Serialize the results of a session, e.g. for a download
+    :param graph: Session graph
+    :param dtype: Precision of the stored embeddings, "float16" or "float32"
+    :return: Bundle contents
+    """
+    buffer = io.BytesIO()
+    write_bundle(graph, buffer, dtype=dtype)
+    return buffer.getvalue()
+
+
+def find_bundles(directory: str | Path = BUNDLE_DIR) -> list[str]:
+    """
+    List the bundles of a directory
+    :param directory: Directory searched recursively
+    :return: Bundle paths relative to the directory, sorted
+    """
+    directory = Path(directory)
+    if not directory.is_dir():
+        return []
+    return sorted(path.relative_to(directory).as_posix() for path in directory.rglob(f"*{BUNDLE_SUFFIX}")
+                  if path.is_file())
+
+
+def bundle_path(name: str, directory: str | Path = BUNDLE_DIR) -> Path:
+    """
+    Resolve the path of a bundle of a directory
+    :param name: Bundle path relative to the directory
+    :param directory: Directory of the bundles
+    :return: Absolute path of the bundle
+    :raises ValueError: If the path leads outside the directory or is not a bundle
+    """
+    root = Path(directory).resolve()
+    path = (root / name).resolve()
+    if not path.is_relative_to(root) or path.suffix != BUNDLE_SUFFIX:
+        raise ValueError(f"{name} is not a bundle of {directory}")
+    return path
+
+
+def read_bundle(source: str | Path | bytes, stages: tuple[str, ...] = STAGES) -> SessionGraph:
+    """
+    Open a bundle as a session graph
+    :param source: Bundle path, memory-mapped, or bundle contents, e.g. an uploaded bundle
+    :param stages: Stages every file must complete
+    :return: Session graph with the results of every file and the study plan. The embeddings of every file
+    are read-only views of the bundle's embedding matrix, read from disk as they are used
+    """
+    from langchain.schema import Document
+
+    raw = np.frombuffer(source, dtype=np.uint8) if isinstance(source, bytes) else np.memmap(source, mode="r")
+    if raw.size < _HEADER.size:
+        raise ValueError("Not a RabbitHole bundle: the file is too short")
+    magic, version, length = _HEADER.unpack(raw[:_HEADER.size].tobytes())
+    if magic != _MAGIC:
+        raise ValueError("Not a RabbitHole bundle")
+    if version != BUNDLE_VERSION:
+        raise ValueError(f"Unsupported bundle version {version}. Expected {BUNDLE_VERSION}")
+    header = json.loads(raw[_HEADER.size:_HEADER.size + length].tobytes().decode("utf-8"))
+    start = _align(_HEADER.size + length)
+
+    def section(name: str) -> np.ndarray:
+        info = header["sections"][name]
+        dtype = np.dtype(info["dtype"])
+        offset = start + info["offset"]
+        count = int(np.prod(info["shape"]))
+        return raw[offset:offset + count * dtype.itemsize].view(dtype).reshape(info["shape"])
+
+    embeddings = section("embeddings")
+    text_offsets = section("text_offsets")
+    text_start = start + header["sections"]["text"]["offset"]
+    text = raw[text_start:text_start + header["sections"]["text"]["length"]]
+
+    graph = SessionGraph(stages)
+    chunk = row = 0
+    for info in header["files"]:
+        record = FileRecord(name=info["name"], digest=info["digest"], settings=info["settings"],
+                            results=dict(info["results"]), errors=dict(info["errors"]))
+        if info["loaded"]:
+            record.results["load"] = [
+                Document(page_content=text[text_offsets[i]:text_offsets[i + 1]].tobytes().decode("utf-8"),
+                         metadata=header["metadata"][i])
+                for i in range(chunk, chunk + info["chunks"])
+            ]
+        if info["embedded"]:
+            rows = info["chunks"]
+            record.results["embed"] = embeddings[row:row + rows] if rows else np.empty((0, 0), dtype=np.float32)
+            row += rows
+        chunk += info["chunks"]
+        graph.records[record.name] = record
+
+    graph.plan = header["plan"]
+    graph.plan_key = header["plan_key"]
+    return graph
+
+
+def build(paths: list[str], output: str, summary_mode: str, planner: str, dtype: str):
+    """
+    Process files in this process and save the results as a bundle
+    :param paths: Files to process
+    :param output: Bundle path
+    :param summary_mode: Summarization mode
+    :param planner: "llm" or "ordering" to generate the study plan, "none" to leave it to the app
+    :param dtype: Precision of the stored embeddings
+    """
+    from rabbithole.jobs import NamedBytesIO
+    from rabbithole.keywords import get_corpus_keywords
+    from rabbithole.pipeline import Pipeline
+    from rabbithole.summarize import summarize_document
+
+    files = []
+    for path in paths:
+        with open(path, "rb") as f:
+            files.append(NamedBytesIO(f.read(), os.path.basename(path)))
+
+    graph = SessionGraph(STAGES)
+    graph.update(files, settings={"summary_mode": summary_mode})
+    pipeline = Pipeline(summarize=lambda documents: summarize_document(documents, mode=summary_mode))
+    for event in pipeline.run(files):
+        if event.ok:
+            graph.set_result(event.file_name, event.stage, event.result)
+            for key, details in (event.details or {}).items():
+                graph.set_result(event.file_name, key, details)
+            print(f"{event.file_name}: {event.stage} ({event.elapsed:.1f}s)")
+        else:
+            graph.set_error(event.file_name, event.stage, event.error)
+            print(f"{event.file_name}: {event.stage} failed: {event.error}")
+
+    # Rank the keywords of every file against the whole upload, like the app does
+    embeddings = graph.results("embed")
+    graph.set_corpus_keywords(get_corpus_keywords(embeddings) if len(embeddings) > 1 else {})
+
+    if planner != "none":
+        summaries, keywords = graph.results("summarize"), graph.keywords()
+        if planner == "ordering":
+            from rabbithole.ordering import order_plan
+
+            plan = order_plan(summaries, keywords, graph.results("embed"))
+        else:
+            from rabbithole.planner import generate_plan
+
+            plan = generate_plan(summaries, keywords)
+        graph.set_plan(plan, settings={"planner": planner})
+
+    save_bundle(graph, output, dtype=dtype)
+    print(f"Bundle of {len(files)} files written to {output} ({os.path.getsize(output) / 1024 ** 2:.1f} MB)")
+
+
+def info(path: str):
+    """Print the contents of a bundle"""
+    import langchain.schema  # noqa: F401, imported before timing the open
+
+    start = time.perf_counter()
+    graph = read_bundle(path)
+    elapsed = time.perf_counter() - start
+    print(f"{path}: {len(graph.records)} files, opened in {elapsed * 1000:.0f} ms")
+    for record in graph.records.values():
+        vectors = record.results.get("embed")
+        shape = "x".join(map(str, vectors.shape)) if vectors is not None else "none"
+        print(f"  {record.name}: {len(record.results.get('load', []))} chunks, embeddings {shape}, "
+              f"{len(record.results.get('corpus_keywords', record.results.get('keywords', [])))} keywords"
+              f"{', errors: ' + ', '.join(record.errors) if record.errors else ''}")
+    print(f"  plan: {'yes' if graph.plan is not None else 'no'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and inspect RabbitHole session bundles")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = commands.add_parser("build", help="Process files and save the results as a bundle")
+    build_parser.add_argument("files", nargs="+", help="Files to process")
+    build_parser.add_argument("-o", "--output", required=True, help=f"Bundle path, e.g. course{BUNDLE_SUFFIX}")
+    build_parser.add_argument("--summary-mode", choices=["refine", "map_reduce"], default=None,
+                              help="Summarization mode. Defaults to RABBITHOLE_SUMMARY_MODE")
+    build_parser.add_argument("--planner", choices=["llm", "ordering", "none"], default="none",
+                              help="Generate the study plan with this planner")
+    build_parser.add_argument("--dtype", choices=["float16", "float32"], default=BUNDLE_DTYPE,
+                              help="Precision of the stored embeddings")
+
+    info_parser = commands.add_parser("info", help="Print the contents of a bundle")
+    info_parser.add_argument("bundle", help="Bundle path")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        from rabbithole.summarize import SUMMARY_MODE
+
+        build(args.files, args.output, args.summary_mode or SUMMARY_MODE, args.planner, args.dtype)
+    else:
+        info(args.bundle)
+
+
+if __name__ == "__main__":
+    main()
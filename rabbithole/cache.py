@@ -0,0 +1,208 @@
+"""rabbithole.cache module"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from rabbithole.metrics import count
+
+# Directory of the persistent cache
+CACHE_DIR = os.getenv("RABBITHOLE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "rabbithole"))
+
+# Maximum total size of the cached values in bytes
+CACHE_MAX_BYTES = int(os.getenv("RABBITHOLE_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+
+def content_hash(*parts: str | bytes) -> str:
+    """
+    Hash a sequence of strings and bytes into a cache key
+    :param parts: Parts of the key, e.g. model name and chunk text
+    :return: Hex SHA-256 digest
+
+    Every part is length-prefixed, so ("ab", "c") and ("a", "bc") hash differently.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part.encode("utf-8") if isinstance(part, str) else bytes(part)
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class Cache:
+    """
+    Persistent content-addressed cache in a SQLite database
+
+    Values are bytes stored under (namespace, key). When the total size of the values exceeds max_bytes,
+    the least recently used entries are evicted down to 90% of max_bytes.
+    Hits and misses are counted per namespace.
+    """
+
+    def __init__(self, path: str | Path = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        """
+        :param path: Directory of the cache database
+        :param max_bytes: Maximum total size of the cached values in bytes
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits: Counter = Counter()
+        self.misses: Counter = Counter()
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path / "cache.sqlite", check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, "
+            "size INTEGER NOT NULL, accessed REAL NOT NULL, PRIMARY KEY (namespace, key))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._db.commit()
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get(self, namespace: str, key: str) -> bytes | None:
+        """
+        Get a cached value
+        :param namespace: Namespace of the value, e.g. "embedding"
+        :param key: Key of the value
+        :return: Cached value, or None on a miss
+        """
+        return self.get_many(namespace, [key]).get(key)
+
+    def get_many(self, namespace: str, keys: list[str]) -> dict[str, bytes]:
+        """
+        Get many cached values at once
+        :param namespace: Namespace of the values
+        :param keys: Keys of the values
+        :return: Cached values by key. Missing keys are left out
+        """
+        found: dict[str, bytes] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            # Stay below SQLite's limit of bound parameters per statement
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start: start + 500]
+                placeholders = ", ".join("?" * len(batch))
+                rows = self._db.execute(
+                    f"SELECT key, value FROM entries WHERE namespace = ? AND key IN ({placeholders})",
+                    [namespace, *batch],
+                ).fetchall()
+                found.update(rows)
+
+            if found:
+                now = time.time()
+                self._db.executemany(
+                    "UPDATE entries SET accessed = ? WHERE namespace = ? AND key = ?",
+                    [(now, namespace, key) for key in found],
+                )
+                self._db.commit()
+
+        hits = sum(key in found for key in keys)
+        self.hits[namespace] += hits
+        self.misses[namespace] += len(keys) - hits
+        count("cache_hits", hits, namespace=namespace)
+        count("cache_misses", len(keys) - hits, namespace=namespace)
+        return found
+
+    def set(self, namespace: str, key: str, value: bytes):
+        """
+        Cache a value
+        :param namespace: Namespace of the value
+        :param key: Key of the value
+        :param value: Value to cache
+        """
+        self.set_many(namespace, {key: value})
+
+    def set_many(self, namespace: str, values: dict[str, bytes]):
+        """
+        Cache many values at once
+        :param namespace: Namespace of the values
+        :param values: Values to cache by key
+        """
+        if not values:
+            return
+
+        now = time.time()
+        keys = list(values)
+        with self._lock:
+            # Size of the values that are replaced
+            replaced = 0
+            for start in range(0, len(keys), 500):
+                batch = keys[start: start + 500]
+                placeholders = ", ".join("?" * len(batch))
+                replaced += self._db.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM entries WHERE namespace = ? AND key IN ({placeholders})",
+                    [namespace, *batch],
+                ).fetchone()[0]
+            self._db.executemany(
+                "INSERT OR REPLACE INTO entries (namespace, key, value, size, accessed) VALUES (?, ?, ?, ?, ?)",
+                [(namespace, key, sqlite3.Binary(value), len(value), now) for key, value in values.items()],
+            )
+            self._db.commit()
+            self._size += sum(len(value) for value in values.values()) - replaced
+
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Delete the least recently used entries until the cache is below 90% of max_bytes"""
+        # Other processes may have written to the cache too
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        excess = self._size - int(self.max_bytes * 0.9)
+        if excess <= 0:
+            return
+
+        # The oldest entries whose older entries add up to less than the excess
+        evicted = self._db.execute(
+            "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM (SELECT rowid, size, "
+            "SUM(size) OVER (ORDER BY accessed, rowid) AS total FROM entries) WHERE total - size < ?) "
+            "RETURNING size",
+            (excess,),
+        ).fetchall()
+        self._db.commit()
+        self._size -= sum(size for size, in evicted)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """
+        Get the hit and miss counts of every namespace since the cache was opened
+        :return: {"namespace": {"hits": int, "misses": int}}
+        """
+        return {
+            namespace: {"hits": self.hits[namespace], "misses": self.misses[namespace]}
+            for namespace in sorted(set(self.hits) | set(self.misses))
+        }
+
+    def size(self) -> int:
+        """
+        Get the total size of the cached values
+        :return: Size in bytes
+        """
+        return self._size
+
+    def clear(self):
+        """Delete every cached value"""
+        with self._lock:
+            self._db.execute("DELETE FROM entries")
+            self._db.commit()
+            self._size = 0
+
+
+_cache: Cache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Cache:
+    """
+    Get the process-wide cache, opening it on first use
+    :return: Cache
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = Cache()
+        return _cache
@@ -0,0 +1,214 @@
+"""rabbithole.chat module"""
+
+import os
+from typing import TYPE_CHECKING, Callable, Iterator
+
+import numpy as np
+
+from rabbithole.chunking import count_tokens, truncate_tokens
+from rabbithole.embedding import embed_document
+from rabbithole.ratelimit import retry
+from rabbithole.streaming import stream_chat
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+CHAT_MODEL = os.getenv("RABBITHOLE_CHAT_MODEL", "gpt-4")
+
+# Number of document chunks retrieved per question
+CHAT_TOP_K = int(os.getenv("RABBITHOLE_CHAT_TOP_K", "5"))
+
+# Token budgets of each part of the prompt. Together they bound the prompt size of every turn
+CHAT_CONTEXT_TOKENS = int(os.getenv("RABBITHOLE_CHAT_CONTEXT_TOKENS", "2000"))
+CHAT_HISTORY_TOKENS = int(os.getenv("RABBITHOLE_CHAT_HISTORY_TOKENS", "1000"))
+CHAT_SUMMARY_TOKENS = 300
+CHAT_QUESTION_TOKENS = 500
+
+# Model that folds older turns into the conversation summary
+CHAT_SUMMARY_MODEL = os.getenv("RABBITHOLE_CHAT_SUMMARY_MODEL", "gpt-3.5-turbo")
+
+SYSTEM_PROMPT = (
+    "You are an experienced professor helping a student learn from their documents. "
+    "Answer using the document excerpts when they are relevant, name the documents you used, "
+    "and say so when the excerpts do not cover the question."
+)
+
+
+class SessionIndex:
+    """
+    In-memory vector index over the chunks of a session's documents
+
+    Chunks are scored by cosine similarity. The index is rebuilt from the per-file results of the
+    pipeline, so it follows the uploaded file set without embedding anything again.
+    """
+
+    def __init__(self):
+        self.texts: list[str] = []
+        self.sources: list[str] = []
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+
+    @classmethod
+    def from_results(cls, documents: dict[str, list["Document"]], embeddings: dict[str, np.ndarray]) -> "SessionIndex":
+        """
+        Build the index from the loaded documents and their chunk embeddings
+        :param documents: Document chunks of every file
+        :param embeddings: (chunks, dim) embeddings of every file, in chunk order
+        :return: Session index
+        """
+        index = cls()
+        blocks = []
+        for name, chunks in documents.items():
+            vectors = embeddings.get(name)
+            if vectors is None or len(vectors) != len(chunks) or not len(chunks):
+                continue
+            index.texts.extend(doc.page_content for doc in chunks)
+            index.sources.extend([name] * len(chunks))
+            blocks.append(np.asarray(vectors, dtype=np.float32))
+        if blocks:
+            vectors = np.concatenate(blocks)
+            index.vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def search(self, vector: np.ndarray, top_k: int = CHAT_TOP_K) -> list[dict]:
+        """
+        Find the chunks closest to a query
+        :param vector: (dim,) query embedding
+        :param top_k: Number of chunks to return
+        :return: {"source", "text", "score"} of the best chunks, by descending score
+        """
+        if not len(self):
+            return []
+        query = np.asarray(vector, dtype=np.float32).reshape(-1)
+        scores = self.vectors @ (query / max(np.linalg.norm(query), 1e-12))
+        k = min(top_k, len(scores))
+        best = np.argpartition(scores, -k)[-k:]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [{"source": self.sources[i], "text": self.texts[i], "score": float(scores[i])} for i in best]
+
+
+class ChatSession:
+    """
+    Retrieval-augmented chat over a session index with a token-bounded prompt
+
+    Every prompt holds the system prompt, a summary of older turns, the most recent turns that fit the
+    history budget, the retrieved chunks that fit the context budget and the question, so prompt size
+    stays bounded however long the conversation is and however many files are uploaded.
+    Turns that no longer fit the history budget are folded into the summary.
+    """
+
+    def __init__(self, index: SessionIndex | None = None, embed: Callable[[list[str]], np.ndarray] = embed_document,
+                 model: str = CHAT_MODEL, top_k: int = CHAT_TOP_K, context_tokens: int = CHAT_CONTEXT_TOKENS,
+                 history_tokens: int = CHAT_HISTORY_TOKENS, summarize_history: bool = True):
+        """
+        :param index: Index of the document chunks
+        :param embed: Embedding function for the questions, the same model as the chunk embeddings
+        :param model: Chat model
+        :param top_k: Number of chunks retrieved per question
+        :param context_tokens: Token budget of the retrieved chunks
+        :param history_tokens: Token budget of the recent turns
+        :param summarize_history: Fold older turns into a summary with an LLM call. Otherwise they are dropped
+        """
+        self.index = index or SessionIndex()
+        self.embed = embed
+        self.model = model
+        self.top_k = top_k
+        self.context_tokens = context_tokens
+        self.history_tokens = history_tokens
+        self.summarize_history = summarize_history
+
+        self.turns: list[tuple[str, str]] = []  # (question, answer) turns not folded into the summary
+        self.summary = ""
+
+    def retrieve(self, question: str) -> list[dict]:
+        """
+        Retrieve the chunks relevant to a question
+        :param question: User question
+        :return: Chunks that fit the context budget, by descending score
+        """
+        if not len(self.index):
+            return []
+        matches = self.index.search(np.asarray(self.embed([question]))[0], top_k=self.top_k)
+
+        chunks, used = [], 0
+        for match in matches:
+            tokens = count_tokens(match["text"])
+            if used + tokens > self.context_tokens:
+                # Cut the first chunk that does not fit to the remaining budget
+                match = {**match, "text": truncate_tokens(match["text"], self.context_tokens - used)}
+                tokens = self.context_tokens - used
+            if tokens <= 0:
+                break
+            chunks.append(match)
+            used += tokens
+        return chunks
+
+    def _fold(self, turns: list[tuple[str, str]], **kwargs):
+        """Fold turns into the conversation summary, or drop them if summaries are disabled or fail"""
+        if not self.summarize_history:
+            return
+        transcript = "\n".join(f"Student: {question}\nProfessor: {answer}" for question, answer in turns)
+        prompt = (
+            "Summarize this conversation between a student and a professor in a few sentences, keeping the "
+            f"topics and conclusions.\n\nEarlier summary: {self.summary or 'none'}\n\n"
+            f"{truncate_tokens(transcript, self.history_tokens)}"
+        )
+        try:
+            summary = retry(lambda: "".join(stream_chat(
+                [{"role": "user", "content": prompt}], model=CHAT_SUMMARY_MODEL, **kwargs
+            )))
+        except Exception as e:
+            print(f"Dropping {len(turns)} turns from the chat history: {e}")
+            return
+        self.summary = truncate_tokens(summary.strip(), CHAT_SUMMARY_TOKENS)
+
+    def build_messages(self, question: str, chunks: list[dict], **kwargs) -> list[dict]:
+        """
+        Build the prompt of a turn, folding the turns that do not fit the history budget
+        :param question: User question
+        :param chunks: Retrieved chunks
+        :param kwargs: Extra arguments of the OpenAI calls, e.g. api_base
+        :return: Chat messages
+        """
+        # Keep the most recent turns that fit the budget
+        recent, used = [], 0
+        for question_, answer in reversed(self.turns):
+            tokens = count_tokens(question_) + count_tokens(answer)
+            if used + tokens > self.history_tokens:
+                break
+            recent.insert(0, (question_, answer))
+            used += tokens
+        older = self.turns[:len(self.turns) - len(recent)]
+        if older:
+            self._fold(older, **kwargs)
+            self.turns = recent
+
+        system = SYSTEM_PROMPT
+        if self.summary:
+            system += f"\n\nSummary of the earlier conversation: {self.summary}"
+        if chunks:
+            excerpts = "\n\n".join(f"[{chunk['source']}]\n{chunk['text']}" for chunk in chunks)
+            system += f"\n\nDocument excerpts:\n{excerpts}"
+
+        messages = [{"role": "system", "content": system}]
+        for question_, answer in recent:
+            messages.append({"role": "user", "content": question_})
+            messages.append({"role": "assistant", "content": answer})
+        messages.append({"role": "user", "content": truncate_tokens(question, CHAT_QUESTION_TOKENS)})
+        return messages
+
+    def ask(self, question: str, **kwargs) -> Iterator[str]:
+        """
+        Answer a question, streaming the answer
+        :param question: User question
+        :param kwargs: Extra arguments of the OpenAI calls, e.g. api_base
+        :return: Iterator of answer text deltas. The turn is recorded once the answer is complete
+        """
+        messages = self.build_messages(question, self.retrieve(question), **kwargs)
+        answer = ""
+        for delta in stream_chat(messages, model=self.model, **kwargs):
+            answer += delta
+            yield delta
+        self.turns.append((question, answer))
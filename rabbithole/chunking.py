@@ -0,0 +1,256 @@
+"""rabbithole.chunking module"""
+
+import os
+import re
+from array import array
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterable, Iterator
+
+import tiktoken
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+ENCODING_NAME = "cl100k_base"
+
+# Token window of the chunks that are embedded, deduplicated and queried for keywords
+CHUNK_SIZE = int(os.getenv("RABBITHOLE_CHUNK_TOKENS", "1000"))
+CHUNK_OVERLAP = 100
+
+# Token window of the chunks that are summarized, joined from consecutive chunks of the loader.
+# Larger chunks take fewer summarization calls. Summarization joins smaller chunks when the prompt, the running
+# summary and the completion would not fit the context window of the LLM with them
+SUMMARY_CHUNK_SIZE = int(os.getenv("RABBITHOLE_SUMMARY_CHUNK_TOKENS", "3000"))
+
+# A chunk is cut at the strongest boundary past this fraction of its window, or at the end of the window
+MIN_CHUNK_FILL = 0.5
+
+# Strength of the boundaries chunks are cut at: the start of a line, a sentence, a paragraph,
+# a PDF page or a transcript segment, and a heading
+LINE, SENTENCE, PARAGRAPH, SECTION, HEADING = range(5)
+
+# Markdown headings, numbered headings like "2.1 Gradient descent" or "Lecture 3: Graphs", and all-caps titles
+_HEADING = re.compile(r"#{1,6}\s.*|(\d+(\.\d+)*\.?|[IVXLC]+\.|Chapter|Section|Lecture|Part)\s+\S.*"
+                      r"|[A-Z][A-Z0-9 ,:&'()-]{3,}")
+_HEADING_MAX_CHARS = 80
+# Sentence ends within a line. The space stays with the next sentence, as the tokenizer would have it
+_SENTENCE_END = re.compile(r"[.!?](?=[ \t])")
+
+
+_encoding = None
+
+
+def _get_encoding() -> "tiktoken.Encoding":
+    """Get the encoding of the chunks, loading it on first use"""
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding(ENCODING_NAME)
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens of a text with the encoding of the chunks. Special tokens are treated as plain text
+    :param text: Text to count
+    :return: Number of tokens
+    """
+    return len(_get_encoding().encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cut a text to a number of tokens of the encoding of the chunks. Special tokens are treated as plain text
+    :param text: Text to cut
+    :param max_tokens: Maximum number of tokens to keep
+    :return: The text, or its first max_tokens tokens
+    """
+    tokens = _get_encoding().encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else _get_encoding().decode(tokens[:max_tokens])
+
+
+@dataclass
+class Chunk:
+    """A token window of a stream of texts"""
+    text: str
+    start: int  # Token offset of the window in the stream
+    end: int
+    boundary: int  # Strength of the boundary the text new to this chunk starts at
+    overlap: int  # Number of characters at the start of the text repeated from the previous chunk
+
+
+def is_heading(line: str) -> bool:
+    """
+    Whether a line looks like a heading
+    :param line: Line of text
+    """
+    line = line.strip()
+    return 0 < len(line) <= _HEADING_MAX_CHARS and line[-1] not in ".,;" and _HEADING.fullmatch(line) is not None
+
+
+def pieces(text: str, boundary: int = SECTION) -> Iterator[tuple[str, int]]:
+    """
+    Cut a text at the start of its lines and sentences
+    :param text: Text to cut
+    :param boundary: Strength of the boundary at the start of the text
+    :return: Iterator of (piece, strength of the boundary at its start). The pieces join into the text
+    """
+    blank = False
+    for number, line in enumerate(text.splitlines(keepends=True)):
+        if number == 0:
+            strength = boundary
+        elif is_heading(line):
+            strength = HEADING
+        else:
+            strength = PARAGRAPH if blank else LINE
+        blank = not line.strip()
+
+        # Long lines, like transcripts, are cut at their sentence ends
+        start = 0
+        for match in _SENTENCE_END.finditer(line):
+            yield line[start:match.end()], strength
+            start, strength = match.end(), SENTENCE
+        if start < len(line):
+            yield line[start:], strength
+
+
+class TokenChunker:
+    """
+    Split a stream of texts into overlapping token windows cut at headings, pages and paragraphs,
+    tokenizing every text once
+
+    Texts are cut into lines and sentences, each tokenized once as it arrives, so pages and transcript segments
+    can be fed one at a time and the token offset of every boundary is known without tokenizing again.
+    Each window ends at the strongest boundary of the second half of its window, a heading before a page or
+    segment, before a paragraph, before a sentence, or at the end of the window if there is no boundary.
+    Windows following a heading start at the heading, the others overlap the previous window.
+    """
+
+    def __init__(self, encoding_name: str = ENCODING_NAME, chunk_size: int = CHUNK_SIZE,
+                 chunk_overlap: int = CHUNK_OVERLAP):
+        if chunk_overlap >= chunk_size * MIN_CHUNK_FILL:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than {MIN_CHUNK_FILL} * chunk_size "
+                             f"({chunk_size})")
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    def encode(self, text: str) -> list[int]:
+        """
+        Tokenize a text. Special tokens are treated as plain text
+        :param text: Text to tokenize
+        :return: Token ids
+        """
+        return self.encoding.encode(text, disallowed_special=())
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        Cut a text to a number of tokens
+        :param text: Text to cut
+        :param max_tokens: Maximum number of tokens to keep
+        :return: The text, or its first max_tokens tokens
+        """
+        tokens = self.encode(text)
+        return text if len(tokens) <= max_tokens else self.encoding.decode(tokens[:max_tokens])
+
+    def split(self, texts: Iterable[str], separator: str = "\n", boundary: int = SECTION) -> Iterator[Chunk]:
+        """
+        Split consecutive texts into chunks as they arrive
+        :param texts: Texts, e.g. the pages of a PDF or the segments of a transcript
+        :param separator: Joined between consecutive texts
+        :param boundary: Strength of the boundary between consecutive texts
+        :return: Iterator of chunks
+        """
+        tokens = array("I")  # Tokens from offset base on
+        base = 0
+        cuts: list[tuple[int, int]] = []  # (token offset, strength) of the boundaries past the chunk start
+        start, start_boundary, overlap = 0, boundary, 0
+        previous_end = 0
+
+        def cut() -> Chunk:
+            nonlocal base, cuts, start, start_boundary, overlap, previous_end
+            low, high = start + int(self.chunk_size * MIN_CHUNK_FILL), start + self.chunk_size
+            # The strongest boundary in the second half of the window, the last one if several are as strong
+            strength, end = max(((strength, offset) for offset, strength in cuts if low <= offset <= high),
+                                default=(LINE - 1, high))
+            chunk = Chunk(text=self.encoding.decode(tokens[start - base:end - base].tolist()), start=start, end=end,
+                          boundary=start_boundary, overlap=overlap)
+
+            following = end if strength == HEADING else end - self.chunk_overlap
+            overlap = len(self.encoding.decode(tokens[following - base:end - base].tolist()))
+            start, start_boundary, previous_end = following, strength, end
+            cuts = [(offset, strength) for offset, strength in cuts if offset > start]
+            del tokens[:start - base]
+            base = start
+            return chunk
+
+        for number, text in enumerate(texts):
+            for piece, strength in pieces(text if number == 0 else separator + text, boundary):
+                offset = base + len(tokens)
+                if offset > start:
+                    cuts.append((offset, strength))
+                tokens.extend(self.encode(piece))
+
+                # Emit every full window, keeping the overlap for the next one
+                while base + len(tokens) - start >= self.chunk_size:
+                    yield cut()
+
+        # Emit the rest, unless it is all in the previous chunk
+        end = base + len(tokens)
+        if end > previous_end:
+            yield Chunk(text=self.encoding.decode(tokens[start - base:].tolist()), start=start, end=end,
+                        boundary=start_boundary, overlap=overlap)
+
+
+def join_chunks(documents: list["Document"], chunk_size: int = SUMMARY_CHUNK_SIZE) -> list["Document"]:
+    """
+    Join consecutive chunks of a file into larger chunks, from their token offsets, without tokenizing again
+    :param documents: Chunks of one file in order, with the token metadata of the loader
+    :param chunk_size: Maximum number of tokens per joined chunk
+    :return: Joined chunks, cut at the strongest boundary between chunks in the second half of their window.
+    The documents as they are if any has no token metadata
+
+    The overlap of a chunk with the previous chunk is only kept once, so joined chunks read like the file.
+    Chunks that do not follow the previous one, after a dropped or merged duplicate, are joined whole.
+    """
+    from langchain.schema import Document
+
+    if len(documents) < 2 or any("tokens" not in doc.metadata for doc in documents):
+        return documents
+
+    # The text and tokens of every chunk that are not in the previous chunk
+    parts: list[tuple[str, int, int]] = []  # (text, tokens, strength of the boundary before it)
+    previous = None
+    for doc in documents:
+        meta = doc.metadata
+        if (previous is not None and "duplicate_of" not in meta and "duplicate_of" not in previous
+                and meta["offset"] < previous["offset"] + previous["tokens"]):
+            new_tokens = meta["offset"] + meta["tokens"] - previous["offset"] - previous["tokens"]
+            parts.append((doc.page_content[meta["overlap"]:], new_tokens, meta["boundary"]))
+        else:
+            parts.append((doc.page_content, meta["tokens"], meta.get("boundary", PARAGRAPH)))
+        previous = meta
+
+    joined = []
+    first = 0
+    while first < len(parts):
+        # Find the parts that fit the window, and the strongest boundary in its second half
+        total, last, best = 0, first, None
+        while last < len(parts) and (last == first or total + parts[last][1] <= chunk_size):
+            if last > first and total >= chunk_size * MIN_CHUNK_FILL and (best is None or
+                                                                          parts[last][2] >= parts[best][2]):
+                best = last
+            total += parts[last][1]
+            last += 1
+        if last < len(parts) and best is not None:
+            last = best
+
+        group = parts[first:last]
+        meta = documents[first].metadata
+        joined.append(Document(page_content="".join(text for text, _, _ in group), metadata={
+            "source": meta.get("source", ""),
+            "offset": meta["offset"],
+            "tokens": sum(tokens for _, tokens, _ in group),
+            "chunks": [doc.metadata.get("chunk", index) for index, doc in enumerate(documents[first:last], first)],
+        }))
+        first = last
+    return joined
@@ -0,0 +1,305 @@
+"""rabbithole.cli module"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Any
+
+from rabbithole.dedup import clear_upload
+from rabbithole.incremental import FileRecord, path_digest
+from rabbithole.jobs import JOBS_DB, JOBS_WORKERS, set_environment, worker_environment
+from rabbithole.loader import SUPPORTED_IMG_FILE_TYPES
+from rabbithole.mp3 import SUPPORTED_AV_FILE_TYPES
+
+# Suffixes of the supported files, with their dot
+SUPPORTED_FILE_TYPES = tuple(
+    "." + suffix.lstrip(".") for suffix in (".docx", ".pdf", ".txt", *SUPPORTED_IMG_FILE_TYPES, *SUPPORTED_AV_FILE_TYPES)
+)
+
+# Number of files processed at once, each in its own process
+CLI_PROCESSES = max(JOBS_WORKERS, 1)
+
+# Number of stages running at once in each process
+CLI_THREADS = 8
+
+
+def is_supported(path: str | Path) -> bool:
+    """Whether a file has a supported suffix, in any case"""
+    return Path(path).suffix.lower() in SUPPORTED_FILE_TYPES
+
+
+def collect_files(inputs: list[str], manifest: str | None = None) -> list[tuple[str, str]]:
+    """
+    List the files to process
+    :param inputs: Files and directories. Directories are searched recursively for supported files
+    :param manifest: Text file listing one file per line, relative to the manifest. Blank lines and lines
+    starting with # are skipped
+    :return: (path, name) of every file, in order. Files found in a directory or listed in the manifest are named
+    by their path relative to it, so files with the same name in different folders stay apart. Other files are
+    named by their base name
+    """
+    entries: list[tuple[str, str]] = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for path in sorted(Path(item).rglob("*")):
+                if path.is_file() and is_supported(path):
+                    entries.append((str(path), path.relative_to(item).as_posix()))
+        else:
+            entries.append((item, os.path.basename(item)))
+
+    if manifest is not None:
+        root = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    entries.append((os.path.join(root, line), Path(os.path.normpath(line)).as_posix()))
+
+    # Keep the first of the files listed more than once
+    seen = set()
+    unique = []
+    for path, name in entries:
+        if os.path.abspath(path) not in seen:
+            seen.add(os.path.abspath(path))
+            unique.append((path, name))
+    return unique
+
+
+def read_done(output: str) -> set[str]:
+    """
+    Find the files an earlier run already processed
+    :param output: JSON lines output of the earlier runs
+    :return: Record keys of the files processed without errors
+    """
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by an interrupted run
+                continue
+            if not result.get("errors") and result.get("key"):
+                done.add(result["key"])
+    return done
+
+
+def process_file(path: str, name: str, digest: str, settings: dict, threads: int = CLI_THREADS,
+                 keep: bool = False, upload: str | None = None) -> dict[str, Any]:
+    """
+    Run every stage of one file. Runs in the worker processes
+    :param path: File path
+    :param name: File name in the results
+    :param digest: Content hash of the file
+    :param settings: Processing settings, e.g. {"summary_mode": "refine"}
+    :param threads: Number of stages running at once
+    :param keep: Also return the chunks and their embeddings
+    :param upload: Id of the run. Repeated chunks are merged across the files of a run, through the job
+    queue database
+    :return: {"file", "path", "key", "digest", "settings", "bytes", "chunks", "keywords", "summary", "dedup",
+    "errors", "timings", "elapsed"}, and "documents" and "embeddings" if keep
+    """
+    from rabbithole.dedup import DEDUP, SharedDeduplicator
+    from rabbithole.jobs import NamedBytesIO
+    from rabbithole.pipeline import Pipeline
+    from rabbithole.summarize import SUMMARY_MODE, summarize_document
+
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        data = f.read()
+
+    deduplicator = SharedDeduplicator(JOBS_DB, upload) if DEDUP and upload is not None else None
+    summary_mode = settings.get("summary_mode", SUMMARY_MODE)
+    pipeline = Pipeline(max_workers=threads, deduplicator=deduplicator,
+                        summarize=lambda documents: summarize_document(documents, mode=summary_mode))
+    results, details, errors, timings = {}, {}, {}, {}
+    try:
+        for event in pipeline.run([NamedBytesIO(data, name)]):
+            timings[event.stage] = round(event.elapsed, 3)
+            if event.ok:
+                results[event.stage] = event.result
+                details.update(event.details or {})
+            else:
+                errors[event.stage] = str(event.error)
+    finally:
+        if deduplicator is not None:
+            deduplicator.close()
+
+    result = {
+        "file": name,
+        "path": path,
+        "key": FileRecord(name=name, digest=digest, settings=settings).key(),
+        "digest": digest,
+        "settings": settings,
+        "bytes": len(data),
+        "chunks": len(results.get("load", [])),
+        "keywords": results.get("keywords"),
+        "summary": results.get("summarize"),
+        "dedup": details.get("dedup"),
+        "errors": errors,
+        "timings": timings,
+        "elapsed": round(time.perf_counter() - start, 3),
+    }
+    if keep:
+        result["documents"] = results.get("load")
+        result["embeddings"] = results.get("embed")
+    return result
+
+
+def run(entries: list[tuple[str, str]], output: str, settings: dict, processes: int = CLI_PROCESSES,
+        threads: int = CLI_THREADS, force: bool = False, bundle: str | None = None) -> dict[str, int]:
+    """
+    Process files on a pool of processes and append their results to a JSON lines file
+    :param entries: (path, name) of the files to process
+    :param output: JSON lines output. One line is appended per file as soon as it is processed, so an interrupted
+    run resumes where it stopped
+    :param settings: Processing settings, e.g. {"summary_mode": "refine"}
+    :param processes: Number of files processed at once, each in its own process
+    :param threads: Number of stages running at once in each process
+    :param force: Process the files an earlier run already processed
+    :param bundle: Also save the files processed by this run as a session bundle at this path
+    :return: Number of files processed, skipped and failed
+    """
+    done = set() if force else read_done(output)
+    todo = []
+    skipped = 0
+    for path, name in entries:
+        digest = path_digest(path)
+        if FileRecord(name=name, digest=digest, settings=settings).key() in done:
+            skipped += 1
+            print(f"Skipping {name}: already processed")
+        else:
+            todo.append((path, name, digest))
+
+    total_bytes = sum(os.path.getsize(path) for path, _, _ in todo)
+    print(f"Processing {len(todo)} files ({total_bytes / 1024 ** 2:.1f} MB) on {processes} processes "
+          f"x {threads} threads. Skipped {skipped}.")
+
+    graph = None
+    if bundle is not None:
+        from rabbithole.incremental import SessionGraph
+        from rabbithole.pipeline import STAGES
+
+        graph = SessionGraph(STAGES)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    start = time.perf_counter()
+    processed = failed = chunks = 0
+    upload = uuid.uuid4().hex
+    # Spawned rather than forked, since the pipeline runs threads
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=set_environment, initargs=(worker_environment(processes),)) as executor, \
+            open(output, "a", encoding="utf-8") as out:
+        pending: dict[Future, tuple[str, str, str]] = {
+            executor.submit(process_file, path, name, digest, settings, threads, bundle is not None, upload): (
+                path, name, digest)
+            for path, name, digest in todo
+        }
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path, name, digest = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # The worker process died, e.g. out of memory
+                    result = {"file": name, "path": path, "digest": digest, "settings": settings,
+                              "errors": {"process": str(e)}, "timings": {}, "elapsed": None}
+
+                documents, embeddings = result.pop("documents", None), result.pop("embeddings", None)
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+
+                processed += 1
+                failed += bool(result["errors"])
+                chunks += result.get("chunks", 0)
+                timings = ", ".join(f"{stage} {elapsed:.1f}s" for stage, elapsed in result["timings"].items())
+                status = "failed: " + "; ".join(f"{stage}: {error}" for stage, error in result["errors"].items()) \
+                    if result["errors"] else f"{result['chunks']} chunks"
+                print(f"[{processed}/{len(todo)}] {name}: {status} ({timings}"
+                      f"{', total ' + format(result['elapsed'], '.1f') + 's' if result['elapsed'] else ''})")
+
+                if graph is not None:
+                    record = FileRecord(name=name, digest=digest, settings=settings,
+                                        errors=dict(result["errors"]))
+                    stages = {"load": documents, "embed": embeddings, "keywords": result.get("keywords"),
+                              "summarize": result.get("summary"), "dedup": result.get("dedup")}
+                    record.results = {stage: value for stage, value in stages.items() if value is not None}
+                    graph.records[name] = record
+
+    elapsed = time.perf_counter() - start
+    if todo:
+        # The chunks the processes shared to merge repeats
+        clear_upload(JOBS_DB, upload)
+        print(f"Processed {processed} files in {elapsed:.1f}s: {processed / elapsed * 60:.1f} files/min, "
+              f"{total_bytes / 1024 ** 2 / elapsed:.2f} MB/s, {chunks / elapsed:.1f} chunks/s. {failed} failed.")
+    print(f"Results appended to {output}")
+
+    if graph is not None and not todo:
+        print(f"No bundle written to {bundle}: no file was processed. Use --force to process the files again.")
+    elif graph is not None:
+        from rabbithole.bundle import save_bundle
+
+        # Keep the input order
+        graph.records = {name: graph.records[name] for _, name, _ in todo if name in graph.records}
+        save_bundle(graph, bundle)
+        note = " Skipped files are not in it, use --force to include them." if skipped else ""
+        print(f"Bundle of {len(graph.records)} files written to {bundle}.{note}")
+
+    return {"processed": processed, "skipped": skipped, "failed": failed}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="rabbithole",
+        description="Process course material without the app: load, embed, extract keywords and summarize "
+                    "every file, and write the results as JSON lines",
+    )
+    parser.add_argument("inputs", nargs="*", help="Files and directories to process. Directories are searched "
+                                                  "recursively")
+    parser.add_argument("-m", "--manifest", default=None, help="Text file listing the files to process, one per line")
+    parser.add_argument("-o", "--output", default="rabbithole-results.jsonl",
+                        help="JSON lines output. Files already in it are skipped")
+    parser.add_argument("-p", "--processes", type=int, default=CLI_PROCESSES,
+                        help="Number of files processed at once, each in its own process")
+    parser.add_argument("-t", "--threads", type=int, default=CLI_THREADS,
+                        help="Number of stages running at once in each process")
+    parser.add_argument("--summary-mode", choices=["refine", "map_reduce"], default=None,
+                        help="Summarization mode. Defaults to RABBITHOLE_SUMMARY_MODE")
+    parser.add_argument("--force", action="store_true", help="Process the files already in the output again")
+    parser.add_argument("--bundle", default=None,
+                        help="Also save the processed files as a session bundle that the app can open")
+    # Inputs may come before and after the options
+    args = parser.parse_intermixed_args()
+
+    entries = collect_files(args.inputs, args.manifest)
+    if not entries:
+        parser.error("no files to process")
+    unsupported = [path for path, _ in entries if not is_supported(path)]
+    if unsupported:
+        parser.error(f"unsupported file types: {', '.join(unsupported)}")
+    names = [name for _, name in entries]
+    clashing = sorted({name for name in names if names.count(name) > 1})
+    if clashing:
+        parser.error(f"several files named {', '.join(clashing)}: pass their folder or list them in a manifest")
+    missing = [path for path, _ in entries if not os.path.isfile(path)]
+    if missing:
+        parser.error(f"files not found: {', '.join(missing)}")
+
+    from rabbithole.summarize import SUMMARY_MODE
+
+    counts = run(entries, args.output, settings={"summary_mode": args.summary_mode or SUMMARY_MODE},
+                 processes=args.processes, threads=args.threads, force=args.force, bundle=args.bundle)
+    sys.exit(1 if counts["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
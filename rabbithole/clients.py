@@ -0,0 +1,46 @@
+"""rabbithole.clients module"""
+
+import os
+import threading
+
+# Maximum number of pooled keep-alive connections per host of the shared HTTP session
+HTTP_POOL_SIZE = int(os.getenv("RABBITHOLE_HTTP_POOL_SIZE", "16"))
+
+_session = None
+_openai = None
+_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Get the HTTP session shared by the provider clients, creating it on first use
+    :return: requests.Session keeping up to HTTP_POOL_SIZE connections alive per host
+
+    Every call of every thread reuses the pooled connections, instead of each worker thread opening its own
+    session and paying a new TLS handshake.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def get_openai():
+    """
+    Get the openai module, importing and configuring it on first use
+    :return: The openai module, sending its requests through the shared HTTP session
+    """
+    global _openai
+    if _openai is None:
+        import openai
+
+        openai.requestssession = get_http_session()
+        _openai = openai
+    return _openai
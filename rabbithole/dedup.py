@@ -0,0 +1,357 @@
+"""rabbithole.dedup module"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import defaultdict
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from rabbithole.chunking import TokenChunker
+from rabbithole.metrics import count
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+# Drop near-duplicate chunks between loading and embedding
+DEDUP = os.getenv("RABBITHOLE_DEDUP", "1") == "1"
+
+# Minimum estimated Jaccard similarity of the shingles of two chunks for one to be dropped.
+# 0.8 still matches the same text cut at chunk boundaries about 50 words apart
+DEDUP_THRESHOLD = float(os.getenv("RABBITHOLE_DEDUP_THRESHOLD", "0.8"))
+
+# Number of consecutive words per shingle
+SHINGLE_SIZE = 5
+
+# MinHash permutations, split into LSH bands of NUM_PERM // LSH_BANDS rows.
+# Chunks sharing a band are compared, which finds more than 99% of the pairs above 0.8 similarity
+NUM_PERM = 128
+LSH_BANDS = 32
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_WORD = re.compile(r"\w+")
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> np.ndarray:
+    """
+    Hash the word shingles of a text
+    :param text: Text to shingle. Case and punctuation are ignored
+    :param size: Number of consecutive words per shingle
+    :return: Unique 32-bit hashes of the shingles. Texts shorter than size words have one shingle
+    """
+    words = _WORD.findall(text.lower())
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    grams = (" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1)))
+    return np.unique(np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint64))
+
+
+class MinHasher:
+    """MinHash signatures with a fixed family of hash permutations"""
+
+    def __init__(self, num_perm: int = NUM_PERM, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+        self.b = rng.randint(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+
+    def signature(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Compute the MinHash signature of a set
+        :param hashes: (n,) 32-bit hashes of the set elements
+        :return: (num_perm,) signature. Two signatures agree at a position with probability the Jaccard
+        similarity of their sets
+        """
+        if not len(hashes):
+            return np.full(len(self.a), _MAX_HASH, dtype=np.uint64)
+        # Multiplication wraps around modulo 2^64, like datasketch's implementation
+        with np.errstate(over="ignore"):
+            permuted = ((hashes[:, None] * self.a + self.b) % _MERSENNE_PRIME) & _MAX_HASH
+        return permuted.min(axis=0)
+
+
+class Deduplicator:
+    """
+    Find chunks that nearly repeat an earlier chunk, within a file and across the files of an upload
+
+    Chunks are compared by the MinHash of their word shingles, and candidates are found with LSH banding,
+    so each chunk is compared with a few similar chunks instead of all of them.
+    - A chunk repeating a chunk of the same file is dropped: it adds nothing to the file's keywords and summary.
+    - A chunk repeating a chunk of another file is merged into it: it is replaced by the text of that chunk, so
+      every file keeps all its content, but the embedding service and the keyword query cache compute the
+      shared text once.
+    Repeats are recorded in the "duplicates" metadata of the chunk they repeat, merged chunks point at it in
+    their "duplicate_of" metadata, and every chunk keeps its position in its file in the "chunk" metadata.
+    Thread-safe, so the files of a pipeline run can share one deduplicator. Files processed in different
+    processes share a SharedDeduplicator instead.
+    """
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, num_perm: int = NUM_PERM, bands: int = LSH_BANDS):
+        """
+        :param threshold: Minimum estimated Jaccard similarity of a chunk to the chunk it repeats
+        :param num_perm: Number of MinHash permutations
+        :param bands: Number of LSH bands. Must divide num_perm
+        """
+        if num_perm % bands:
+            raise ValueError(f"bands ({bands}) must divide num_perm ({num_perm})")
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm)
+        self.rows = num_perm // bands
+        self.chunker = TokenChunker()
+
+        self._buckets: list[dict[bytes, list[int]]] = [defaultdict(list) for _ in range(bands)]
+        self._signatures: list[np.ndarray] = []
+        self._kept: list["Document"] = []
+        self._used: dict[str, set[int]] = defaultdict(set)  # Kept chunks each source kept or merged into
+        self._stats: dict[str, dict[str, int]] = defaultdict(
+            lambda: {"chunks": 0, "dropped": 0, "merged": 0, "dropped_tokens": 0, "merged_tokens": 0}
+        )
+        self._lock = threading.Lock()
+
+    def _match(self, source: str, document: "Document", signature: np.ndarray,
+               bands: list[bytes]) -> tuple["Document", float, bool] | None:
+        """
+        Find the kept chunk a chunk repeats, or keep the chunk. Called with the lock held
+        :param source: File name of the chunk
+        :param document: Chunk
+        :param signature: MinHash signature of the chunk
+        :param bands: LSH bands of the signature
+        :return: (kept chunk, similarity, whether the file already kept or merged into it), or None if the chunk
+        is kept
+        """
+        # Compare with the chunks sharing at least one band, and keep the most similar
+        candidates = {kept for band, buckets in zip(bands, self._buckets) for kept in buckets.get(band, ())}
+        best, similarity = None, 0.0
+        for kept in candidates:
+            estimate = float(np.mean(self._signatures[kept] == signature))
+            if estimate > similarity:
+                best, similarity = kept, estimate
+
+        if best is None or similarity < self.threshold:
+            index = len(self._kept)
+            self._kept.append(document)
+            self._signatures.append(signature)
+            self._used[source].add(index)
+            for band, buckets in zip(bands, self._buckets):
+                buckets[band].append(index)
+            return None
+
+        used = best in self._used[source]
+        self._used[source].add(best)
+        return self._kept[best], similarity, used
+
+    def add(self, document: "Document") -> "Document | None":
+        """
+        Register a chunk
+        :param document: Chunk, with its file name in the "source" metadata
+        :return: The chunk, the chunk it repeats if that belongs to another file, or None if it repeats a chunk
+        of its own file
+        """
+        from langchain.schema import Document
+
+        source = document.metadata.get("source", "")
+        signature = self.hasher.signature(shingles(document.page_content))
+        bands = [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(len(self._buckets))]
+
+        with self._lock:
+            stats = self._stats[source]
+            document.metadata["chunk"] = stats["chunks"]
+            stats["chunks"] += 1
+
+            match = self._match(source, document, signature, bands)
+            if match is None:
+                return document
+            original, similarity, used = match
+            repeat = {"source": source, "chunk": document.metadata["chunk"], "similarity": round(similarity, 3)}
+            original.metadata.setdefault("duplicates", []).append(repeat)
+            outcome = "dropped" if used else "merged"
+
+        tokens = document.metadata.get("tokens") or len(self.chunker.encode(document.page_content))
+        with self._lock:
+            stats[outcome] += 1
+            stats[f"{outcome}_tokens"] += tokens
+        count(f"chunks_{outcome}", 1, stage="dedup")
+        count("tokens_saved", tokens, stage="dedup")
+        if outcome == "dropped":
+            return None
+        return Document(page_content=original.page_content, metadata={
+            **document.metadata,
+            **({"tokens": original.metadata["tokens"]} if "tokens" in original.metadata else {}),
+            "duplicate_of": {"source": original.metadata.get("source", ""), "chunk": original.metadata["chunk"],
+                             "similarity": round(similarity, 3)},
+        })
+
+    def report(self, source: str | None = None) -> dict[str, int]:
+        """
+        Get what the repeated chunks saved
+        :param source: Only the chunks of this file. Defaults to every file
+        :return: Chunks seen, kept, dropped and merged, tokens that were not embedded again, and the remote calls
+        saved: one Cohere embedding and one Pinecone keyword query per dropped or merged chunk. The summarization
+        calls saved depend on how the chunks are joined, see Pipeline
+        """
+        with self._lock:
+            stats = [self._stats[source]] if source is not None else list(self._stats.values())
+            totals = {key: sum(s[key] for s in stats) for key in ("chunks", "dropped", "merged", "dropped_tokens",
+                                                                  "merged_tokens")}
+        repeats = totals["dropped"] + totals["merged"]
+        return {
+            "chunks": totals["chunks"],
+            "kept": totals["chunks"] - repeats,
+            "dropped": totals["dropped"],
+            "merged": totals["merged"],
+            "tokens_saved": totals["dropped_tokens"] + totals["merged_tokens"],
+            "embeddings_saved": repeats,
+            "keyword_queries_saved": repeats,
+        }
+
+
+def _connect(path: str | Path) -> sqlite3.Connection:
+    """Open a database holding the chunks of SharedDeduplicators"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS dedup_chunks (id INTEGER PRIMARY KEY, upload TEXT NOT NULL, source TEXT NOT NULL, "
+        "chunk INTEGER NOT NULL, signature BLOB NOT NULL, text TEXT NOT NULL, tokens INTEGER, created REAL NOT NULL)"
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS dedup_chunks_upload ON dedup_chunks (upload, source)")
+    db.execute("CREATE TABLE IF NOT EXISTS dedup_bands (upload TEXT NOT NULL, band BLOB NOT NULL, "
+               "chunk_id INTEGER NOT NULL)")
+    db.execute("CREATE INDEX IF NOT EXISTS dedup_bands_band ON dedup_bands (upload, band)")
+    db.execute("CREATE TABLE IF NOT EXISTS dedup_used (upload TEXT NOT NULL, source TEXT NOT NULL, "
+               "chunk_id INTEGER NOT NULL, PRIMARY KEY (upload, source, chunk_id))")
+    return db
+
+
+class SharedDeduplicator(Deduplicator):
+    """
+    Deduplicator sharing its chunks through a SQLite database, so the files of an upload processed in different
+    processes, like the jobs of rabbithole.jobs, are compared with each other
+
+    The signatures, LSH bands and texts of the kept chunks are stored by upload. Each chunk is compared and
+    registered in one immediate transaction, so two processes never both keep the same text.
+    Repeats of chunks of another process are only recorded in the "duplicate_of" metadata of the repeat.
+    """
+
+    def __init__(self, path: str | Path, upload: str, threshold: float = DEDUP_THRESHOLD, num_perm: int = NUM_PERM,
+                 bands: int = LSH_BANDS):
+        """
+        :param path: Path of the database, e.g. the job queue database
+        :param upload: Upload id. Chunks are only compared with the chunks of the same upload
+        :param threshold: Minimum estimated Jaccard similarity of a chunk to the chunk it repeats
+        :param num_perm: Number of MinHash permutations
+        :param bands: Number of LSH bands. Must divide num_perm
+        """
+        super().__init__(threshold, num_perm, bands)
+        self.path = Path(path)
+        self.upload = upload
+        self._db = _connect(self.path)
+        self._own: dict[int, "Document"] = {}  # Chunks kept by this process, by id
+
+    def forget(self, source: str):
+        """
+        Remove the chunks of a file from the upload, e.g. before processing it again after a failed attempt
+        :param source: File name
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("DELETE FROM dedup_bands WHERE upload = ? AND chunk_id IN "
+                                 "(SELECT id FROM dedup_chunks WHERE upload = ? AND source = ?)",
+                                 (self.upload, self.upload, source))
+                self._db.execute("DELETE FROM dedup_chunks WHERE upload = ? AND source = ?", (self.upload, source))
+                self._db.execute("DELETE FROM dedup_used WHERE upload = ? AND source = ?", (self.upload, source))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _match(self, source: str, document: "Document", signature: np.ndarray,
+               bands: list[bytes]) -> tuple["Document", float, bool] | None:
+        from langchain.schema import Document
+
+        # Bands are keyed by their position, so equal rows of different bands do not match
+        keys = [bytes([i]) + band for i, band in enumerate(bands)]
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self._db.execute(
+                "SELECT id, source, chunk, signature, text, tokens FROM dedup_chunks WHERE id IN "
+                f"(SELECT chunk_id FROM dedup_bands WHERE upload = ? AND band IN ({', '.join('?' * len(keys))}))",
+                (self.upload, *keys),
+            ).fetchall()
+            best, similarity = None, 0.0
+            for row in rows:
+                estimate = float(np.mean(np.frombuffer(row[3], dtype=np.uint64) == signature))
+                if estimate > similarity:
+                    best, similarity = row, estimate
+
+            if best is None or similarity < self.threshold:
+                chunk_id = self._db.execute(
+                    "INSERT INTO dedup_chunks (upload, source, chunk, signature, text, tokens, created) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (self.upload, source, document.metadata["chunk"], signature.tobytes(), document.page_content,
+                     document.metadata.get("tokens"), time.time()),
+                ).lastrowid
+                self._db.executemany("INSERT INTO dedup_bands (upload, band, chunk_id) VALUES (?, ?, ?)",
+                                     [(self.upload, key, chunk_id) for key in keys])
+                self._db.execute("INSERT INTO dedup_used (upload, source, chunk_id) VALUES (?, ?, ?)",
+                                 (self.upload, source, chunk_id))
+                self._own[chunk_id] = document
+                match = None
+            else:
+                chunk_id, original_source, chunk, _, text, tokens = best
+                used = self._db.execute(
+                    "INSERT OR IGNORE INTO dedup_used (upload, source, chunk_id) VALUES (?, ?, ?)",
+                    (self.upload, source, chunk_id),
+                ).rowcount == 0
+                original = self._own.get(chunk_id) or Document(page_content=text, metadata={
+                    "source": original_source, "chunk": chunk, **({"tokens": tokens} if tokens is not None else {}),
+                })
+                match = original, similarity, used
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return match
+
+    def close(self):
+        """Close the database connection"""
+        self._db.close()
+
+
+def clear_upload(path: str | Path, upload: str | None = None, max_age: float | None = None) -> int:
+    """
+    Delete the chunks SharedDeduplicators stored for an upload, or for every upload older than max_age
+    :param path: Path of the database
+    :param upload: Upload id
+    :param max_age: Age in seconds of the newest chunk of the uploads to delete
+    :return: Number of deleted chunks
+    """
+    db = _connect(path)
+    try:
+        if upload is not None:
+            uploads = [upload]
+        else:
+            uploads = [row[0] for row in db.execute(
+                "SELECT upload FROM dedup_chunks GROUP BY upload HAVING MAX(created) < ?", (time.time() - max_age,)
+            )]
+        deleted = 0
+        for upload in uploads:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                deleted += db.execute("DELETE FROM dedup_chunks WHERE upload = ?", (upload,)).rowcount
+                db.execute("DELETE FROM dedup_bands WHERE upload = ?", (upload,))
+                db.execute("DELETE FROM dedup_used WHERE upload = ?", (upload,))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return deleted
+    finally:
+        db.close()
@@ -1,17 +1,151 @@
 """rabbithole.embedding module"""
 
-import streamlit as st
-from langchain.embeddings import CohereEmbeddings
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
-cohere = CohereEmbeddings()
-cohere.model = "multilingual-22-12"
+import numpy as np
 
+from rabbithole.cache import Cache, content_hash, get_cache
+from rabbithole.metrics import count, in_context, span
+from rabbithole.ratelimit import limit
 
-@st.cache_data
-def embed_document(texts: list[str]) -> list[list[float]]:
+EMBEDDING_MODEL = "multilingual-22-12"
+
+# Maximum number of texts per Cohere embed request
+EMBED_BATCH_SIZE = int(os.getenv("RABBITHOLE_EMBED_BATCH_SIZE", "96"))
+
+# Number of embed requests in flight per service
+EMBED_WORKERS = int(os.getenv("RABBITHOLE_EMBED_WORKERS", "4"))
+
+
+class EmbeddingService:
+    """
+    Batched, deduplicating embedding client
+
+    - Identical texts are embedded once, within a request and across requests (through the persistent cache)
+    - Requests from concurrent sessions for a text already being embedded wait for that result
+      instead of sending it again
+    - Texts missing from the cache are sent in batches of at most max_batch_size, max_workers batches at a time
+    """
+
+    def __init__(self, client=None, model: str = EMBEDDING_MODEL, max_batch_size: int = EMBED_BATCH_SIZE,
+                 max_workers: int = EMBED_WORKERS, cache: Cache | None = None):
+        """
+        :param client: Client with an embed_documents(texts) -> list[list[float]] method.
+        Defaults to langchain's CohereEmbeddings
+        :param model: Embedding model name. Part of the cache keys
+        :param max_batch_size: Maximum number of texts per request
+        :param max_workers: Number of requests in flight at once
+        :param cache: Persistent cache. Defaults to the process-wide cache
+        """
+        if client is None:
+            from langchain.embeddings import CohereEmbeddings
+
+            client = CohereEmbeddings()
+            client.model = model
+        self.client = client
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.cache = cache or get_cache()
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="embedding")
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """
+        Embed texts
+        :param texts: Texts to embed
+        :return: (len(texts), dim) float32 array of embeddings
+        """
+        keys = [content_hash(self.model, text) for text in texts]
+        texts_by_key = dict(zip(keys, texts))
+
+        # Claim the keys nobody is embedding yet, and share the futures of the others
+        futures: dict[str, Future] = {}
+        claimed: dict[str, Future] = {}
+        with self._lock:
+            for key in texts_by_key:
+                if key not in self._inflight:
+                    self._inflight[key] = claimed[key] = Future()
+                futures[key] = self._inflight[key]
+
+        try:
+            cached = self.cache.get_many("embedding", list(claimed))
+            for key, value in cached.items():
+                self._resolve(key, claimed[key], np.frombuffer(value, dtype=np.float32))
+
+            missing = [key for key in claimed if key not in cached]
+            for start in range(0, len(missing), self.max_batch_size):
+                batch = {key: claimed[key] for key in missing[start: start + self.max_batch_size]}
+                self._executor.submit(in_context(self._embed_batch), batch, [texts_by_key[key] for key in batch])
+        except BaseException as e:
+            for key, future in claimed.items():
+                self._fail(key, future, e)
+            raise
+
+        embeddings = [futures[key].result() for key in keys]
+        if not embeddings:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack(embeddings)
+
+    def _embed_batch(self, futures: dict[str, Future], texts: list[str]):
+        """Embed one batch of texts and publish the results to the futures of their keys"""
+        try:
+            with span("cohere.embed", texts=len(texts)), limit("cohere"):
+                embeddings = np.asarray(self.client.embed_documents(texts=texts), dtype=np.float32)
+            count("chunks_embedded", len(texts))
+            self.cache.set_many("embedding", {key: emb.tobytes() for key, emb in zip(futures, embeddings)})
+        except BaseException as e:
+            for key, future in futures.items():
+                self._fail(key, future, e)
+            return
+
+        for (key, future), emb in zip(futures.items(), embeddings):
+            self._resolve(key, future, emb)
+
+    def _settle(self, key: str, future: Future) -> bool:
+        """
+        Stop sharing a future of this service. Runs under the lock
+        :return: Whether the future is still pending. A request that failed may have settled it already
+        """
+        # The key may be claimed again by a later request once this future is settled
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        return not future.done()
+
+    def _resolve(self, key: str, future: Future, embedding: np.ndarray):
+        with self._lock:
+            if self._settle(key, future):
+                future.set_result(embedding)
+
+    def _fail(self, key: str, future: Future, error: BaseException):
+        with self._lock:
+            if self._settle(key, future):
+                future.set_exception(error)
+
+
+_service: EmbeddingService | None = None
+_service_lock = threading.Lock()
+
+
+def get_embedding_service() -> EmbeddingService:
+    """
+    Get the process-wide embedding service, shared by every session
+    :return: Embedding service
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = EmbeddingService()
+        return _service
+
+
+def embed_document(texts: list[str]) -> np.ndarray:
     """
     Embed a document using the cohere multilingual-22-12 model
     :param texts: Document texts to embed
-    :return: List of embeddings
+    :return: (len(texts), dim) float32 array of embeddings
     """
-    return cohere.embed_documents(texts=texts)
+    return get_embedding_service().embed(texts)
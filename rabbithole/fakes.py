@@ -0,0 +1,285 @@
+"""rabbithole.fakes module"""
+
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import BinaryIO, Callable
+
+import numpy as np
+from langchain.llms.base import LLM
+from pydantic import PrivateAttr
+
+from rabbithole.chunking import count_tokens
+
+
+class FakeProvider:
+    """
+    Deterministic local stand-in for a remote provider, for offline tests and benchmarks
+
+    Calls have a configurable latency and error rate, and are counted.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        """
+        :param latency: Seconds every call sleeps
+        :param error_rate: Probability of a call raising RuntimeError
+        :param seed: Random seed of the injected errors
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _call(self):
+        """Count the call, sleep and maybe fail"""
+        with self._lock:
+            self.calls += 1
+            fail = self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise RuntimeError(f"{type(self).__name__}: injected failure")
+
+
+class FakeTranscriber(FakeProvider):
+    """Transcriber returning a deterministic transcript of each audio file"""
+
+    def __call__(self, audio_file: BinaryIO) -> str:
+        self._call()
+        name = os.path.basename(getattr(audio_file, "name", "audio"))
+        data = audio_file.read()
+        return f"Transcript of {name} ({len(data)} bytes)."
+
+
+class FakeEmbeddings(FakeProvider):
+    """
+    Embedding client returning deterministic unit vectors derived from a hash of each text
+
+    Identical texts get identical embeddings. Has the embed_documents interface of langchain's CohereEmbeddings.
+    """
+
+    def __init__(self, dim: int = 768, **kwargs):
+        super().__init__(**kwargs)
+        self.dim = dim
+        self.texts = 0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        self._call()
+        with self._lock:
+            self.texts += len(texts)
+        return [self.embed(text).tolist() for text in texts]
+
+    def embed(self, text: str) -> np.ndarray:
+        """Deterministic unit vector of a text"""
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+
+class FakeVectorStore(FakeProvider):
+    """Vector store with the upsert and query interface of a Pinecone index, keeping vectors in memory"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.vectors: dict[str, dict[str, tuple]] = {}
+        self._matrices: dict[str, tuple[list[str], np.ndarray]] = {}
+
+    def upsert(self, vectors: list[tuple], namespace: str = ""):
+        self._call()
+        with self._lock:
+            store = self.vectors.setdefault(namespace, {})
+            for vec_id, values, metadata in vectors:
+                store[vec_id] = (values, metadata)
+            self._matrices.pop(namespace, None)
+        return {"upserted_count": len(vectors)}
+
+    def query(self, vector: list[float], top_k: int = 10, namespace: str = "", include_values: bool = False,
+              include_metadata: bool = False) -> dict:
+        """Exact dot-product search over the vectors of a namespace"""
+        self._call()
+        with self._lock:
+            store = self.vectors.get(namespace, {})
+            if namespace not in self._matrices:
+                ids = list(store)
+                matrix = np.asarray([store[vec_id][0] for vec_id in ids], dtype=np.float32).reshape(len(ids), -1)
+                self._matrices[namespace] = (ids, matrix)
+            ids, matrix = self._matrices[namespace]
+        if not ids:
+            return {"matches": []}
+
+        scores = matrix @ np.asarray(vector, dtype=np.float32)
+        best = np.argsort(-scores, kind="stable")[:top_k]
+        return {"matches": [
+            {"id": ids[i], "score": float(scores[i]), **({"metadata": store[ids[i]][1]} if include_metadata else {}),
+             **({"values": list(store[ids[i]][0])} if include_values else {})}
+            for i in best
+        ]}
+
+
+class FakeLLM(LLM):
+    """
+    langchain LLM returning a short deterministic completion: the first words of the prompt
+
+    Works with langchain chains. Calls have a configurable latency and error rate, and are counted.
+    """
+
+    latency: float = 0.0
+    error_rate: float = 0.0
+    seed: int = 0
+    words: int = 40
+    calls: int = 0
+    prompt_chars: int = 0
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _random: random.Random | None = PrivateAttr(default=None)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _call(self, prompt: str, stop=None, run_manager=None) -> str:
+        with self._lock:
+            if self._random is None:
+                self._random = random.Random(self.seed)
+            self.calls += 1
+            self.prompt_chars += len(prompt)
+            fail = self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise RuntimeError("FakeLLM: injected failure")
+        return " ".join(prompt.split()[:self.words])
+
+    def get_num_tokens(self, text: str) -> int:
+        # The default of langchain downloads the GPT-2 tokenizer of transformers
+        return count_tokens(text)
+
+
+class FakeChatServer:
+    """
+    Local HTTP server speaking the OpenAI chat completions API, streamed or not
+
+    Replies are sent word by word as server-sent events, after a configurable time to first token and
+    with a configurable delay between tokens. A configurable share of requests fails with HTTP 500. Point the OpenAI client at it with api_base=server.url.
+
+        with FakeChatServer(reply='{"plan": []}') as server:
+            generate_plan(summaries, keywords, api_base=server.url, api_key="fake")
+    """
+
+    def __init__(self, reply: str | Callable[[list[dict]], str] | None = None, ttft: float = 0.0,
+                 token_latency: float = 0.0, error_rate: float = 0.0, seed: int = 0, host: str = "127.0.0.1",
+                 port: int = 0):
+        """
+        :param reply: Reply text, or a function of the request messages returning it.
+        Defaults to echoing the last message
+        :param ttft: Seconds before the first token
+        :param token_latency: Seconds between tokens
+        :param error_rate: Probability of a request failing
+        :param seed: Random seed of the injected errors
+        :param host: Host to listen on
+        :param port: Port to listen on. Defaults to a free port
+        """
+        self.reply = reply
+        self.ttft = ttft
+        self.token_latency = token_latency
+        self.error_rate = error_rate
+        self.requests: list[dict] = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        """Base URL of the API"""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _reply(self, messages: list[dict]) -> str:
+        if callable(self.reply):
+            return self.reply(messages)
+        if self.reply is not None:
+            return self.reply
+        return messages[-1]["content"] if messages else ""
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                with server._lock:
+                    server.requests.append(body)
+                    fail = server._random.random() < server.error_rate
+                time.sleep(server.ttft)
+                if fail:
+                    payload = json.dumps({"error": {"message": "injected failure", "type": "server_error"}})
+                    self.send_response(500)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload.encode("utf-8"))
+                    return
+
+                text = server._reply(body.get("messages", []))
+                model = body.get("model", "fake")
+                base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": model}
+
+                if not body.get("stream"):
+                    payload = json.dumps({
+                        **base, "object": "chat.completion",
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": text}}],
+                    }).encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                deltas = [{"role": "assistant"}, *({"content": token} for token in re.findall(r"\s*\S+", text))]
+                for i, delta in enumerate(deltas):
+                    if i > 1 and server.token_latency:
+                        time.sleep(server.token_latency)
+                    self._event({**base, "object": "chat.completion.chunk",
+                                 "choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+                self._event({**base, "object": "chat.completion.chunk",
+                             "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+
+            def _event(self, data: dict):
+                self.wfile.write(f"data: {json.dumps(data)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+        return Handler
+
+    def start(self) -> "FakeChatServer":
+        """Serve requests on a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeChatServer":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,167 @@
+"""rabbithole.incremental module"""
+
+import hashlib
+import os
+from dataclasses import dataclass, field
+from typing import Any
+
+from rabbithole.cache import content_hash
+from rabbithole.loader import read_bytes
+
+
+def file_digest(file) -> str:
+    """
+    Hash the contents of an uploaded file
+    :param file: Uploaded file
+    :return: Hex SHA-256 digest of the file contents
+    """
+    return content_hash(read_bytes(file))
+
+
+def path_digest(path: str | os.PathLike, block_size: int = 1 << 20) -> str:
+    """
+    Hash the contents of a file on disk without reading it into memory at once
+    :param path: File path
+    :param block_size: Number of bytes read at a time
+    :return: Hex SHA-256 digest, equal to file_digest of the same contents
+    """
+    # content_hash length-prefixes its parts
+    digest = hashlib.sha256(os.path.getsize(path).to_bytes(8, "little"))
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@dataclass
+class FileRecord:
+    """Stage results of one uploaded file, keyed by what they were computed from"""
+    name: str
+    digest: str
+    settings: dict
+    results: dict[str, Any] = field(default_factory=dict)
+    errors: dict[str, str] = field(default_factory=dict)
+
+    def key(self) -> str:
+        """Key of the inputs of every stage: the file name, contents and processing settings"""
+        return content_hash(self.name, self.digest, *[f"{k}={v}" for k, v in sorted(self.settings.items())])
+
+    def complete(self, stages: tuple[str, ...]) -> bool:
+        """Whether every stage finished successfully"""
+        return all(stage in self.results for stage in stages) and not self.errors
+
+
+class SessionGraph:
+    """
+    Per-file dependency graph of a session
+
+    Every file's stages depend only on that file's name, contents and settings, and the study plan
+    depends on the results of all files. Updating the upload list keeps the records of unchanged files,
+    so only added, replaced or failed files are processed again, and the plan is regenerated only
+    when the set of files changed.
+    """
+
+    def __init__(self, stages: tuple[str, ...]):
+        """
+        :param stages: Stages every file must complete
+        """
+        self.stages = stages
+        self.records: dict[str, FileRecord] = {}
+        self.plan: Any = None
+        self.plan_key: str | None = None
+
+    def update(self, files: list, settings: dict) -> list:
+        """
+        Sync the graph with the current upload list
+        :param files: Uploaded files, in display order
+        :param settings: Processing settings, e.g. {"summary_mode": "refine"}
+        :return: Files whose stages must be (re)computed
+        """
+        records: dict[str, FileRecord] = {}
+        stale = []
+        for file in files:
+            record = FileRecord(name=file.name, digest=file_digest(file), settings=dict(settings))
+            previous = self.records.get(file.name)
+            if previous is not None and previous.key() == record.key() and previous.complete(self.stages):
+                records[file.name] = previous
+            else:
+                records[file.name] = record
+                stale.append(file)
+
+        removed = set(self.records) - set(records)
+        if stale or removed:
+            print(f"Reprocessing {len(stale)} of {len(files)} files. Removed {len(removed)}.")
+        self.records = records
+        return stale
+
+    def set_result(self, name: str, stage: str, result: Any):
+        """
+        Store the result of a stage
+        :param name: File name
+        :param stage: Stage name
+        :param result: Stage result
+        """
+        self.records[name].results[stage] = result
+
+    def set_error(self, name: str, stage: str, error: BaseException):
+        """
+        Store the error of a failed stage. The file is processed again on the next update
+        :param name: File name
+        :param stage: Stage name
+        :param error: Error raised by the stage
+        """
+        self.records[name].errors[stage] = str(error)
+
+    def results(self, stage: str) -> dict[str, Any]:
+        """
+        Get the results of a stage for every file that completed it
+        :param stage: Stage name
+        :return: Results by file name, in upload order
+        """
+        return {name: record.results[stage] for name, record in self.records.items() if stage in record.results}
+
+    def set_corpus_keywords(self, keywords: dict[str, list[str]]):
+        """
+        Store the keywords of every file ranked against all the files of the session, next to the keywords
+        ranked per file. Rankings of an earlier set of files are dropped
+        :param keywords: Keywords by file name. Empty when the files were not ranked together
+        """
+        for name, record in self.records.items():
+            if name in keywords:
+                record.results["corpus_keywords"] = keywords[name]
+            else:
+                record.results.pop("corpus_keywords", None)
+
+    def keywords(self) -> dict[str, list[str]]:
+        """
+        Get the keywords of every file: ranked against all the files of the session, or else ranked per file
+        :return: Keywords by file name, in upload order
+        """
+        keywords = self.results("keywords")
+        keywords.update(self.results("corpus_keywords"))
+        return keywords
+
+    def current_plan_key(self, settings: dict | None = None) -> str:
+        """
+        Key of the inputs of the study plan: the key of every file and the planning settings
+        :param settings: Planning settings, e.g. {"planner": "ordering"}
+        """
+        settings = settings or {}
+        return content_hash(*[record.key() for record in self.records.values()],
+                            *[f"{k}={v}" for k, v in sorted(settings.items())])
+
+    def plan_stale(self, settings: dict | None = None) -> bool:
+        """
+        Whether the study plan must be regenerated
+        :param settings: Planning settings
+        """
+        return self.plan is None or self.plan_key != self.current_plan_key(settings)
+
+    def set_plan(self, plan: Any, settings: dict | None = None):
+        """
+        Store the study plan for the current files
+        :param plan: Generated plan
+        :param settings: Planning settings the plan was generated with
+        """
+        self.plan = plan
+        self.plan_key = self.current_plan_key(settings)
@@ -0,0 +1,516 @@
+"""rabbithole.jobs module"""
+
+import argparse
+import atexit
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from rabbithole.cache import CACHE_DIR, content_hash
+
+# SQLite database of the job queue, shared by the app and every worker process
+JOBS_DB = os.getenv("RABBITHOLE_JOBS_DB", os.path.join(CACHE_DIR, "jobs.sqlite"))
+
+# Number of worker processes the app starts. 0 when the workers run separately with `python -m rabbithole.jobs`
+JOBS_WORKERS = int(os.getenv("RABBITHOLE_JOBS_WORKERS", str(min(os.cpu_count() or 1, 4))))
+
+# Seconds without a heartbeat after which a running job is considered abandoned and queued again
+JOBS_STALE_SECONDS = float(os.getenv("RABBITHOLE_JOBS_STALE_SECONDS", "60"))
+
+# Seconds between two heartbeats of a running job, and between two polls of an idle worker
+JOBS_HEARTBEAT_SECONDS = 5.0
+JOBS_IDLE_SECONDS = 0.5
+
+# Seconds between two polls of the job states by the app
+JOBS_POLL_SECONDS = 1.0
+
+# Number of times an abandoned job is queued again before it fails
+JOBS_MAX_ATTEMPTS = 3
+
+# Job states
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class NamedBytesIO(io.BytesIO):
+    """In-memory file with a name, standing in for an uploaded file in the worker processes"""
+
+    def __init__(self, data: bytes, name: str):
+        super().__init__(data)
+        self.name = name
+
+
+@dataclass
+class Job:
+    """Processing of one file"""
+    job_id: str
+    key: str
+    file_name: str
+    settings: dict
+    status: str
+    stages: dict[str, float] = field(default_factory=dict)  # Elapsed seconds of every finished stage
+    errors: dict[str, str] = field(default_factory=dict)  # Error of every failed stage
+    attempts: int = 0
+    upload: str | None = None  # Upload the file was submitted with. Its jobs share a deduplicator
+    worker: str | None = None
+    created: float = 0.0
+    started: float | None = None
+    finished: float | None = None
+
+    @property
+    def finished_ok(self) -> bool:
+        return self.status == DONE and not self.errors
+
+    @property
+    def pending(self) -> bool:
+        return self.status in (QUEUED, RUNNING)
+
+
+class JobQueue:
+    """
+    Persistent queue of file processing jobs in a SQLite database
+
+    A job holds everything a worker process needs: the file contents and the processing settings. Jobs are
+    keyed by file name, contents and settings, so submitting a file that is already queued, running or done
+    without errors returns the existing job, e.g. after a browser refresh. Workers claim jobs atomically and send heartbeats
+    while they run them; jobs of workers that stopped sending heartbeats are queued again.
+    """
+
+    def __init__(self, path: str | Path = JOBS_DB):
+        """
+        :param path: Path of the database
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, key TEXT NOT NULL, file_name TEXT NOT NULL, settings TEXT NOT NULL, "
+            "data BLOB, status TEXT NOT NULL, stages TEXT NOT NULL DEFAULT '{}', errors TEXT NOT NULL DEFAULT '{}', "
+            "result BLOB, attempts INTEGER NOT NULL DEFAULT 0, worker TEXT, created REAL NOT NULL, "
+            "started REAL, heartbeat REAL, finished REAL)"
+        )
+        if "upload" not in [row[1] for row in self._db.execute("PRAGMA table_info(jobs)")]:
+            # Databases created before uploads were recorded
+            self._db.execute("ALTER TABLE jobs ADD COLUMN upload TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)")
+
+    def _transaction(self, sql: str, params=()) -> list:
+        """Run a statement in an immediate transaction, so that concurrent workers never claim the same job"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(sql, params).fetchall()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return rows
+
+    def submit(self, file_name: str, data: bytes, settings: dict, upload: str | None = None) -> str:
+        """
+        Queue the processing of a file, unless the same file is already queued, running or done without errors
+        :param file_name: File name
+        :param data: File contents
+        :param settings: Processing settings, e.g. {"summary_mode": "refine"}
+        :param upload: Id of the upload the file belongs to. Repeated chunks are merged across the files of an
+        upload
+        :return: Job id
+        """
+        key = content_hash(file_name, content_hash(data), *[f"{k}={v}" for k, v in sorted(settings.items())])
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                existing = self._db.execute(
+                    "SELECT job_id FROM jobs WHERE key = ? AND (status IN (?, ?) OR (status = ? AND errors = '{}')) "
+                    "ORDER BY created DESC LIMIT 1",
+                    (key, QUEUED, RUNNING, DONE),
+                ).fetchone()
+                if existing is None:
+                    self._db.execute(
+                        "INSERT INTO jobs (job_id, key, file_name, settings, data, status, upload, created) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (job_id, key, file_name, json.dumps(settings), sqlite3.Binary(data), QUEUED, upload,
+                         time.time()),
+                    )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return existing[0] if existing is not None else job_id
+
+    def claim(self, worker: str) -> tuple[Job, bytes] | None:
+        """
+        Take the oldest queued job
+        :param worker: Name of the claiming worker
+        :return: The job and the file contents, or None if no job is queued
+        """
+        now = time.time()
+        rows = self._transaction(
+            "UPDATE jobs SET status = ?, worker = ?, started = ?, heartbeat = ?, attempts = attempts + 1 "
+            "WHERE job_id = (SELECT job_id FROM jobs WHERE status = ? ORDER BY created LIMIT 1) "
+            "RETURNING job_id, data",
+            (RUNNING, worker, now, now, QUEUED),
+        )
+        if not rows:
+            return None
+        job_id, data = rows[0]
+        return self.get([job_id])[job_id], bytes(data)
+
+    def heartbeat(self, job_id: str, stage: str | None = None, elapsed: float = 0.0, error: str | None = None):
+        """
+        Record that a job is still running, and optionally the outcome of one of its stages
+        :param job_id: Job id
+        :param stage: Finished stage
+        :param elapsed: Seconds the stage took
+        :param error: Error of the stage, if it failed
+        """
+        with self._lock:
+            if stage is None:
+                self._db.execute("UPDATE jobs SET heartbeat = ? WHERE job_id = ?", (time.time(), job_id))
+                return
+            column, value = ("errors", error) if error is not None else ("stages", elapsed)
+            self._db.execute(
+                f"UPDATE jobs SET heartbeat = ?, {column} = json_set({column}, '$.' || json_quote(?), ?) "
+                "WHERE job_id = ?",
+                (time.time(), stage, value, job_id),
+            )
+
+    def finish(self, job_id: str, worker: str, result: dict[str, Any] | None, error: str | None = None) -> bool:
+        """
+        Store the outcome of a job, unless it was queued again and the worker no longer holds it
+        :param job_id: Job id
+        :param worker: Name of the worker that ran the job
+        :param result: Result of every successful stage
+        :param error: Error that stopped the job, if any
+        :return: Whether the outcome was stored
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE jobs SET status = ?, result = ?, data = NULL, finished = ?, "
+                "errors = CASE WHEN ? IS NULL THEN errors ELSE json_set(errors, '$.job', ?) END "
+                "WHERE job_id = ? AND worker = ? AND status = ?",
+                (FAILED if error is not None else DONE, pickle.dumps(result) if result is not None else None,
+                 time.time(), error, error, job_id, worker, RUNNING),
+            )
+        return cursor.rowcount > 0
+
+    def requeue_stale(self, stale_seconds: float = JOBS_STALE_SECONDS, max_attempts: int = JOBS_MAX_ATTEMPTS) -> int:
+        """
+        Queue again the running jobs whose worker stopped sending heartbeats, or fail them after max_attempts
+        :param stale_seconds: Seconds without a heartbeat
+        :param max_attempts: Maximum number of attempts of a job
+        :return: Number of jobs queued again or failed
+        """
+        deadline = time.time() - stale_seconds
+        rows = self._transaction(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, "
+            "errors = CASE WHEN attempts >= ? THEN json_set(errors, '$.job', 'worker stopped') ELSE errors END, "
+            "finished = CASE WHEN attempts >= ? THEN ? ELSE finished END "
+            "WHERE status = ? AND heartbeat < ? RETURNING job_id",
+            (max_attempts, FAILED, QUEUED, max_attempts, max_attempts, time.time(), RUNNING, deadline),
+        )
+        if rows:
+            print(f"Requeued {len(rows)} abandoned jobs")
+        return len(rows)
+
+    def get(self, job_ids: list[str]) -> dict[str, Job]:
+        """
+        Get the state of jobs
+        :param job_ids: Job ids
+        :return: Jobs by id. Unknown ids are left out
+        """
+        if not job_ids:
+            return {}
+        placeholders = ", ".join("?" * len(job_ids))
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT job_id, key, file_name, settings, status, stages, errors, attempts, upload, worker, created, "
+                f"started, finished FROM jobs WHERE job_id IN ({placeholders})",
+                list(job_ids),
+            ).fetchall()
+        return {
+            row[0]: Job(job_id=row[0], key=row[1], file_name=row[2], settings=json.loads(row[3]), status=row[4],
+                        stages=json.loads(row[5]), errors=json.loads(row[6]), attempts=row[7], upload=row[8],
+                        worker=row[9], created=row[10], started=row[11], finished=row[12])
+            for row in rows
+        }
+
+    def result(self, job_id: str) -> dict[str, Any]:
+        """
+        Get the results of a finished job
+        :param job_id: Job id
+        :return: Result of every successful stage by stage name
+        """
+        with self._lock:
+            row = self._db.execute("SELECT result FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return pickle.loads(row[0]) if row is not None and row[0] is not None else {}
+
+    def counts(self) -> dict[str, int]:
+        """
+        Get the number of jobs in every state
+        :return: Number of jobs by status
+        """
+        with self._lock:
+            return dict(self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def prune(self, max_age: float = 7 * 24 * 3600) -> int:
+        """
+        Delete the finished jobs older than max_age seconds
+        :param max_age: Age in seconds
+        :return: Number of deleted jobs
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND finished < ?", (DONE, FAILED, time.time() - max_age)
+            )
+        return cursor.rowcount
+
+
+_queue: JobQueue | None = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """
+    Get the process-wide job queue, opening it on first use
+    :return: Job queue
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
+
+
+def run_job(queue: JobQueue, job: Job, data: bytes) -> dict[str, Any]:
+    """
+    Run every stage of a job, recording each stage as it finishes
+    :param queue: Job queue
+    :param job: Claimed job
+    :param data: File contents
+    :return: Result of every successful stage, the "dedup" report of the load, and the "trace" of the job:
+    its spans and counters, recorded in the worker process, for the app to merge into its tracer
+    """
+    from rabbithole.dedup import DEDUP, SharedDeduplicator
+    from rabbithole.metrics import get_tracer
+    from rabbithole.pipeline import Pipeline
+    from rabbithole.summarize import SUMMARY_MODE, summarize_document
+
+    # Merge repeated chunks across the files of the upload, processed by other jobs
+    deduplicator = None
+    if DEDUP and job.upload is not None:
+        deduplicator = SharedDeduplicator(queue.path, job.upload)
+        # Chunks registered by an abandoned attempt of this job
+        deduplicator.forget(job.file_name)
+
+    summary_mode = job.settings.get("summary_mode", SUMMARY_MODE)
+    pipeline = Pipeline(summarize=lambda documents: summarize_document(documents, mode=summary_mode),
+                        deduplicator=deduplicator)
+
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(JOBS_HEARTBEAT_SECONDS):
+            queue.heartbeat(job.job_id)
+
+    # Stages like transcription can run for minutes, so heartbeats are sent while they run
+    heart = threading.Thread(target=beat, name=f"heartbeat-{job.job_id[:8]}", daemon=True)
+    heart.start()
+    results = {}
+    try:
+        with get_tracer().run("job") as run:
+            for event in pipeline.run([NamedBytesIO(data, job.file_name)]):
+                if event.ok:
+                    results[event.stage] = event.result
+                    # e.g. the deduplication report, stored next to the stage results
+                    results.update(event.details or {})
+                    queue.heartbeat(job.job_id, event.stage, elapsed=event.elapsed)
+                else:
+                    print(job.file_name, event.stage, event.error)
+                    queue.heartbeat(job.job_id, event.stage, error=str(event.error))
+    finally:
+        stop.set()
+        heart.join()
+        if deduplicator is not None:
+            deduplicator.close()
+    results["trace"] = get_tracer().to_json(run.run_id)
+    return results
+
+
+def worker_environment(processes: int) -> dict[str, str]:
+    """
+    Get the environment of worker processes running side by side
+    :param processes: Number of worker processes
+    :return: Environment variables to set in every worker, so that they share the provider rate limits and, unless
+    RABBITHOLE_OCR_WORKERS is set, the CPUs of their OCR pools
+    """
+    env = {"RABBITHOLE_RATELIMIT_PROCESSES": str(processes)}
+    if "RABBITHOLE_OCR_WORKERS" not in os.environ:
+        # Every worker starts its own OCR pool
+        env["RABBITHOLE_OCR_WORKERS"] = str(max((os.cpu_count() or 1) // max(processes, 1), 1))
+    return env
+
+
+def set_environment(env: dict[str, str]):
+    """
+    Set environment variables. Runs first in the worker processes
+    :param env: Environment variables, e.g. from worker_environment
+    """
+    os.environ.update(env)
+
+
+def work(path: str | Path = JOBS_DB, stop: Any = None, max_jobs: int | None = None, env: dict[str, str] | None = None):
+    """
+    Run jobs until stopped
+    :param path: Path of the job queue database
+    :param stop: multiprocessing.Event stopping the worker between two jobs
+    :param max_jobs: Stop after this many jobs
+    :param env: Environment variables to set before running jobs, e.g. from worker_environment
+    """
+    set_environment(env or {})
+    queue = JobQueue(path)
+    worker = f"{os.uname().nodename if hasattr(os, 'uname') else 'local'}:{os.getpid()}"
+    done = 0
+    while (stop is None or not stop.is_set()) and (max_jobs is None or done < max_jobs):
+        claimed = queue.claim(worker)
+        if claimed is None:
+            time.sleep(JOBS_IDLE_SECONDS)
+            continue
+
+        job, data = claimed
+        print(f"{worker} running {job.file_name} ({job.job_id})")
+        try:
+            finished = queue.finish(job.job_id, worker, run_job(queue, job, data))
+        except Exception as e:
+            print(f"{worker} failed {job.file_name}: {e}")
+            finished = queue.finish(job.job_id, worker, None, error=str(e))
+        if not finished:
+            print(f"{worker} dropped the outcome of {job.file_name}: the job was queued again")
+        done += 1
+
+
+class WorkerPool:
+    """
+    Pool of worker processes running the jobs of a queue
+
+    Each worker process runs one job at a time, with the thread pipeline of rabbithole.pipeline inside it,
+    so CPU-bound decoding and parsing of different files run in parallel. Workers are not daemonic, so their
+    stages can start process pools of their own, e.g. for OCR. A supervisor thread restarts workers that died
+    and queues their jobs again.
+    The workers share the rate limits of rabbithole.ratelimit: each gets an equal share of every provider limit.
+    """
+
+    def __init__(self, workers: int = JOBS_WORKERS, path: str | Path = JOBS_DB):
+        """
+        :param workers: Number of worker processes
+        :param path: Path of the job queue database
+        """
+        self.workers = workers
+        self.path = str(path)
+        # Spawned rather than forked, since the parent runs threads
+        self._context = multiprocessing.get_context("spawn")
+        self._stop = self._context.Event()
+        self._env = worker_environment(workers)
+        self._processes: list = []
+        self._supervisor: threading.Thread | None = None
+
+    def _spawn(self):
+        process = self._context.Process(target=work, args=(self.path, self._stop, None, self._env), daemon=False,
+                                        name="rabbithole-worker")
+        process.start()
+        return process
+
+    def _supervise(self):
+        queue = JobQueue(self.path)
+        while not self._stop.wait(JOBS_HEARTBEAT_SECONDS):
+            for i, process in enumerate(self._processes):
+                if not process.is_alive():
+                    print(f"Restarting worker {process.pid} (exit code {process.exitcode})")
+                    self._processes[i] = self._spawn()
+            queue.requeue_stale()
+
+    def start(self) -> "WorkerPool":
+        """Start the worker processes and the supervisor"""
+        self._processes = [self._spawn() for _ in range(self.workers)]
+        self._supervisor = threading.Thread(target=self._supervise, name="rabbithole-supervisor", daemon=True)
+        self._supervisor.start()
+        # Busy workers would otherwise keep the app from exiting. Their jobs are queued again
+        atexit.register(self.stop, timeout=JOBS_HEARTBEAT_SECONDS)
+        return self
+
+    def stop(self, timeout: float | None = None):
+        """
+        Stop the workers once their current jobs finish
+        :param timeout: Seconds to wait for each worker before terminating it. Defaults to waiting for its job
+        """
+        self._stop.set()
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                print(f"Terminating worker {process.pid}")
+                process.terminate()
+        if self._supervisor is not None:
+            self._supervisor.join()
+
+    def __enter__(self) -> "WorkerPool":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+_pool: WorkerPool | None = None
+
+
+def get_worker_pool() -> WorkerPool | None:
+    """
+    Get the worker pool of the app, starting it on first use
+    :return: Worker pool, or None when the workers run separately (RABBITHOLE_JOBS_WORKERS=0)
+    """
+    global _pool
+    with _queue_lock:
+        if _pool is None and JOBS_WORKERS > 0:
+            _pool = WorkerPool().start()
+        return _pool
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run RabbitHole processing workers")
+    parser.add_argument("--workers", type=int, default=max(JOBS_WORKERS, 1), help="Number of worker processes")
+    parser.add_argument("--db", default=JOBS_DB, help="Path of the job queue database")
+    parser.add_argument("--prune-days", type=float, default=None,
+                        help="Delete the finished jobs older than this many days, then exit")
+    args = parser.parse_args()
+
+    if args.prune_days is not None:
+        from rabbithole.dedup import clear_upload
+
+        print(f"Deleted {JobQueue(args.db).prune(args.prune_days * 24 * 3600)} jobs and "
+              f"{clear_upload(args.db, max_age=args.prune_days * 24 * 3600)} deduplicated chunks")
+        return
+
+    with WorkerPool(args.workers, args.db) as pool:
+        print(f"Running {args.workers} workers on {args.db}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print("Stopping workers after their current jobs")
+            pool.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,76 +1,150 @@
 """rabbithole.keywords module"""
 
-from collections import Counter
-from heapq import nlargest
+from itertools import chain
 from math import log
 
-import streamlit as st
-from pinecone import QueryResponse
+import numpy as np
 
-from rabbithole.vecstore import index
+from rabbithole.metrics import span
+from rabbithole.vecstore import query
 
 
-@st.cache_data
-def get_document_keywords(embeddings: list[list[float]], n: int = 10, n_mult=3) -> list[str]:
+def score_keywords(results: list[list[dict]], n: int = 10, weighted: bool = False) -> list[str]:
+    """
+    Rank the titles of vector store matches by TF-IDF across the document chunks
+    :param results: Matches ({"score", "metadata": {"title"}}) for each chunk of a document
+    :param n: Number of keywords to return
+    :param weighted: Weight each match by its similarity score instead of counting it once
+    :return: List of keywords, highest scoring first
+
+    Each chunk is a "document" for TF-IDF: tf is the share of a chunk's matches that hit a title
+    and idf is computed over the chunks. Ties keep the order in which titles first appear.
+    """
+    return score_corpus_keywords(results, np.zeros(len(results), dtype=np.int64), 1, n=n, weighted=weighted)[0]
+
+
+def score_corpus_keywords(results: list[list[dict]], owners: np.ndarray, num_files: int, n: int = 10,
+                          weighted: bool = False) -> list[list[str]]:
+    """
+    Rank the titles of vector store matches of the chunks of several files by TF-IDF across all the chunks
+    :param results: Matches ({"score", "metadata": {"title"}}) for each chunk of every file
+    :param owners: (len(results),) index of the file of each chunk
+    :param num_files: Number of files
+    :param n: Number of keywords per file
+    :param weighted: Weight each match by its similarity score instead of counting it once
+    :return: Keywords of every file, highest scoring first
+
+    Every chunk of every file is a "document" for TF-IDF, so the titles matched by many chunks of the other files
+    weigh less than the titles distinctive to a file. With one file, this is the TF-IDF of score_keywords.
+    The weights of all files are computed together, ties keep the order in which titles first appear.
+    """
+    num_documents = len(results)
+
+    # Titles of the matches of every chunk
+    chunk_titles = [
+        [match["metadata"].get("title") for match in matches if match.get("metadata")]
+        for matches in results
+    ]
+    occurrences = list(chain.from_iterable(chunk_titles))
+    if not occurrences or n <= 0:
+        return [[] for _ in range(num_files)]
+
+    # Intern the titles to integer ids in order of first appearance
+    titles = list(dict.fromkeys(occurrences))
+    title_ids = {title: i for i, title in enumerate(titles)}
+    num_titles = len(titles)
+
+    # Sparse chunk x title occurrences in coordinate form
+    counts = np.fromiter(map(len, chunk_titles), np.int64, num_documents)
+    rows = np.repeat(np.arange(num_documents), counts)
+    cols = np.fromiter(map(title_ids.__getitem__, occurrences), np.int64, len(occurrences))
+
+    # Term frequency of every occurrence
+    if weighted:
+        scores = np.fromiter(
+            (match.get("score") or 0.0 for matches in results for match in matches if match.get("metadata")),
+            np.float64, len(occurrences)
+        )
+        totals = np.bincount(rows, weights=scores, minlength=num_documents)[rows]
+        tf = np.divide(scores, totals, out=np.zeros_like(scores), where=totals != 0)
+    else:
+        tf = 1 / counts[rows]
+
+    # Document frequency: number of chunks with at least one occurrence of each title
+    pairs = np.sort(rows * num_titles + cols)
+    pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))]
+    document_frequency = np.bincount(pairs % num_titles, minlength=num_titles)
+    idf = np.fromiter((log(num_documents / df) for df in document_frequency.tolist()), np.float64, num_titles)
+
+    # Sum tf * idf over the occurrences of each title in each file
+    cells = np.asarray(owners, dtype=np.int64)[rows] * num_titles + cols
+    present = np.flatnonzero(np.bincount(cells, minlength=num_files * num_titles))
+    keyword_weight = np.bincount(cells, weights=tf * idf[cols], minlength=num_files * num_titles)[present]
+    files, title_ids = np.divmod(present, num_titles)
+
+    # Sort the titles of every file by weight, breaking ties by first appearance, and keep the first n of each
+    order = np.lexsort((title_ids, -keyword_weight, files))
+    rank = np.arange(len(order)) - np.searchsorted(files[order], files[order])
+    top = order[rank < n]
+    keywords: list[list[str]] = [[] for _ in range(num_files)]
+    for file, title in zip(files[top].tolist(), title_ids[top].tolist()):
+        keywords[file].append(titles[title])
+    return keywords
+
+
+def get_document_keywords(embeddings: np.ndarray | list[list[float]], n: int = 10, n_mult=3,
+                          weighted: bool = False) -> list[str]:
     """
     Get keywords from the text embeddings of a document
     :param embeddings: Text embeddings to get keywords from
     :param n: Number of keywords to return
     :param n_mult: n-multiplier to query and filter more keywords
+    :param weighted: Weight the keyword matches by their similarity scores
     :return List of keywords
 
     NOTE: This requires the embeddings to use cohere multilingual-22-12 model
     """
     # Check input types
-    if not isinstance(embeddings, list):
-        raise TypeError(f"embeddings must be a list. Got {type(embeddings)}")
-    if not isinstance(embeddings[0], list):
+    if isinstance(embeddings, np.ndarray):
+        if embeddings.ndim != 2:
+            raise TypeError(f"embeddings must be a 2D array. Got {embeddings.ndim}D")
+    elif not isinstance(embeddings, list):
+        raise TypeError(f"embeddings must be an array or a list. Got {type(embeddings)}")
+    elif not isinstance(embeddings[0], list):
         raise TypeError(f"embeddings must be a list of lists. Got list[{type(embeddings[0])}]")
 
-    results: list[list[dict]] = []
+    # Query the Wikipedia collection with all the embeddings at once
+    results: list[list[dict]] = query(embeddings, top_k=n * n_mult, namespace="wikipedia")
 
-    # Query the Wikipedia collection with the embeddings
-    for emb in embeddings:
-        result: QueryResponse = index.query(
-            vector=emb,
-            top_k=n * n_mult,
-            include_values=False,
-            include_metadata=True,
-            namespace="wikipedia"
-        )
-        results.append(result.get("matches", []))
-
-    # Loop over the metadatas to extract the titles as keywords
-    keywords = [
-        [
-            vector.get("metadata").get("title")
-            for vector in result if vector.get("metadata")
-        ]
-        for result in results
-    ]
-
-    # Initialize counters for keyword count, weight, and document frequency
-    keyword_count = Counter()
-    keyword_weight = Counter()
-    document_frequency = Counter()
+    with span("keywords.score", chunks=len(results)):
+        return score_keywords(results, n=n, weighted=weighted)
 
-    num_documents = len(keywords)
 
-    # Count the document frequency for each unique keyword
-    for kw_list in keywords:
-        unique_keywords = set(kw_list)
-        document_frequency.update(unique_keywords)
+def get_corpus_keywords(embeddings: dict[str, np.ndarray], n: int = 10, n_mult=3,
+                        weighted: bool = False) -> dict[str, list[str]]:
+    """
+    Get the keywords of every file of an upload from the text embeddings of all their chunks
+    :param embeddings: Text embeddings of the chunks of every file
+    :param n: Number of keywords per file
+    :param n_mult: n-multiplier to query and filter more keywords
+    :param weighted: Weight the keyword matches by their similarity scores
+    :return: Keywords of every file, favouring the concepts distinctive to it over those shared by the upload
 
-    # Calculate the weight of each keyword
-    for kw_list in keywords:
-        num_keywords = len(kw_list)
-        for keyword in kw_list:
-            keyword_count[keyword] += 1
-            tf = 1 / num_keywords
-            idf = log(num_documents / document_frequency[keyword])
-            keyword_weight[keyword] += tf * idf
+    Every distinct embedding of every file is queried in one batch, so chunks repeated across files are
+    queried once, and the matches are scored together with score_corpus_keywords.
+    NOTE: This requires the embeddings to use cohere multilingual-22-12 model
+    """
+    names = [name for name, vectors in embeddings.items() if len(vectors)]
+    if not names:
+        return {name: [] for name in embeddings}
+    vectors = np.concatenate([np.asarray(embeddings[name], dtype=np.float32) for name in names])
+    owners = np.repeat(np.arange(len(names)), [len(embeddings[name]) for name in names])
 
-    # Get the n largest keywords by weight
-    top_keywords = nlargest(n, keyword_weight, key=keyword_weight.get)
+    # Query the Wikipedia collection once per distinct embedding
+    unique, inverse = np.unique(vectors, axis=0, return_inverse=True)
+    matches: list[list[dict]] = query(unique, top_k=n * n_mult, namespace="wikipedia")
+    results = [matches[i] for i in inverse.reshape(-1).tolist()]
 
-    return top_keywords
+    with span("keywords.score", chunks=len(results), files=len(names), queries=len(unique)):
+        keywords = dict(zip(names, score_corpus_keywords(results, owners, len(names), n=n, weighted=weighted)))
+    return {name: keywords.get(name, []) for name in embeddings}
@@ -1,93 +1,171 @@
 """rabbithole.loader module"""
+import io
+import os
 import tempfile
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterable, Iterator
 
-import streamlit as st
-from langchain.document_loaders import Docx2txtLoader, PyMuPDFLoader, TextLoader, UnstructuredImageLoader
-from langchain.schema import Document
-from langchain.text_splitter import TokenTextSplitter
-from streamlit.runtime.uploaded_file_manager import UploadedFile
+from rabbithole.chunking import SECTION, TokenChunker
+from rabbithole.metrics import Span, count, span_iter
+from rabbithole.mp3 import SUPPORTED_AV_FILE_TYPES
+from rabbithole.ocr import ocr_images, pdf_page_texts
 
-from rabbithole.mp3 import SUPPORTED_AV_FILE_TYPES, convert_to_mp3
-from rabbithole.transcribe import transcribe
+# The parsers of each file type, langchain and streamlit are imported on first use
+if TYPE_CHECKING:
+    from langchain.schema import Document
+    from streamlit.runtime.uploaded_file_manager import UploadedFile
 
 SUPPORTED_IMG_FILE_TYPES = (".jpg", ".jpeg", ".png")
 
 
-def save_to_temp_file(file: UploadedFile) -> str:
+def read_bytes(file: "UploadedFile") -> bytes:
     """
-    Save an uploaded file to a temporary file and return the path.
-    :param file: File to save.
-    :return: Path to the temporary file.
+    Get the contents of an uploaded file without consuming it
+    :param file: Uploaded file, or any binary file object with a name
+    :return: File contents
     """
-    temp_file = tempfile.NamedTemporaryFile(suffix=f".{file.name.split('.')[-1]}", delete=False)
-    temp_file.write(file.read())
-    temp_file.close()
-    return temp_file.name
+    if hasattr(file, "getvalue"):
+        return file.getvalue()
+    file.seek(0)
+    return file.read()
 
 
-@st.cache_data
-def load_file(file: UploadedFile) -> list[Document]:
+@contextmanager
+def scratch_file(data: bytes, suffix: str) -> Iterator[str]:
     """
-    Load a file and return a list of Document objects
+    Write data to a scratch file for loaders that need a path, and delete it afterwards
+    :param data: File contents
+    :param suffix: File name suffix, e.g. ".png"
+    :return: Path to the scratch file
+    """
+    with tempfile.TemporaryDirectory(prefix="rabbithole-") as temp_dir:
+        path = os.path.join(temp_dir, f"upload{suffix}")
+        with open(path, "wb") as f:
+            f.write(data)
+        yield path
+
+
+def split_stream(texts: Iterable[str], chunker: TokenChunker, source: str, separator: str = "\n",
+                 boundary: int = SECTION) -> Iterator["Document"]:
+    """
+    Split a stream of text segments into Documents as the segments arrive
+    :param texts: Consecutive text segments, e.g. PDF pages or transcript chunks
+    :param chunker: Token chunker to use
+    :param source: Name of the source file, stored in the Document metadata
+    :param separator: Joined between consecutive segments
+    :param boundary: Strength of the boundary between consecutive segments
+    :return: Iterator of Document objects
+
+    The metadata of each Document holds the token offset and length of its window in the file, the strength
+    of the boundary it starts at and the number of characters it repeats from the previous Document,
+    so later stages count and join chunks without tokenizing them again.
+    """
+    from langchain.schema import Document
+
+    for chunk in chunker.split(texts, separator=separator, boundary=boundary):
+        yield Document(page_content=chunk.text, metadata={
+            "source": source,
+            "offset": chunk.start,
+            "tokens": chunk.end - chunk.start,
+            "boundary": chunk.boundary,
+            "overlap": chunk.overlap,
+        })
+
+
+def iter_documents(file: "UploadedFile") -> Iterator["Document"]:
+    """
+    Load a file and yield its Document objects
     :param file: File to load.
-    Supported file types: PDF
-    :return: List of Document objects
+    Supported file types: .docx, .pdf, .txt, images, audio and video
+    :return: Iterator of Document objects
+
+    Files are read from memory and tokenized once. PDF pages and transcript chunks are split as
+    they are extracted, and Documents are yielded while later pages or chunks are still being processed.
+    Chunks are cut at headings, pages, transcript segments and paragraphs where possible.
+    Images and scanned PDF pages are OCRed on a process pool.
+    Scratch files, needed only for audio/video, are deleted when loading finishes.
     """
-    text_splitter = TokenTextSplitter(encoding_name="cl100k_base", chunk_size=1000, chunk_overlap=100)
+    data = read_bytes(file)
 
-    # Handle .docx files
-    if file.name.endswith(".docx"):
-        temp_file = save_to_temp_file(file)
-        return Docx2txtLoader(file_path=temp_file).load_and_split(text_splitter=text_splitter)
+    def documents(load_span: Span) -> Iterator["Document"]:
+        count("bytes_processed", len(data), stage="load")
+        chunks = 0
+        for document in _iter_file_documents(file.name, data):
+            chunks += 1
+            yield document
+        load_span.attributes["chunks"] = chunks
+        count("chunks", chunks, stage="load")
+
+    # The span is current while the file is split, not while the consumer handles its documents
+    yield from span_iter("load", documents, file=file.name, bytes=len(data))
 
-    # Handle .pdf files
-    elif file.name.endswith(".pdf"):
-        temp_file = save_to_temp_file(file)
-        pdf_doc = PyMuPDFLoader(file_path=temp_file).load_and_split(text_splitter=text_splitter)
 
-        # Save transcription to temporary file
-        temp_file = tempfile.NamedTemporaryFile(suffix=".txt", delete=False)
-        temp_file.write("\n".join([page.page_content for page in pdf_doc]).encode())
-        temp_file.close()
+def _iter_file_documents(name: str, data: bytes) -> Iterator["Document"]:
+    """Split the contents of a file into Documents according to its type"""
+    chunker = TokenChunker()
+    suffix = os.path.splitext(name)[1].lower()
+
+    # Handle .docx files
+    if suffix == ".docx":
+        import docx2txt
 
-        # Load the file using TextLoader
-        return TextLoader(file_path=temp_file.name, encoding="utf-8").load_and_split(text_splitter=text_splitter)
+        yield from split_stream([docx2txt.process(io.BytesIO(data))], chunker, name)
+
+    # Handle .pdf files
+    elif suffix == ".pdf":
+        # Scanned pages are OCRed in parallel, and the pages are split in order as they are ready
+        yield from split_stream(pdf_page_texts(data), chunker, name)
 
     # Handle .txt files
-    elif file.name.endswith(".txt"):
-        temp_file = save_to_temp_file(file)
-        return TextLoader(file_path=temp_file).load_and_split(text_splitter=text_splitter)
+    elif suffix == ".txt":
+        yield from split_stream([data.decode("utf-8", errors="replace")], chunker, name)
 
     # Handle image files
-    elif file.name.endswith(SUPPORTED_IMG_FILE_TYPES):
-        temp_file = save_to_temp_file(file)
-        return UnstructuredImageLoader(file_path=temp_file).load_and_split(text_splitter=text_splitter)
+    elif suffix in SUPPORTED_IMG_FILE_TYPES:
+        yield from split_stream(ocr_images([data]), chunker, name, separator="\n\n")
 
     # Handle Audio and Video files
-    elif file.name.endswith(SUPPORTED_AV_FILE_TYPES):
-        temp_file = save_to_temp_file(file)
+    elif suffix[1:] in SUPPORTED_AV_FILE_TYPES:
+        from rabbithole.transcribe import transcribe_iter
 
-        # Convert to mp3 and transcribe
-        mp3_file = convert_to_mp3(temp_file)
-        transcription = transcribe(mp3_file)
+        # ffmpeg needs a seekable path for containers like mp4
+        with scratch_file(data, suffix=suffix) as path:
+            # Transcribe and split the transcript as it streams in
+            yield from split_stream(transcribe_iter(path), chunker, name, separator=" ")
 
-        # Save transcription to temporary file
-        temp_file = tempfile.NamedTemporaryFile(suffix=".txt", delete=False)
-        temp_file.write(transcription.encode())
-        temp_file.close()
+    else:
+        raise ValueError(f"Unsupported file type: {suffix}")
 
-        # Load the file using TextLoader
-        return TextLoader(file_path=temp_file.name).load_and_split(text_splitter=text_splitter)
 
-    else:
-        raise ValueError(f"Unsupported file type: {file.type}")
+_cached_load_file = None
+
+
+def _load_file(file: "UploadedFile") -> list["Document"]:
+    return list(iter_documents(file))
+
+
+def load_file(file: "UploadedFile") -> list["Document"]:
+    """
+    Load a file and return a list of Document objects
+    :param file: File to load.
+    Supported file types: .docx, .pdf, .txt, images, audio and video
+    :return: List of Document objects
+
+    Results are cached by streamlit's st.cache_data.
+    """
+    global _cached_load_file
+    if _cached_load_file is None:
+        import streamlit as st
+
+        _cached_load_file = st.cache_data(_load_file)
+    return _cached_load_file(file)
 
 
-def load_files(files: list[UploadedFile]) -> dict[str, list[Document]]:
+def load_files(files: list["UploadedFile"]) -> dict[str, list["Document"]]:
     """
     Load a list of files and return a dictionary of Document objects
     :param files: List of files to load.
-    Supported file types: PDF
+    Supported file types: .docx, .pdf, .txt, images, audio and video
     :return: Dictionary of Document objects
     """
     documents = {}
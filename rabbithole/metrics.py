@@ -0,0 +1,483 @@
+"""rabbithole.metrics module"""
+
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+# Trace exports written when a run ends: comma-separated "json" and/or "prometheus"
+TRACE_EXPORT = [name for name in os.getenv("RABBITHOLE_TRACE_EXPORT", "").split(",") if name]
+
+# Directory of the exported traces
+TRACE_DIR = os.getenv("RABBITHOLE_TRACE_DIR", "traces")
+
+# Mirror spans to OpenTelemetry, if the opentelemetry-api package is installed
+TRACE_OTEL = os.getenv("RABBITHOLE_TRACE_OTEL", "0") == "1"
+
+# Number of finished spans kept in memory
+TRACE_MAX_SPANS = 20_000
+
+# Number of runs kept in memory. Runs whose spans all left memory are forgotten earlier
+TRACE_MAX_RUNS = 1_000
+
+
+class Metrics:
+    """
+    Thread-safe in-process recorder of numeric observations, e.g. LLM time-to-first-token
+
+    Every metric keeps its count, sum, minimum, maximum and last value.
+    """
+
+    def __init__(self):
+        self._values: dict[str, dict[str, float]] = defaultdict(
+            lambda: {"count": 0, "sum": 0.0, "min": float("inf"), "max": float("-inf"), "last": 0.0}
+        )
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float):
+        """
+        Record an observation
+        :param name: Metric name, e.g. "openai.ttft_seconds"
+        :param value: Observed value
+        """
+        with self._lock:
+            metric = self._values[name]
+            metric["count"] += 1
+            metric["sum"] += value
+            metric["min"] = min(metric["min"], value)
+            metric["max"] = max(metric["max"], value)
+            metric["last"] = value
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """
+        Get the statistics of every metric
+        :return: {"count", "mean", "min", "max", "last"} by metric name
+        """
+        with self._lock:
+            return {
+                name: {"count": metric["count"], "mean": metric["sum"] / metric["count"], "min": metric["min"],
+                       "max": metric["max"], "last": metric["last"]}
+                for name, metric in sorted(self._values.items())
+            }
+
+    def clear(self):
+        """Forget every observation"""
+        with self._lock:
+            self._values.clear()
+
+
+_metrics: Metrics | None = None
+
+
+def get_metrics() -> Metrics:
+    """Get the metrics shared by every session of the process"""
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+@dataclass
+class Span:
+    """A timed operation, e.g. one embedding request"""
+    name: str
+    span_id: int
+    parent_id: int | None
+    run_id: int | None
+    thread: str
+    start: float  # Seconds since the epoch
+    end: float | None = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+    error: str | None = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+
+@dataclass
+class Run:
+    """A traced unit of work, e.g. processing an upload"""
+    run_id: int
+    name: str
+    start: float
+    end: float | None = None
+
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar("rabbithole_span", default=None)
+_current_run: contextvars.ContextVar[Run | None] = contextvars.ContextVar("rabbithole_run", default=None)
+
+
+def _label_key(labels: dict[str, Any]) -> tuple[tuple[str, str], ...]:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Tracer:
+    """
+    Lightweight in-process tracer: nested spans and labeled counters, grouped by run
+
+    Spans and counters recorded inside `run()` belong to that run, including those recorded on worker
+    threads started with `in_context()`. Finished runs can be exported as JSON or Prometheus text, and
+    spans are mirrored to OpenTelemetry when enabled and installed.
+    """
+
+    def __init__(self, max_spans: int = TRACE_MAX_SPANS, export: list[str] | None = None,
+                 export_dir: str | Path = TRACE_DIR, otel: bool = TRACE_OTEL, max_runs: int = TRACE_MAX_RUNS):
+        """
+        :param max_spans: Number of finished spans kept in memory
+        :param export: Exports written when a run ends: "json" and/or "prometheus"
+        :param export_dir: Directory of the exports
+        :param otel: Mirror spans to the OpenTelemetry tracer "rabbithole"
+        :param max_runs: Number of runs kept in memory, with their counters
+        """
+        self.export = TRACE_EXPORT if export is None else export
+        self.export_dir = Path(export_dir)
+        self.max_runs = max_runs
+        self.runs: OrderedDict[int, Run] = OrderedDict()
+        self._spans: deque[Span] = deque(maxlen=max_spans)
+        self._counters: dict[tuple[str, tuple], float] = defaultdict(float)
+        self._run_counters: dict[int, dict[tuple[str, tuple], float]] = defaultdict(lambda: defaultdict(float))
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+        self._otel = None
+        if otel:
+            try:
+                from opentelemetry import trace
+
+                self._otel = trace.get_tracer("rabbithole")
+            except ImportError:
+                print("RABBITHOLE_TRACE_OTEL is set but opentelemetry-api is not installed")
+
+    @contextmanager
+    def run(self, name: str) -> Iterator[Run]:
+        """
+        Group the spans and counters recorded inside the block into a run
+        :param name: Run name, e.g. "upload"
+        :return: The run
+        """
+        run = Run(run_id=next(self._ids), name=name, start=time.time())
+        with self._lock:
+            self.runs[run.run_id] = run
+            self._evict_runs()
+        token = _current_run.set(run)
+        try:
+            with self.span(name):
+                yield run
+        finally:
+            run.end = time.time()
+            _current_run.reset(token)
+            for export in self.export:
+                self.export_run(run.run_id, export)
+
+    def _start(self, name: str, attributes: dict[str, Any]) -> Span:
+        """Create a span nested in the current span"""
+        parent = _current_span.get()
+        run = _current_run.get()
+        return Span(name=name, span_id=next(self._ids), parent_id=parent.span_id if parent else None,
+                    run_id=run.run_id if run else None, thread=threading.current_thread().name,
+                    start=time.time(), attributes=attributes)
+
+    def _finish(self, span: Span, otel_span: Any = None):
+        """Record a finished span, and copy its attributes to its OpenTelemetry span"""
+        span.end = time.time()
+        with self._lock:
+            self._spans.append(span)
+            self._evict_runs()
+        if otel_span is not None:
+            for key, value in span.attributes.items():
+                otel_span.set_attribute(key, value if isinstance(value, (bool, int, float, str)) else str(value))
+            if span.error:
+                otel_span.set_attribute("error", span.error)
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        """
+        Time the block as a span, nested in the current span
+        :param name: Span name, e.g. "cohere.embed"
+        :param attributes: Span attributes. More can be set on the yielded span
+        :return: The span
+
+        Generators should not yield inside the block, or the span stays current in the context of the consumer
+        while they are suspended. See span_iter.
+        """
+        span = self._start(name, attributes)
+        token = _current_span.set(span)
+        otel_context = self._otel.start_as_current_span(name) if self._otel is not None else None
+        otel_span = otel_context.__enter__() if otel_context is not None else None
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            self._finish(span, otel_span)
+            if otel_context is not None:
+                otel_context.__exit__(None, None, None)
+
+    def span_iter(self, name: str, items: Callable[[Span], Iterable[T]], **attributes) -> Iterator[T]:
+        """
+        Time an iteration as a span, nested in the current span when the iteration starts
+        :param name: Span name, e.g. "load"
+        :param items: Function of the span returning the items, e.g. a generator setting attributes of the span
+        :param attributes: Span attributes
+        :return: Iterator of the items
+
+        The span is current only while the next item is computed, so the spans of the consumer are not nested
+        in it, and the iteration can move between threads and contexts.
+        """
+        span = self._start(name, attributes)
+        otel_span = self._otel.start_span(name) if self._otel is not None else None
+        iterator = iter(items(span))
+        try:
+            while True:
+                token = _current_span.set(span)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    _current_span.reset(token)
+                yield item
+        except GeneratorExit:
+            # The consumer stopped early. The items are closed with the span current, as they ran
+            token = _current_span.set(span)
+            try:
+                getattr(iterator, "close", lambda: None)()
+            finally:
+                _current_span.reset(token)
+            raise
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self._finish(span, otel_span)
+            if otel_span is not None:
+                otel_span.end()
+
+    def count(self, name: str, value: float = 1, **labels):
+        """
+        Add to a counter
+        :param name: Counter name, e.g. "api_calls"
+        :param value: Amount to add
+        :param labels: Counter labels, e.g. provider="cohere"
+        """
+        key = (name, _label_key(labels))
+        run = _current_run.get()
+        with self._lock:
+            self._counters[key] += value
+            if run is not None and run.run_id in self.runs:
+                self._run_counters[run.run_id][key] += value
+
+    def merge(self, traces: dict[str, dict], name: str) -> Run | None:
+        """
+        Record runs traced in other processes, e.g. the jobs of an upload, as one run
+        :param traces: Runs exported with to_json, by label, e.g. by file name. Their thread names are prefixed
+        with the label, so the threads of different processes stay apart
+        :param name: Name of the merged run, e.g. "upload"
+        :return: The merged run, or None if no trace has a run
+        """
+        runs = [trace["run"] for trace in traces.values() if trace.get("run") and trace["run"]["end"] is not None]
+        if not runs:
+            return None
+        run = Run(run_id=next(self._ids), name=name, start=min(r["start"] for r in runs),
+                  end=max(r["end"] for r in runs))
+        with self._lock:
+            self.runs[run.run_id] = run
+            for label, trace in traces.items():
+                # Spans get new ids, so they cannot collide with the spans of this process
+                span_ids = {span["span_id"]: next(self._ids) for span in trace["spans"]}
+                for span in trace["spans"]:
+                    self._spans.append(Span(
+                        name=span["name"], span_id=span_ids[span["span_id"]],
+                        parent_id=span_ids.get(span["parent_id"]), run_id=run.run_id,
+                        thread=f"{label}/{span['thread']}", start=span["start"], end=span["end"],
+                        attributes=span["attributes"], error=span["error"],
+                    ))
+                for counter in trace["counters"]:
+                    key = (counter["name"], _label_key(counter["labels"]))
+                    self._counters[key] += counter["value"]
+                    self._run_counters[run.run_id][key] += counter["value"]
+            self._evict_runs()
+        for export in self.export:
+            self.export_run(run.run_id, export)
+        return run
+
+    def _evict_runs(self):
+        """
+        Forget the oldest runs and their counters, beyond max_runs or once their spans all left memory.
+        Called with the lock held
+        """
+        # Spans are appended as they end, so the spans of a run that ended before the oldest span kept are gone
+        oldest = self._spans[0].end if len(self._spans) == self._spans.maxlen else None
+        while self.runs:
+            run_id, run = next(iter(self.runs.items()))
+            if len(self.runs) <= self.max_runs and (oldest is None or run.end is None or run.end >= oldest):
+                break
+            del self.runs[run_id]
+            self._run_counters.pop(run_id, None)
+
+    def finished_runs(self) -> list[Run]:
+        """
+        Get the finished runs still in memory
+        :return: Runs by start time
+        """
+        with self._lock:
+            return [run for run in self.runs.values() if run.end is not None]
+
+    def spans(self, run_id: int | None = None) -> list[Span]:
+        """
+        Get finished spans
+        :param run_id: Only the spans of this run. Defaults to every span
+        :return: Spans by start time
+        """
+        with self._lock:
+            spans = [span for span in self._spans if run_id is None or span.run_id == run_id]
+        return sorted(spans, key=lambda span: span.start)
+
+    def counters(self, run_id: int | None = None) -> dict[tuple[str, tuple], float]:
+        """
+        Get counter values
+        :param run_id: Only the counts of this run. Defaults to the totals
+        :return: Values by (name, labels)
+        """
+        with self._lock:
+            return dict(self._counters if run_id is None else self._run_counters.get(run_id, {}))
+
+    def last_run(self, name: str | None = None) -> Run | None:
+        """
+        Get the latest finished run
+        :param name: Only runs with this name
+        """
+        runs = [run for run in self.finished_runs() if name in (None, run.name)]
+        return max(runs, key=lambda run: run.start, default=None)
+
+    def to_json(self, run_id: int | None = None) -> dict:
+        """
+        Get the spans and counters as a JSON-serializable dictionary
+        :param run_id: Only this run. Defaults to everything recorded
+        """
+        return {
+            "run": asdict(run) if run_id is not None and (run := self.runs.get(run_id)) is not None else None,
+            "spans": [{**asdict(span), "duration": span.duration} for span in self.spans(run_id)],
+            "counters": [{"name": name, "labels": dict(labels), "value": value}
+                         for (name, labels), value in sorted(self.counters(run_id).items())],
+            "metrics": get_metrics().summary(),
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        Get the totals in the Prometheus text exposition format
+        :return: Counters, span durations by name, and metrics
+        """
+        def labels_text(labels) -> str:
+            if not labels:
+                return ""
+            escaped = (
+                key + '="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                for key, value in labels
+            )
+            return "{" + ",".join(escaped) + "}"
+
+        def metric_name(name: str) -> str:
+            return "rabbithole_" + "".join(c if c.isalnum() else "_" for c in name)
+
+        lines = []
+        counters: dict[str, list] = defaultdict(list)
+        for (name, labels), value in sorted(self.counters().items()):
+            counters[metric_name(name) + "_total"].append((labels, value))
+        for name, values in counters.items():
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{labels_text(labels)} {value:g}" for labels, value in values)
+
+        durations: dict[str, list[float]] = defaultdict(list)
+        for span in self.spans():
+            durations[span.name].append(span.duration)
+        if durations:
+            lines.append("# TYPE rabbithole_span_seconds summary")
+            for name, values in sorted(durations.items()):
+                labels = labels_text([("span", name)])
+                lines.append(f"rabbithole_span_seconds_sum{labels} {sum(values):.6f}")
+                lines.append(f"rabbithole_span_seconds_count{labels} {len(values)}")
+
+        for name, stats in get_metrics().summary().items():
+            lines.append(f"# TYPE {metric_name(name)} summary")
+            lines.append(f"{metric_name(name)}_sum {stats['mean'] * stats['count']:.6f}")
+            lines.append(f"{metric_name(name)}_count {stats['count']}")
+        return "\n".join(lines) + "\n"
+
+    def export_run(self, run_id: int, export: str) -> Path:
+        """
+        Write a run to the export directory
+        :param run_id: Run to export
+        :param export: "json" for the run's spans and counters, "prometheus" for the process totals
+        :return: Path of the written file
+        """
+        self.export_dir.mkdir(parents=True, exist_ok=True)
+        if export == "json":
+            path = self.export_dir / f"run-{run_id}.json"
+            path.write_text(json.dumps(self.to_json(run_id), indent=2), encoding="utf-8")
+        elif export == "prometheus":
+            path = self.export_dir / "rabbithole.prom"
+            temp = path.with_suffix(".tmp")
+            temp.write_text(self.to_prometheus(), encoding="utf-8")
+            os.replace(temp, path)
+        else:
+            raise ValueError(f"Unsupported trace export: {export}")
+        return path
+
+    def clear(self):
+        """Forget every run, span and counter"""
+        with self._lock:
+            self.runs.clear()
+            self._spans.clear()
+            self._counters.clear()
+            self._run_counters.clear()
+
+
+_tracer: Tracer | None = None
+
+
+def get_tracer() -> Tracer:
+    """Get the tracer shared by every session of the process"""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+
+def span(name: str, **attributes):
+    """Time a block as a span of the process tracer. See Tracer.span"""
+    return get_tracer().span(name, **attributes)
+
+
+def span_iter(name: str, items: Callable[[Span], Iterable[T]], **attributes) -> Iterator[T]:
+    """Time an iteration as a span of the process tracer. See Tracer.span_iter"""
+    return get_tracer().span_iter(name, items, **attributes)
+
+
+def count(name: str, value: float = 1, **labels):
+    """Add to a counter of the process tracer. See Tracer.count"""
+    get_tracer().count(name, value, **labels)
+
+
+def in_context(func: Callable) -> Callable:
+    """
+    Bind a function to a copy of the current context, so that spans it records on a worker thread
+    nest under the current span and run
+    :param func: Function to submit to an executor
+    :return: Function running func in a fresh copy of the context on every call, so it can run on many
+    threads at once, e.g. with executor.map
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
@@ -1,11 +1,24 @@
 """rabbithole.mp3 module"""
 
+import io
+import os
+import subprocess
 import tempfile
+import threading
+from typing import Iterator
 
-from moviepy.editor import AudioFileClip
-from pydub import AudioSegment
+import numpy as np
 from tqdm import tqdm
 
+from rabbithole.metrics import count, span
+
+# ffmpeg executable, shared with moviepy's setting
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+
+# Chunks are decoded to 16 kHz mono 16-bit PCM, the format Whisper resamples to anyway
+SAMPLE_RATE = 16000
+BYTES_PER_SECOND = SAMPLE_RATE * 2
+
 SUPPORTED_AV_FILE_TYPES = (
     # Video formats
     "mp4", "mkv", "webm", "flv", "avi", "mov", "wmv",
@@ -30,6 +43,8 @@ def convert_to_mp3(filepath: str) -> str:
         raise ValueError(f"Unsupported file type: {filepath.rsplit('.', 1)[-1]}")
 
     # Load video or audio file
+    from moviepy.editor import AudioFileClip
+
     clip = AudioFileClip(filepath)
 
     # Make sure the file name ends with .mp3
@@ -53,6 +68,8 @@ def chunk_mp3(filepath: str, chunk_length: int = 10) -> list[str]:
     Saves the chunked files in a temporary directory
     """
 
+    from pydub import AudioSegment
+
     audio = AudioSegment.from_mp3(filepath)
 
     # Get the total length of the audio file
@@ -86,3 +103,128 @@ def chunk_mp3(filepath: str, chunk_length: int = 10) -> list[str]:
             chunked_filepaths.append(temp.name)
 
     return chunked_filepaths
+
+
+def _find_silence(pcm: bytes, search_seconds: float, frame_seconds: float = 0.1) -> int:
+    """
+    Find the quietest frame near the end of a PCM window
+    :param pcm: 16-bit mono PCM
+    :param search_seconds: Length of the window tail to search in seconds
+    :param frame_seconds: Length of the frames compared in seconds
+    :return: Byte offset of the middle of the quietest frame
+    """
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    frame = int(SAMPLE_RATE * frame_seconds)
+    start = max(0, len(samples) - int(SAMPLE_RATE * search_seconds))
+    start -= start % frame
+
+    frames = samples[start: start + (len(samples) - start) // frame * frame].reshape(-1, frame)
+    if not len(frames):
+        return len(pcm)
+    energy = (frames.astype(np.float32) ** 2).mean(axis=1)
+    return (start + int(np.argmin(energy)) * frame + frame // 2) * 2
+
+
+def encode_mp3(pcm: bytes, bitrate: str = "64k") -> bytes:
+    """
+    Encode 16 kHz mono 16-bit PCM to mp3 in memory
+    :param pcm: PCM audio
+    :param bitrate: mp3 bitrate
+    :return: mp3 bytes
+    """
+    result = subprocess.run(
+        [FFMPEG_BINARY, "-nostdin", "-loglevel", "error", "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE),
+         "-i", "pipe:0", "-f", "mp3", "-b:a", bitrate, "pipe:1"],
+        input=pcm, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to encode mp3: {result.stderr.decode(errors='replace')}")
+    return result.stdout
+
+
+def stream_chunks(source: str | bytes, chunk_length: int = 10, split_on_silence: bool = True,
+                  silence_search: float = 30.0, bitrate: str = "64k") -> Iterator[io.BytesIO]:
+    """
+    Decode a video or audio source once through an ffmpeg pipe and yield mp3 chunks in memory
+    :param source: Path of the file, or its bytes.
+    Bytes must be in a streamable format: containers that keep their index at the end (most mp4/m4a/mov)
+    can only be decoded from a path
+    :param chunk_length: Maximum length of each chunk in minutes
+    :param split_on_silence: Cut each chunk at the quietest point of its last `silence_search` seconds
+    instead of at the fixed window boundary
+    :param silence_search: Length of the window tail searched for silence in seconds
+    :param bitrate: mp3 bitrate of the chunks
+    :return: Iterator of in-memory mp3 chunks, named chunk_000.mp3, chunk_001.mp3, ...
+
+    At most one window of PCM (about 19 MB for 10 minutes) is held in memory at a time.
+    """
+    window = int(chunk_length * 60 * BYTES_PER_SECOND)
+    window -= window % 2
+
+    args = [FFMPEG_BINARY, "-loglevel", "error"]
+    args += ["-nostdin", "-i", source] if isinstance(source, str) else ["-i", "pipe:0"]
+    args += ["-vn", "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"]
+
+    decoder = subprocess.Popen(
+        args,
+        stdin=None if isinstance(source, str) else subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    )
+
+    # Feed in-memory sources from a thread so the decoder never blocks on a full stdout pipe
+    feeder = None
+    if not isinstance(source, str):
+        def feed():
+            try:
+                decoder.stdin.write(source)
+            except BrokenPipeError:
+                pass
+            finally:
+                decoder.stdin.close()
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+    try:
+        buffer = bytearray()
+        index = 0
+        decoded = 0
+        eof = False
+        while not eof or buffer:
+            while not eof and len(buffer) < window:
+                data = decoder.stdout.read(window - len(buffer))
+                if not data:
+                    eof = True
+                buffer.extend(data)
+                decoded += len(data)
+
+            if eof:
+                cut = len(buffer)
+            elif split_on_silence:
+                cut = _find_silence(bytes(buffer[:window]), silence_search)
+            else:
+                cut = window
+
+            pcm = bytes(buffer[:cut])
+            del buffer[:cut]
+
+            # Ignore chunks that are too small
+            if len(pcm) < BYTES_PER_SECOND:
+                continue
+
+            with span("mp3.encode", seconds=len(pcm) / BYTES_PER_SECOND):
+                chunk = io.BytesIO(encode_mp3(pcm, bitrate=bitrate))
+            count("audio_seconds", len(pcm) / BYTES_PER_SECOND)
+            chunk.name = f"chunk_{index:03d}.mp3"
+            index += 1
+            yield chunk
+
+        if decoder.wait() != 0 or not decoded:
+            raise RuntimeError(f"ffmpeg could not decode audio from the source (exit code {decoder.returncode})")
+    finally:
+        if decoder.poll() is None:
+            decoder.kill()
+        decoder.stdout.close()
+        decoder.wait()
+        if feeder is not None:
+            feeder.join()
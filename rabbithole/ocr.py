@@ -0,0 +1,183 @@
+"""rabbithole.ocr module"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterable, Iterator
+
+from rabbithole.metrics import Span, count, span_iter
+
+# Path to the tesseract binary
+TESSERACT_CMD = os.getenv("TESSERACT_CMD", "tesseract")
+
+# Tesseract language(s), e.g. "eng+deu"
+OCR_LANG = os.getenv("RABBITHOLE_OCR_LANG", "eng")
+
+# Resolution of the PDF pages rendered for OCR. Higher is more accurate on small print, and slower
+OCR_DPI = int(os.getenv("RABBITHOLE_OCR_DPI", "200"))
+
+# PDF pages with fewer characters in their text layer are OCRed if they have images
+OCR_MIN_TEXT_CHARS = 20
+
+
+def ocr_workers() -> int:
+    """
+    Get the number of OCR processes shared by every file of the process
+    :return: RABBITHOLE_OCR_WORKERS, or the number of CPUs. Processes running side by side, like the job workers,
+    each start their own pool, so the process starting them sets their share of the CPUs
+    """
+    return int(os.getenv("RABBITHOLE_OCR_WORKERS", str(os.cpu_count() or 1)))
+
+
+def tesseract_available() -> bool:
+    """Whether the tesseract binary is installed"""
+    return shutil.which(TESSERACT_CMD) is not None
+
+
+def _ocr_image(image: bytes, lang: str) -> str:
+    """OCR one encoded image. Runs in the pool processes"""
+    import pytesseract
+
+    pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+    # Tesseract reads the file as is, so the image is not decoded and encoded again on the way.
+    # It detects the format from the contents
+    with tempfile.TemporaryDirectory(prefix="rabbithole-ocr-") as temp_dir:
+        path = os.path.join(temp_dir, "image")
+        with open(path, "wb") as f:
+            f.write(image)
+        return pytesseract.image_to_string(path, lang=lang)
+
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def get_ocr_pool() -> ProcessPoolExecutor:
+    """
+    Get the process-wide OCR pool, starting it on first use
+    :return: Process pool of ocr_workers() processes
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned rather than forked, since the parent runs threads
+            _pool = ProcessPoolExecutor(max_workers=ocr_workers(), mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def ocr_ordered(items: Iterable[str | bytes], lang: str = OCR_LANG, window: int | None = None) -> Iterator[str]:
+    """
+    OCR images concurrently, passing texts through, and yield every text in input order
+    :param items: Texts, yielded as they are, and encoded images, e.g. PNG or PGM bytes, yielded as their OCR text
+    :param lang: Tesseract language(s)
+    :param window: Maximum number of images in flight. Defaults to twice the number of OCR processes
+    :return: Iterator of texts, each yielded as soon as it and every text before it are ready
+
+    Images are submitted as they are read from items, so rendering the next pages overlaps with OCR.
+    """
+    window = window or 2 * ocr_workers()
+    pending: deque[str | Future] = deque()
+    in_flight = 0
+    for item in items:
+        if isinstance(item, bytes):
+            # The pool is started by the first image, so PDFs with a text layer on every page never start it
+            pending.append(get_ocr_pool().submit(_ocr_image, item, lang))
+            in_flight += 1
+        else:
+            pending.append(item)
+
+        # Yield the texts that are ready in order, and wait for the oldest image when the window is full
+        while pending and (not isinstance(pending[0], Future) or pending[0].done() or in_flight >= window):
+            head = pending.popleft()
+            if isinstance(head, Future):
+                in_flight -= 1
+                yield head.result()
+            else:
+                yield head
+
+    for head in pending:
+        yield head.result() if isinstance(head, Future) else head
+
+
+def ocr_images(images: Iterable[bytes], lang: str = OCR_LANG) -> Iterator[str]:
+    """
+    OCR images on the process pool
+    :param images: Encoded images, e.g. the contents of uploaded .png or .jpg files
+    :param lang: Tesseract language(s)
+    :return: Iterator of texts, in image order
+    """
+    if not tesseract_available():
+        raise RuntimeError(f"OCR needs tesseract. {TESSERACT_CMD} was not found")
+
+    def texts(ocr_span: Span) -> Iterator[str]:
+        pages = 0
+        for text in ocr_ordered(images, lang=lang):
+            pages += 1
+            yield text
+        ocr_span.attributes["pages"] = pages
+        count("pages_ocr", pages)
+
+    yield from span_iter("ocr.images", texts, lang=lang)
+
+
+def needs_ocr(page) -> bool:
+    """
+    Whether a PDF page has no text layer to speak of but shows images, like a scanned page
+    :param page: fitz.Page
+    """
+    return len(page.get_text().strip()) < OCR_MIN_TEXT_CHARS and bool(page.get_images())
+
+
+def render_page(page, dpi: int = OCR_DPI) -> bytes:
+    """
+    Render a PDF page for OCR
+    :param page: fitz.Page
+    :param dpi: Resolution in dots per inch
+    :return: Grayscale PGM image, which is several times faster to encode than PNG
+    """
+    import fitz
+
+    return page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY).tobytes("pgm")
+
+
+def pdf_page_texts(data: bytes, dpi: int = OCR_DPI, lang: str = OCR_LANG) -> Iterator[str]:
+    """
+    Extract the text of every page of a PDF, OCRing the pages without a text layer
+    :param data: PDF contents
+    :param dpi: Resolution of the pages rendered for OCR
+    :param lang: Tesseract language(s)
+    :return: Iterator of page texts, in page order
+
+    Pages with a text layer are read directly. Scanned pages are rendered one after another and OCRed
+    in parallel on the process pool. Without tesseract, scanned pages are skipped with a warning.
+    """
+    import fitz
+
+    ocr = tesseract_available()
+    with fitz.open(stream=data, filetype="pdf") as pdf:
+        scanned = 0
+
+        def pages() -> Iterator[str | bytes]:
+            nonlocal scanned
+            for page in pdf:
+                if needs_ocr(page):
+                    scanned += 1
+                    if ocr:
+                        yield render_page(page, dpi)
+                        continue
+                yield page.get_text()
+
+        def texts(ocr_span: Span) -> Iterator[str]:
+            yield from ocr_ordered(pages(), lang=lang)
+            ocr_span.attributes["scanned_pages"] = scanned
+
+        yield from span_iter("ocr.pdf", texts, pages=len(pdf), dpi=dpi)
+
+        if scanned and ocr:
+            count("pages_ocr", scanned)
+        elif scanned:
+            print(f"Skipping the text of {scanned} scanned pages: OCR needs tesseract. {TESSERACT_CMD} was not found")
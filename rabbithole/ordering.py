@@ -0,0 +1,260 @@
+"""rabbithole.ordering module"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable
+
+import numpy as np
+
+from rabbithole.chunking import truncate_tokens
+from rabbithole.embedding import embed_document
+from rabbithole.metrics import in_context, span
+from rabbithole.ratelimit import retry
+from rabbithole.streaming import stream_chat
+
+# Minimum cosine similarity between two documents for the more general one to be a prerequisite of the other
+ORDERING_MIN_SIMILARITY = float(os.getenv("RABBITHOLE_ORDERING_MIN_SIMILARITY", "0.3"))
+
+# Model and number of concurrent calls of the per-document refinements
+ORDERING_MODEL = os.getenv("RABBITHOLE_ORDERING_MODEL", "gpt-3.5-turbo")
+ORDERING_CONCURRENCY = int(os.getenv("RABBITHOLE_ORDERING_CONCURRENCY", "4"))
+
+# Maximum number of summary tokens sent per refinement, which bounds the prompt size
+REFINE_SUMMARY_TOKENS = 400
+
+PLAN_SECTIONS = ("Background Concepts", "Key Concepts", "Further Reading")
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scale vectors to unit length"""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+@dataclass
+class ConceptGraph:
+    """
+    Similarity and prerequisite graph of documents and their keyword concepts
+
+    The generality of a concept is its mean similarity to every document, and that of a document the mean
+    generality of its concepts: concepts and documents related to much of the upload set are foundational,
+    those related to few are advanced. A document is a prerequisite of a
+    similar document that is less general, so the graph is acyclic by construction.
+    """
+    documents: list[str]
+    concepts: list[str]
+    keywords: dict[str, list[str]]
+    doc_similarity: np.ndarray  # (documents, documents) cosine similarities
+    affinity: np.ndarray  # (concepts, documents) cosine similarities
+    doc_generality: np.ndarray  # (documents,)
+    concept_generality: np.ndarray  # (concepts,)
+    prerequisites: dict[int, set[int]] = field(default_factory=dict)
+
+    def dependants(self, doc: int) -> list[int]:
+        """Documents that have doc as a prerequisite"""
+        return [other for other, prereqs in self.prerequisites.items() if doc in prereqs]
+
+
+def build_graph(embeddings: dict[str, np.ndarray], keywords: dict[str, list[str]],
+                embed: Callable[[list[str]], np.ndarray] = embed_document,
+                min_similarity: float = ORDERING_MIN_SIMILARITY) -> ConceptGraph:
+    """
+    Build the concept graph from the chunk embeddings and keywords of the documents
+    :param embeddings: (chunks, dim) chunk embeddings of every document
+    :param keywords: Keywords of every document. Only documents with keywords are ordered
+    :param embed: Embedding function for the keyword concepts, the same model as the chunk embeddings
+    :param min_similarity: Minimum similarity of two documents for a prerequisite edge
+    :return: Concept graph
+    """
+    documents = [name for name in keywords if name in embeddings and len(embeddings[name])]
+    doc_vectors = _normalize(np.stack([
+        _normalize(np.asarray(embeddings[name], dtype=np.float32)).mean(axis=0) for name in documents
+    ])) if documents else np.zeros((0, 0), dtype=np.float32)
+
+    concepts = list(dict.fromkeys(keyword for name in documents for keyword in keywords[name]))
+    if concepts:
+        concept_vectors = _normalize(np.asarray(embed(concepts), dtype=np.float32))
+        affinity = concept_vectors @ doc_vectors.T
+    else:
+        affinity = np.zeros((0, len(documents)), dtype=np.float32)
+
+    doc_similarity = doc_vectors @ doc_vectors.T
+    n = len(documents)
+    concept_generality = affinity.mean(axis=1) if n else np.zeros(len(concepts), dtype=np.float32)
+
+    # A document is as general as its concepts. Without keywords, use its mean similarity to the other documents
+    index = {concept: i for i, concept in enumerate(concepts)}
+    doc_generality = np.array([
+        concept_generality[[index[keyword] for keyword in keywords[name]]].mean() if keywords[name]
+        else (doc_similarity[doc].sum() - 1) / max(n - 1, 1)
+        for doc, name in enumerate(documents)
+    ], dtype=np.float32)
+
+    # The more general of two similar documents comes first. Ties go to upload order
+    prerequisites: dict[int, set[int]] = {doc: set() for doc in range(n)}
+    for a in range(n):
+        for b in range(n):
+            if a != b and doc_similarity[a, b] >= min_similarity and \
+                    (doc_generality[a], -a) > (doc_generality[b], -b):
+                prerequisites[b].add(a)
+
+    return ConceptGraph(
+        documents=documents, concepts=concepts, keywords={name: keywords[name] for name in documents},
+        doc_similarity=doc_similarity, affinity=affinity, doc_generality=doc_generality,
+        concept_generality=concept_generality, prerequisites=prerequisites,
+    )
+
+
+def topological_order(graph: ConceptGraph) -> list[int]:
+    """
+    Order the documents so that every document comes after its prerequisites
+    :param graph: Concept graph
+    :return: Document indices from foundational to advanced
+
+    Among the documents whose prerequisites are all placed, the one most similar to the last placed
+    document comes next, so related documents stay together.
+    """
+    remaining = {doc: set(prereqs) for doc, prereqs in graph.prerequisites.items()}
+    order: list[int] = []
+    while remaining:
+        ready = [doc for doc, prereqs in remaining.items() if not prereqs]
+        if order:
+            last = order[-1]
+            doc = max(ready, key=lambda d: (graph.doc_similarity[last, d], graph.doc_generality[d], -d))
+        else:
+            doc = max(ready, key=lambda d: (graph.doc_generality[d], -d))
+        order.append(doc)
+        del remaining[doc]
+        for prereqs in remaining.values():
+            prereqs.discard(doc)
+    return order
+
+
+def draft_entry(graph: ConceptGraph, doc: int, introduced: set[str], further_reading: int = 5) -> dict:
+    """
+    Split the concepts of a document into plan sections
+    :param graph: Concept graph
+    :param doc: Document index
+    :param introduced: Concepts of the documents placed before this one
+    :param further_reading: Maximum number of concepts taken from dependant documents
+    :return: {"Background Concepts", "Key Concepts", "Further Reading"} lists of concepts
+
+    Concepts already introduced and the most general third of the new ones are background.
+    Further reading points at the concepts of dependant documents closest to this one, or at the most
+    advanced third of its own concepts when nothing depends on it.
+    """
+    index = {concept: i for i, concept in enumerate(graph.concepts)}
+    own = sorted(dict.fromkeys(graph.keywords[graph.documents[doc]]),
+                 key=lambda c: -graph.concept_generality[index[c]])
+    fresh = [concept for concept in own if concept not in introduced]
+    third = len(fresh) // 3
+
+    background = [concept for concept in own if concept in introduced] + fresh[:third]
+    ahead = list(dict.fromkeys(
+        concept for other in graph.dependants(doc) for concept in graph.keywords[graph.documents[other]]
+        if concept not in own
+    ))
+    if ahead:
+        key = fresh[third:]
+        further = sorted(ahead, key=lambda c: -graph.affinity[index[c], doc])[:further_reading]
+    else:
+        key = fresh[third:len(fresh) - third]
+        further = fresh[len(fresh) - third:]
+    return {"Background Concepts": background, "Key Concepts": key, "Further Reading": further}
+
+
+def refine_entry(name: str, summary: str, draft: dict, previous: str | None = None, model: str = ORDERING_MODEL,
+                 **kwargs) -> dict:
+    """
+    Ask the LLM to correct the draft plan of one document
+    :param name: Document name
+    :param summary: Document summary. Truncated to REFINE_SUMMARY_TOKENS tokens
+    :param draft: Draft plan sections
+    :param previous: Name of the document studied before this one
+    :param model: Chat model to use
+    :param kwargs: Extra arguments of the OpenAI call, e.g. api_base
+    :return: Refined plan sections, or the draft if the response is not a valid plan
+    """
+    summary = truncate_tokens(summary, REFINE_SUMMARY_TOKENS)
+    prompt = f"""
+    Document: {name}
+    {f"Studied after: {previous}" if previous else "Studied first"}
+    Summary: {summary}
+
+    Draft study plan for this document:
+    {json.dumps(draft)}
+
+    Correct the draft: keep the concepts relevant to the document, move misplaced concepts to the right section
+    and add at most three missing background concepts. Reply only with JSON with the same three keys.
+    """
+    messages = [
+        {"role": "system", "content": "You are an experienced professor helping a student plan their studies."},
+        {"role": "user", "content": prompt},
+    ]
+    response = retry(lambda: "".join(stream_chat(messages, model=model, **kwargs)))
+
+    try:
+        refined = json.loads(response[response.find("{"):response.rfind("}") + 1])
+    except json.JSONDecodeError:
+        print(f"Keeping the draft plan of {name}: invalid refinement")
+        return draft
+    if not isinstance(refined, dict) or \
+            not all(isinstance(refined.get(section), list) for section in PLAN_SECTIONS):
+        print(f"Keeping the draft plan of {name}: invalid refinement")
+        return draft
+    return {section: [str(concept) for concept in refined[section]] for section in PLAN_SECTIONS}
+
+
+def order_plan(summaries: dict[str, str], keywords: dict[str, list[str]], embeddings: dict[str, np.ndarray],
+               refine: bool = True, embed: Callable[[list[str]], np.ndarray] = embed_document,
+               on_entry: Callable[[dict], None] | None = None, max_workers: int = ORDERING_CONCURRENCY,
+               **kwargs) -> dict:
+    """
+    Generate a study plan by ordering the documents locally from their embeddings
+    :param summaries: Summaries for each document
+    :param keywords: Keywords for each document
+    :param embeddings: Chunk embeddings for each document
+    :param refine: Correct every document's draft with a short LLM call
+    :param embed: Embedding function for the keyword concepts
+    :param on_entry: Called with each document's plan entry, in plan order, as soon as it is ready
+    :param max_workers: Number of refinements in flight
+    :param kwargs: Extra arguments of the OpenAI calls, e.g. api_base
+    :return: Plan in the format of rabbithole.planner.generate_plan
+
+    The ordering needs no LLM call. Each refinement prompt holds one document's truncated summary and
+    concepts, so planning cost grows linearly with the number of documents and no call outgrows the context.
+    """
+    with span("plan.order", planner="ordering", documents=len(keywords)):
+        graph = build_graph(embeddings, keywords, embed=embed)
+        order = topological_order(graph)
+
+    drafts = []
+    introduced: set[str] = set()
+    for doc in order:
+        drafts.append(draft_entry(graph, doc, introduced))
+        introduced.update(graph.keywords[graph.documents[doc]])
+
+    names = [graph.documents[doc] for doc in order]
+    plan = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if refine:
+            futures = [
+                executor.submit(in_context(refine_entry), name, summaries.get(name, ""), draft,
+                                previous=names[i - 1] if i else None, **kwargs)
+                for i, (name, draft) in enumerate(zip(names, drafts))
+            ]
+        for i, name in enumerate(names):
+            sections = drafts[i]
+            if refine:
+                try:
+                    sections = futures[i].result()
+                except Exception as e:
+                    print(f"Keeping the draft plan of {name}: {e}")
+            entry = {name: sections}
+            plan.append(entry)
+            if on_entry is not None:
+                on_entry(entry)
+
+    return {"plan": plan}
@@ -0,0 +1,151 @@
+"""rabbithole.pipeline module"""
+
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator
+
+import numpy as np
+
+from rabbithole.chunking import join_chunks
+from rabbithole.dedup import DEDUP, Deduplicator
+from rabbithole.embedding import embed_document
+from rabbithole.keywords import get_document_keywords
+from rabbithole.loader import iter_documents
+from rabbithole.metrics import in_context, span
+from rabbithole.summarize import summarize_document
+
+# Stages run for every file, in dependency order
+STAGES = ("load", "embed", "keywords", "summarize")
+
+
+@dataclass
+class StageEvent:
+    """Outcome of one stage for one file"""
+    file_name: str
+    stage: str
+    result: Any = None
+    error: BaseException | None = None
+    elapsed: float = 0.0
+    details: dict | None = None  # e.g. the deduplication report of a load
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class Pipeline:
+    """
+    Run load -> embed -> keywords and load -> summarize for many files at once
+
+    Stages of different files overlap on a shared thread pool. Remote calls inside the stages are
+    bounded per provider by rabbithole.ratelimit, so the pool size only caps the number of stages in flight.
+    Documents are embedded in batches while the file is still loading, so the embeddings of early
+    transcript chunks are computed while later chunks are being transcribed.
+    Chunks that nearly repeat an earlier chunk of the same file are dropped before they are embedded and
+    summarized, and those repeating a chunk of another file of the run, or of the upload with a shared
+    deduplicator, share its text and embedding.
+    """
+
+    def __init__(self, max_workers: int = 8, initializer: Callable[[], None] | None = None,
+                 load: Callable = iter_documents, embed: Callable = embed_document,
+                 keywords: Callable = get_document_keywords, summarize: Callable = summarize_document,
+                 embed_batch_size: int = 96, dedup: bool = DEDUP, deduplicator: Deduplicator | None = None):
+        """
+        :param max_workers: Maximum number of stages running at once
+        :param initializer: Called in every worker thread on start, e.g. to attach the Streamlit script context
+        :param load: file -> Iterable[Document]
+        :param embed: list[str] -> (n, dim) embeddings
+        :param keywords: embeddings -> list[str]
+        :param summarize: list[Document] -> str
+        :param embed_batch_size: Number of documents embedded per call
+        :param dedup: Drop near-duplicate chunks within a file, and merge those across the files of a run
+        :param deduplicator: Deduplicator shared by every run, e.g. a SharedDeduplicator comparing the files of an
+        upload processed by different jobs. Defaults to a new one per run
+        """
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self.load = load
+        self.embed = embed
+        self.keywords = keywords
+        self.summarize = summarize
+        self.embed_batch_size = embed_batch_size
+        self.dedup = dedup
+        self.deduplicator = deduplicator
+
+    def _load(self, file, executor: ThreadPoolExecutor,
+              deduplicator: Deduplicator | None) -> tuple[list, list[Future], int]:
+        """
+        Load a file, submitting the embedding of each batch of new documents as soon as it is complete.
+        Also returns the number of summarization inputs the dropped chunks saved
+        """
+        documents, loaded, batches, batch = [], [], [], []
+        for document in self.load(file):
+            if deduplicator is not None:
+                loaded.append(document)
+                document = deduplicator.add(document)
+                if document is None:
+                    continue
+            documents.append(document)
+            batch.append(document.page_content)
+            if len(batch) == self.embed_batch_size:
+                batches.append(executor.submit(in_context(self.embed), batch))
+                batch = []
+        if batch:
+            batches.append(executor.submit(in_context(self.embed), batch))
+
+        # Chunks are joined into larger inputs before they are summarized, so a dropped chunk saves a call
+        # only when the joined inputs are fewer without it
+        summary_calls_saved = len(join_chunks(loaded)) - len(join_chunks(documents)) if loaded else 0
+        return documents, batches, summary_calls_saved
+
+    @staticmethod
+    def _gather_embeddings(batches: list[Future]) -> np.ndarray:
+        """Concatenate the embeddings of the document batches"""
+        if not batches:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.concatenate([np.asarray(batch.result(), dtype=np.float32) for batch in batches])
+
+    def run(self, files: Iterable) -> Iterator[StageEvent]:
+        """
+        Process files and yield an event as each stage of each file finishes
+        :param files: Files to process. Each must have a unique .name
+        :return: Iterator of stage events in completion order
+
+        When a stage fails, the stages that depend on it are skipped for that file.
+        """
+        deduplicator = (self.deduplicator or Deduplicator()) if self.dedup else None
+        with ThreadPoolExecutor(max_workers=self.max_workers, initializer=self.initializer) as executor:
+            pending: dict[Future, tuple[str, str, float]] = {}
+
+            def submit(file_name: str, stage: str, func: Callable, *args):
+                def traced():
+                    with span(f"stage.{stage}", file=file_name):
+                        return func(*args)
+
+                pending[executor.submit(in_context(traced))] = (file_name, stage, time.perf_counter())
+
+            for file in files:
+                submit(file.name, "load", self._load, file, executor, deduplicator)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file_name, stage, started = pending.pop(future)
+                    error = future.exception()
+                    result = None if error else future.result()
+                    details = None
+
+                    if stage == "load" and error is None:
+                        # The embedding batches are already in flight
+                        result, batches, summary_calls_saved = result
+                        submit(file_name, "embed", self._gather_embeddings, batches)
+                        submit(file_name, "summarize", self.summarize, result)
+                        if deduplicator is not None:
+                            details = {"dedup": {**deduplicator.report(file_name),
+                                                 "summary_calls_saved": summary_calls_saved}}
+                    elif stage == "embed" and error is None:
+                        submit(file_name, "keywords", self.keywords, result)
+
+                    yield StageEvent(file_name=file_name, stage=stage, result=result, error=error,
+                                     elapsed=time.perf_counter() - started, details=details)
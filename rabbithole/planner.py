@@ -1,15 +1,23 @@
 """rabbithole.planner module"""
 
-import json
+import os
+from typing import Callable
 
-import openai
+from rabbithole.metrics import span
+from rabbithole.streaming import PlanParser, stream_chat
 
+# Study planner: "llm" (one GPT-4 prompt) or "ordering" (local ordering with per-document refinements)
+PLANNER = os.getenv("RABBITHOLE_PLANNER", "llm")
 
-def generate_plan(summaries: dict[str, str], keywords: dict[str, list[str]]) -> dict:
+
+def generate_plan(summaries: dict[str, str], keywords: dict[str, list[str]],
+                  on_entry: Callable[[dict], None] | None = None, **kwargs) -> dict:
     """
     Generate a plan from a list of summaries and keywords.
     :param summaries: Summaries for each document.
     :param keywords: List of keywords for each document.
+    :param on_entry: Called with each document's plan entry as soon as it has been generated.
+    :param kwargs: Extra arguments of the OpenAI call, e.g. api_base.
     :return: Generated plan.
     """
 
@@ -47,27 +55,26 @@ def generate_plan(summaries: dict[str, str], keywords: dict[str, list[str]]) ->
     Make sure the JSON is formatted correctly and without any errors.
     """
 
+    messages = [
+        {"role": "system",
+         "content": "You are an experienced professor helping a student plan their studies. You know everything about all subjects and need to answer factually and logically."},
+        {"role": "user", "content": prompt}
+    ]
+
     print("Making a request to OpenAI's API to generate a plan...")
+    parser = PlanParser()
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system",
-                 "content": "You are an experienced professor helping a student plan their studies. You know everything about all subjects and need to answer factually and logically."},
-                {"role": "user", "content": prompt}
-            ],
-        )
-        print(response)
+        with span("plan", planner="llm", documents=len(summaries)):
+            for delta in stream_chat(messages, model="gpt-4", **kwargs):
+                for entry in parser.feed(delta):
+                    if on_entry is not None:
+                        on_entry(entry)
+        print(parser.text)
     except Exception as e:
         print(e)
         return {
             "plan": "Error generating a plan.\nPlease try again."
         }
 
-    # Get the JSON response
-    response = response.choices[0].message.content
-    first_bracket = response.find('{')
-    last_bracket = response.rfind('}')
-
     # Convert the JSON response to a dictionary
-    return json.loads(response[first_bracket:last_bracket + 1])
+    return parser.result()
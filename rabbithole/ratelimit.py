@@ -0,0 +1,137 @@
+"""rabbithole.ratelimit module"""
+
+import os
+import random
+import threading
+import time
+from typing import Callable, TypeVar
+
+from rabbithole.metrics import count
+
+T = TypeVar("T")
+
+# Default (max concurrent calls, requests per second, burst) for each remote provider.
+# Override with RABBITHOLE_<PROVIDER>_CONCURRENCY, RABBITHOLE_<PROVIDER>_RPS and RABBITHOLE_<PROVIDER>_BURST.
+# The limits hold for all the processes started side by side, e.g. the job workers: each takes an equal share,
+# from the number of processes the starting process sets in RABBITHOLE_RATELIMIT_PROCESSES.
+PROVIDER_LIMITS: dict[str, tuple[int, float, int]] = {
+    "cohere": (4, 10.0, 10),
+    "pinecone": (8, 50.0, 50),
+    "openai": (4, 3.0, 5),
+    "whisper": (4, 1.0, 4),
+}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket
+
+    Tokens refill continuously at `rate` per second up to `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        if rate <= 0:
+            raise ValueError(f"rate must be positive. Got {rate}")
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0):
+        """
+        Take tokens from the bucket, blocking until they are available
+        :param tokens: Number of tokens to take
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ProviderLimiter:
+    """
+    Concurrency and rate limit for one remote provider
+
+    Use as a context manager around every call to the provider:
+    at most `max_concurrency` calls run at once, and calls start at no more than `rate` per second.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, rate: float, burst: int):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(rate=rate, capacity=burst)
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._semaphore.acquire()
+        try:
+            self.bucket.acquire()
+        except BaseException:
+            self._semaphore.release()
+            raise
+        count("api_calls", provider=self.name)
+        count("ratelimit_wait_seconds", time.perf_counter() - start, provider=self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._semaphore.release()
+
+
+_limiters: dict[str, ProviderLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def limit(provider: str) -> ProviderLimiter:
+    """
+    Get the shared limiter of a provider
+    :param provider: Provider name: "cohere", "pinecone", "openai" or "whisper"
+    :return: Provider limiter, shared by every thread and session of the process. Holds the share of the process
+    when several processes run side by side
+    """
+    with _limiters_lock:
+        if provider not in _limiters:
+            if provider not in PROVIDER_LIMITS:
+                raise ValueError(f"Unknown provider: {provider}")
+            concurrency, rate, burst = PROVIDER_LIMITS[provider]
+            prefix = f"RABBITHOLE_{provider.upper()}"
+            processes = max(int(os.getenv("RABBITHOLE_RATELIMIT_PROCESSES", "1")), 1)
+            _limiters[provider] = ProviderLimiter(
+                name=provider,
+                max_concurrency=max(int(os.getenv(f"{prefix}_CONCURRENCY", concurrency)) // processes, 1),
+                rate=float(os.getenv(f"{prefix}_RPS", rate)) / processes,
+                burst=max(int(os.getenv(f"{prefix}_BURST", burst)) // processes, 1),
+            )
+        return _limiters[provider]
+
+
+def retry(func: Callable[..., T], *args, max_retries: int = 3, backoff: float = 1.0,
+          retry_on: tuple[type[BaseException], ...] = (Exception,), **kwargs) -> T:
+    """
+    Call a function, retrying failures with exponential backoff and jitter
+    :param func: Function to call
+    :param args: Positional arguments of the function
+    :param max_retries: Number of retries after the first attempt
+    :param backoff: Delay before the first retry in seconds. Doubles after every retry
+    :param retry_on: Exception types that are retried. Others are raised immediately
+    :param kwargs: Keyword arguments of the function
+    :return: Return value of the function
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except retry_on as e:
+            if attempt == max_retries:
+                raise
+            delay = backoff * 2 ** attempt * (0.5 + random.random())
+            count("retries", function=getattr(func, "__name__", str(func)))
+            print(f"{getattr(func, '__name__', func)} failed ({e}). Retrying in {delay:.1f}s...")
+            time.sleep(delay)
@@ -0,0 +1,130 @@
+"""rabbithole.streaming module"""
+
+import json
+import time
+from typing import Iterator
+
+from rabbithole.chunking import count_tokens
+from rabbithole.clients import get_openai
+from rabbithole.metrics import Span, count, get_metrics, span_iter
+from rabbithole.ratelimit import limit
+
+
+def stream_chat(messages: list[dict], model: str = "gpt-4", **kwargs) -> Iterator[str]:
+    """
+    Stream the completion of a chat as it is generated
+    :param messages: Chat messages, e.g. [{"role": "user", "content": "..."}]
+    :param model: Chat model to use
+    :param kwargs: Extra arguments of openai.ChatCompletion.create, e.g. api_base to use a fake server
+    :return: Iterator of text deltas
+
+    Records the time to the first token and the total duration as the "openai.ttft_seconds" and
+    "openai.stream_seconds" metrics, and counts the prompt and completion tokens.
+    """
+    metrics = get_metrics()
+    prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+    count("tokens", prompt_tokens, model=model, kind="prompt")
+
+    def deltas(chat_span: Span) -> Iterator[str]:
+        start = time.perf_counter()
+        completion_tokens = 0
+        # The limiter slot is released once the response starts, rather than held while the consumer renders
+        with limit("openai"):
+            response = get_openai().ChatCompletion.create(model=model, messages=messages, stream=True, **kwargs)
+        for chunk in response:
+            content = chunk["choices"][0]["delta"].get("content")
+            if not content:
+                continue
+            # Every streamed delta is one token
+            completion_tokens += 1
+            if completion_tokens == 1:
+                metrics.observe("openai.ttft_seconds", time.perf_counter() - start)
+                chat_span.attributes["ttft"] = time.perf_counter() - start
+            yield content
+        metrics.observe("openai.stream_seconds", time.perf_counter() - start)
+        chat_span.attributes["completion_tokens"] = completion_tokens
+        count("tokens", completion_tokens, model=model, kind="completion")
+
+    # The span is current while the response is read, not while the consumer renders the deltas
+    yield from span_iter("openai.chat", deltas, model=model, prompt_tokens=prompt_tokens)
+
+
+class PlanParser:
+    """
+    Incremental parser of a streamed study plan: {"plan": [{"Document 1": {...}}, ...]}
+
+    Text is fed as it arrives, and every entry of the "plan" array is returned as soon as its closing
+    brace is received, so each document's section can be shown before the rest of the plan is generated.
+    Text before the opening brace, e.g. a code fence, is ignored.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.entries: list[dict] = []
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._array_depth: int | None = None
+        self._entry_start: int | None = None
+
+    def feed(self, delta: str) -> list[dict]:
+        """
+        Parse more of the response
+        :param delta: Next piece of the response text
+        :return: Plan entries completed by this piece
+        """
+        self.text += delta
+        completed = []
+        for pos in range(self._pos, len(self.text)):
+            char = self.text[pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                # The first array inside the top-level object is the plan
+                if char == "[" and self._depth == 1 and self._array_depth is None:
+                    self._array_depth = self._depth + 1
+                elif char == "{" and self._depth == self._array_depth:
+                    self._entry_start = pos
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if char == "}" and self._depth == self._array_depth and self._entry_start is not None:
+                    entry = self._parse(self.text[self._entry_start:pos + 1])
+                    if entry is not None:
+                        self.entries.append(entry)
+                        completed.append(entry)
+                    self._entry_start = None
+        self._pos = len(self.text)
+        return completed
+
+    @staticmethod
+    def _parse(text: str) -> dict | None:
+        """Parse one plan entry, skipping malformed ones"""
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError as e:
+            print(f"Skipping malformed plan entry: {e}")
+            return None
+
+    def result(self) -> dict:
+        """
+        Get the whole plan once the response is complete
+        :return: The parsed response, or the entries parsed so far if the response is not valid JSON
+        """
+        first_bracket = self.text.find("{")
+        last_bracket = self.text.rfind("}")
+        try:
+            plan = json.loads(self.text[first_bracket:last_bracket + 1])
+            if isinstance(plan, dict) and isinstance(plan.get("plan"), list):
+                return plan
+        except json.JSONDecodeError:
+            pass
+        return {"plan": list(self.entries)}
@@ -1,22 +1,242 @@
 """rabbithole.summarize module"""
 
-from langchain import OpenAI
-from langchain.chains.summarize import load_summarize_chain
-from langchain.schema import Document
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable
 
+from rabbithole.cache import content_hash, get_cache
+from rabbithole.chunking import SUMMARY_CHUNK_SIZE, count_tokens, join_chunks
+from rabbithole.clients import get_openai
+from rabbithole.metrics import count, in_context, span
+from rabbithole.ratelimit import limit, retry
 
-def summarize_document(document: list[Document]) -> str:
+# langchain is imported when the first document is summarized
+if TYPE_CHECKING:
+    from langchain.llms.base import BaseLLM
+    from langchain.prompts import PromptTemplate
+    from langchain.schema import Document
+
+# Summarization mode: "refine" (sequential) or "map_reduce" (parallel)
+SUMMARY_MODE = os.getenv("RABBITHOLE_SUMMARY_MODE", "refine")
+
+# Maximum number of LLM calls in flight per document in map_reduce mode
+SUMMARY_CONCURRENCY = int(os.getenv("RABBITHOLE_SUMMARY_CONCURRENCY", "4"))
+
+# Context window of the summarization model in tokens, for LLMs that do not tell theirs
+SUMMARY_CONTEXT_TOKENS = 4097
+
+
+def _complete(llm: "BaseLLM", prompt: str, prompt_tokens: int) -> str:
+    """Run one completion, holding a slot of the OpenAI limiter for this call only, and retrying failures"""
+    def attempt() -> str:
+        with span("openai.completion", prompt_tokens=prompt_tokens), limit("openai"):
+            count("tokens", prompt_tokens, model=getattr(llm, "model_name", llm._llm_type), kind="prompt")
+            return llm(prompt).strip()
+
+    return retry(attempt)
+
+
+def _summarize_text(llm: "BaseLLM", text: str, text_tokens: int | None = None) -> str:
+    """Summarize one text with the map-reduce prompt, retrying failures. Texts of known length are not counted"""
+    from langchain.chains.summarize import map_reduce_prompt
+
+    prompt = map_reduce_prompt.PROMPT.format(text=text)
+    prompt_tokens = count_tokens(prompt) if text_tokens is None else _prompt_tokens() + text_tokens
+    return _complete(llm, prompt, prompt_tokens)
+
+
+_template_tokens: dict[str, int] = {}
+
+
+def _prompt_tokens(template: "PromptTemplate | None" = None) -> int:
+    """Number of tokens of a summarization prompt without its inputs. Defaults to the map-reduce prompt"""
+    if template is None:
+        from langchain.chains.summarize import map_reduce_prompt
+
+        template = map_reduce_prompt.PROMPT
+    if template.template not in _template_tokens:
+        _template_tokens[template.template] = count_tokens(
+            template.format(**{name: "" for name in template.input_variables})
+        )
+    return _template_tokens[template.template]
+
+
+def _chunk_budget(llm: "BaseLLM", mode: str) -> int:
+    """
+    Maximum number of tokens of the text summarized per call, counted with the tokenizer of the LLM
+    :param llm: LLM to use
+    :param mode: "refine" or "map_reduce"
+    :return: The context window of the LLM minus the longest prompt without its inputs, the completion and,
+    in refine mode, the running summary, which is a completion too
+    """
+    from langchain.chains.summarize import map_reduce_prompt, refine_prompts
+
+    try:
+        context_tokens = llm.modelname_to_contextsize(llm.model_name)
+    except (AttributeError, ValueError):
+        context_tokens = SUMMARY_CONTEXT_TOKENS
+    completion_tokens = getattr(llm, "max_tokens", 256)
+    if mode == "map_reduce":
+        templates, answer_tokens = [map_reduce_prompt.PROMPT], 0
+    else:
+        templates, answer_tokens = [refine_prompts.PROMPT, refine_prompts.REFINE_PROMPT], completion_tokens
+    prompt_tokens = max(llm.get_num_tokens(template.format(**{name: "" for name in template.input_variables}))
+                        for template in templates)
+    return context_tokens - prompt_tokens - answer_tokens - completion_tokens
+
+
+def _fit_chunks(llm: "BaseLLM", document: list["Document"], chunk_size: int, budget: int) -> list["Document"]:
+    """
+    Join consecutive chunks of the loader, shrinking the window until every joined chunk fits the budget
+    :param llm: LLM to use
+    :param document: Chunks of one file in order, with the token metadata of the loader
+    :param chunk_size: Maximum number of tokens per joined chunk, in the encoding of the loader
+    :param budget: Maximum number of tokens per joined chunk, counted with the tokenizer of the LLM
+    :return: Joined chunks
+
+    The tokenizer of the LLM may count more tokens than the encoding of the loader, e.g. p50k_base for
+    text-davinci-003 against cl100k_base.
+    """
+    chunk_size = min(chunk_size, budget)
+    while True:
+        joined = join_chunks(document, chunk_size)
+        longest = max((llm.get_num_tokens(doc.page_content) for doc in joined), default=0)
+        # Chunks that are not joined are not cut again
+        if longest <= budget or len(joined) == len(document):
+            return joined
+        chunk_size = int(chunk_size * budget / longest)
+
+
+def _group_by_budget(summaries: list[str], token_budget: int,
+                     counter: Callable[[str], int] = count_tokens) -> list[list[str]]:
     """
-    Summarize a document using the langchain summarize chain
+    Group consecutive summaries so that each group fits the token budget
+    :param summaries: Summaries to group
+    :param token_budget: Maximum number of tokens per group
+    :param counter: Function counting the tokens of a summary, e.g. the get_num_tokens of the LLM
+    :return: Groups of summaries. Every group has at least two summaries, unless there is only one summary,
+    so each reduce round makes progress
+    """
+    groups: list[list[str]] = []
+    group: list[str] = []
+    group_tokens = 0
+    for summary in summaries:
+        tokens = counter(summary)
+        if len(group) >= 2 and group_tokens + tokens > token_budget:
+            groups.append(group)
+            group, group_tokens = [], 0
+        group.append(summary)
+        group_tokens += tokens
+
+    # Merge a trailing singleton into the previous group
+    if len(group) == 1 and groups:
+        groups[-1].extend(group)
+    elif group:
+        groups.append(group)
+    return groups
+
+
+def map_reduce_summarize(llm: "BaseLLM", document: list["Document"], max_concurrency: int = SUMMARY_CONCURRENCY,
+                         token_budget: int | None = None) -> str:
+    """
+    Summarize the chunks of a document concurrently, then merge the summaries hierarchically
+    :param llm: LLM to use
+    :param document: Document chunks to summarize
+    :param max_concurrency: Maximum number of LLM calls in flight
+    :param token_budget: Maximum number of summary tokens merged per call, counted with the tokenizer of the LLM.
+    Defaults to the context window minus the prompt and the completion length
+    :return: Summarized text
+
+    N chunks take about log(N) rounds of dependent calls instead of the N calls of the refine chain.
+    """
+    if token_budget is None:
+        token_budget = _chunk_budget(llm, "map_reduce")
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        # Map: summarize every chunk
+        summaries = list(executor.map(
+            in_context(lambda doc: _summarize_text(llm, doc.page_content, doc.metadata.get("tokens"))), document
+        ))
+
+        # Reduce: merge groups of summaries that fit the budget until one is left
+        while len(summaries) > 1:
+            groups = _group_by_budget(summaries, token_budget, llm.get_num_tokens)
+            summaries = list(executor.map(in_context(lambda group: _summarize_text(llm, "\n\n".join(group))),
+                                          groups))
+
+    return summaries[0] if summaries else ""
+
+
+def refine_summarize(llm: "BaseLLM", document: list["Document"]) -> str:
+    """
+    Summarize the chunks of a document one after another, refining the summary with each chunk,
+    with the prompts of langchain's refine chain
+    :param llm: LLM to use
+    :param document: Document chunks to summarize
+    :return: Summarized text
+
+    Every call takes its own slot of the OpenAI limiter, so the calls of a long document are paced by the
+    rate limit and leave room for the calls of other files in between.
+    """
+    from langchain.chains.summarize import refine_prompts
+
+    summary = ""
+    for number, doc in enumerate(document):
+        text_tokens = doc.metadata.get("tokens")
+        if number == 0:
+            template, inputs = refine_prompts.PROMPT, {"text": doc.page_content}
+        else:
+            template, inputs = refine_prompts.REFINE_PROMPT, {"existing_answer": summary, "text": doc.page_content}
+        prompt = template.format(**inputs)
+        prompt_tokens = count_tokens(prompt) if text_tokens is None else \
+            _prompt_tokens(template) + text_tokens + count_tokens(inputs.get("existing_answer", ""))
+        summary = _complete(llm, prompt, prompt_tokens)
+    return summary
+
+
+def summarize_document(document: list["Document"], mode: str = SUMMARY_MODE, llm: "BaseLLM | None" = None,
+                       chunk_size: int = SUMMARY_CHUNK_SIZE) -> str:
+    """
+    Summarize a document with the prompts of the langchain summarize chains
 
     :param document: Document to summarize.
     It must be a list of langchain.schema.Document objects
+    :param mode: "refine" to refine the summary with each chunk in turn,
+    "map_reduce" to summarize the chunks in parallel and merge the summaries
+    :param llm: LLM to use. Defaults to OpenAI. Results are cached for the default LLM only
+    :param chunk_size: Maximum number of tokens summarized per call. Consecutive chunks of the loader
+    are joined up to this size, from their token metadata, and less if the joined chunks do not fit the context
+    window of the LLM with the prompt, the running summary and the completion
 
     :return: Summarized text
+
+    Summaries are cached by model, mode and chunk texts.
     """
+    if mode not in ("refine", "map_reduce"):
+        raise ValueError(f"Unsupported summary mode: {mode}")
+
+    from langchain import OpenAI
+
+    cache = None
+    if llm is None:
+        # Send the completions through the shared HTTP session
+        get_openai()
+        llm = OpenAI()
+        cache = get_cache()
+
+    document = _fit_chunks(llm, document, chunk_size, _chunk_budget(llm, mode))
+    if cache is not None:
+        key = content_hash(llm.model_name, mode, *[doc.page_content for doc in document])
+        cached = cache.get("summary", key)
+        if cached is not None:
+            return cached.decode("utf-8")
 
-    llm = OpenAI()
-    chain = load_summarize_chain(llm, chain_type="refine", verbose=True)
-    summary = chain.run(document)
+    with span("summarize", mode=mode, chunks=len(document)):
+        if mode == "map_reduce":
+            summary = map_reduce_summarize(llm, document)
+        else:
+            summary = refine_summarize(llm, document)
 
+    if cache is not None:
+        cache.set("summary", key, summary.encode("utf-8"))
     return summary
@@ -1,26 +1,118 @@
 """rabbithole.transcribe module"""
 
-import openai
-from tqdm import tqdm
+import io
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Callable, Iterable, Iterator
 
-from rabbithole.mp3 import chunk_mp3
+from rabbithole.cache import content_hash, get_cache
+from rabbithole.clients import get_openai
+from rabbithole.metrics import count, in_context, span
+from rabbithole.mp3 import stream_chunks
+from rabbithole.ratelimit import limit, retry
 
+# Transcribes an open audio file to text
+Transcriber = Callable[[BinaryIO], str]
 
-def transcribe(filepath: str) -> str:
+
+def whisper_transcriber(audio_file: BinaryIO) -> str:
     """
-    Transcribe a mp3 file using OpenAI's Whisper API
-    :param filepath: Path to mp3 file
+    Transcribe an audio file using OpenAI's Whisper API
+    :param audio_file: Open audio file
     :return: Transcription
+
+    Transcriptions are cached by the audio bytes.
     """
+    data = audio_file.read()
+    cache = get_cache()
+    key = content_hash("whisper-1", data)
+    cached = cache.get("transcript", key)
+    if cached is not None:
+        return cached.decode("utf-8")
+
+    buffer = io.BytesIO(data)
+    buffer.name = os.path.basename(getattr(audio_file, "name", "audio.mp3"))
+    with limit("whisper"):
+        transcript = get_openai().Audio.transcribe("whisper-1", buffer)
+
+    text = transcript.get("text", "")
+    cache.set("transcript", key, text.encode("utf-8"))
+    return text
+
+
+def _transcribe_chunk(chunk: str | BinaryIO, transcriber: Transcriber, max_retries: int) -> str:
+    """Transcribe one audio chunk, a path or an in-memory file, retrying failures"""
 
-    # Split the file into chunks
-    files = chunk_mp3(filepath)
+    def attempt() -> str:
+        if not isinstance(chunk, str):
+            chunk.seek(0)
+            return transcriber(chunk)
+        with open(chunk, "rb") as audio_file:
+            return transcriber(audio_file)
 
-    transcripts: list[str] = []
+    size = os.path.getsize(chunk) if isinstance(chunk, str) else len(chunk.getvalue())
+    with span("transcribe.chunk", bytes=size):
+        count("bytes_processed", size, stage="transcribe")
+        return retry(attempt, max_retries=max_retries)
+
+
+def transcribe_chunks(chunks: Iterable[str | BinaryIO], transcriber: Transcriber | None = None,
+                      max_workers: int = 4, max_retries: int = 3) -> Iterator[str]:
+    """
+    Transcribe audio chunks concurrently and yield their transcripts in order
+    :param chunks: Audio chunks, as paths or in-memory files, in playback order
+    :param transcriber: Transcriber to use. Defaults to the Whisper API
+    :param max_workers: Number of chunks transcribed at once
+    :param max_retries: Number of retries of a failed chunk
+    :return: Iterator of chunk transcripts, in chunk order
+
+    Each transcript is yielded as soon as it and every chunk before it are done.
+    Chunks are pulled from the iterable as workers free up, so a lazy chunker keeps
+    at most about 2 * max_workers chunks in memory.
+    """
+    transcriber = transcriber or whisper_transcriber
+    chunks = iter(chunks)
 
-    for file in tqdm(files, desc="Transcribing audio", unit="chunk"):
-        with open(file, "rb") as audio_file:
-            transcript = openai.Audio.transcribe("whisper-1", audio_file)
-            transcripts.append(transcript.get("text", ""))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures: deque[Future] = deque()
+        try:
+            for chunk in chunks:
+                futures.append(executor.submit(in_context(_transcribe_chunk), chunk, transcriber, max_retries))
+                if len(futures) >= 2 * max_workers:
+                    yield futures.popleft().result()
+                # Yield the transcripts that are already done without waiting
+                while futures and futures[0].done():
+                    yield futures.popleft().result()
 
-    return " ".join(transcripts)
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def transcribe_iter(filepath: str, transcriber: Transcriber | None = None,
+                    max_workers: int = 4, max_retries: int = 3) -> Iterator[str]:
+    """
+    Transcribe a video or audio file and yield the transcript segment by segment
+    :param filepath: Path to the video or audio file
+    :param transcriber: Transcriber to use. Defaults to the Whisper API
+    :param max_workers: Number of chunks transcribed at once
+    :param max_retries: Number of retries of a failed chunk
+    :return: Iterator of transcript segments, in order
+    """
+    # Decode the file once and split it into in-memory mp3 chunks as it is read
+    chunks = stream_chunks(filepath)
+
+    yield from transcribe_chunks(chunks, transcriber=transcriber, max_workers=max_workers, max_retries=max_retries)
+
+
+def transcribe(filepath: str, transcriber: Transcriber | None = None) -> str:
+    """
+    Transcribe a video or audio file using OpenAI's Whisper API
+    :param filepath: Path to the video or audio file
+    :param transcriber: Transcriber to use. Defaults to the Whisper API
+    :return: Transcription
+    """
+    return " ".join(transcribe_iter(filepath, transcriber=transcriber))
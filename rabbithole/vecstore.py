@@ -1,8 +1,282 @@
 """rabbithole.vecstore module"""
 
+import json
 import os
+import shutil
+from pathlib import Path
 
-import pinecone
+import numpy as np
 
-pinecone.init(api_key=os.getenv("PINECONE_API_KEY"), environment="us-west4-gcp")
-index = pinecone.Index("rabbithole")
+from rabbithole.cache import content_hash, get_cache
+from rabbithole.metrics import span
+from rabbithole.ratelimit import limit
+
+# Vector store backend used for keyword queries: "pinecone", "local" or "ivfpq"
+VECSTORE_BACKEND = os.getenv("RABBITHOLE_VECSTORE", "pinecone")
+
+# Directory of the local memory-mapped index
+LOCAL_INDEX_DIR = os.getenv("RABBITHOLE_LOCAL_INDEX", "data/wikipedia")
+
+# Number of corpus rows scored per matrix multiply in the local index
+LOCAL_BLOCK_SIZE = 65536
+
+
+class LocalIndex:
+    """
+    Local memory-mapped vector index
+
+    The index is a directory holding:
+    - embeddings.npy: (n, dim) float32 or float16 matrix, opened memory-mapped
+    - metadata.jsonl: One {"id", "title", "url"} object per matrix row
+
+    Vectors are scored by dot product, matching the Cohere embeddings.
+    """
+
+    def __init__(self, path: str | Path):
+        path = Path(path)
+        self.path = path
+        self.embeddings = np.load(path / "embeddings.npy", mmap_mode="r")
+
+        self.ids: list[str] = []
+        self.metadata: list[dict] = []
+        with open(path / "metadata.jsonl", "r", encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                self.ids.append(row.pop("id"))
+                self.metadata.append(row)
+
+        if len(self.ids) != self.embeddings.shape[0]:
+            raise ValueError(
+                f"Index at {path} has {self.embeddings.shape[0]} vectors but {len(self.ids)} metadata rows"
+            )
+
+    def __len__(self) -> int:
+        return self.embeddings.shape[0]
+
+    def search(self, vectors, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the top_k highest scoring rows for every query vector
+        :param vectors: (m, dim) query vectors
+        :param top_k: Number of results per query
+        :return: (scores, indices) arrays of shape (m, top_k), sorted by descending score
+        """
+        queries = np.asarray(vectors, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+
+        top_k = min(top_k, len(self))
+        best_scores = np.full((queries.shape[0], 0), -np.inf, dtype=np.float32)
+        best_indices = np.empty((queries.shape[0], 0), dtype=np.int64)
+
+        # Score the corpus block by block to bound memory and page in the memmap sequentially
+        for start in range(0, len(self), LOCAL_BLOCK_SIZE):
+            block = np.asarray(self.embeddings[start: start + LOCAL_BLOCK_SIZE], dtype=np.float32)
+            scores = queries @ block.T
+
+            k = min(top_k, scores.shape[1])
+            part = np.argpartition(scores, -k, axis=1)[:, -k:]
+
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, part, axis=1)], axis=1)
+            best_indices = np.concatenate([best_indices, part + start], axis=1)
+
+            if best_scores.shape[1] > top_k:
+                keep = np.argpartition(best_scores, -top_k, axis=1)[:, -top_k:]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_indices = np.take_along_axis(best_indices, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_indices, order, axis=1)
+
+    def query(self, vectors, top_k: int) -> list[list[dict]]:
+        """
+        Query the index with a batch of vectors
+        :param vectors: (m, dim) query vectors
+        :param top_k: Number of matches per query
+        :return: Pinecone-style matches ({"id", "score", "metadata"}) for every query
+        """
+        scores, indices = self.search(vectors, top_k)
+        return [
+            [
+                {"id": self.ids[i], "score": float(score), "metadata": self.metadata[i]}
+                for score, i in zip(row_scores, row_indices)
+            ]
+            for row_scores, row_indices in zip(scores.tolist(), indices.tolist())
+        ]
+
+
+class LocalIndexWriter:
+    """
+    Write a LocalIndex directory batch by batch, in any order
+
+    Vectors go straight into a preallocated memory-mapped embeddings.npy. The metadata of each batch
+    is written to its own part file and the parts are joined into metadata.jsonl on close.
+    Reopening an unfinished index keeps the batches already written, so interrupted builds can resume.
+    """
+
+    def __init__(self, path: str | Path, num_vectors: int, dim: int, dtype: str = "float16"):
+        """
+        :param path: Directory of the index
+        :param num_vectors: Total number of vectors in the index
+        :param dim: Dimension of the vectors
+        :param dtype: Storage dtype: "float16" or "float32"
+        """
+        self.path = Path(path)
+        self.parts = self.path / "metadata.parts"
+        self.parts.mkdir(parents=True, exist_ok=True)
+        self.num_vectors = num_vectors
+
+        vectors_path = self.path / "embeddings.npy"
+        shape = (num_vectors, dim)
+        if vectors_path.exists():
+            self._vectors = np.lib.format.open_memmap(vectors_path, mode="r+")
+            if self._vectors.shape != shape or self._vectors.dtype != np.dtype(dtype):
+                raise ValueError(
+                    f"Existing index at {self.path} is {self._vectors.dtype}{self._vectors.shape}. "
+                    f"Expected {np.dtype(dtype)}{shape}"
+                )
+        else:
+            self._vectors = np.lib.format.open_memmap(vectors_path, mode="w+", dtype=dtype, shape=shape)
+
+    def write(self, start: int, ids: list[str], vectors, metadatas: list[dict]):
+        """
+        Write a batch of vectors at a row offset
+        :param start: Row of the first vector
+        :param ids: Vector IDs
+        :param vectors: (n, dim) vectors
+        :param metadatas: Metadata for each vector
+        """
+        vectors = np.asarray(vectors, dtype=self._vectors.dtype)
+        if vectors.shape != (len(ids), self._vectors.shape[1]):
+            raise ValueError(f"Expected vectors of shape {(len(ids), self._vectors.shape[1])}. Got {vectors.shape}")
+        if start + len(ids) > self.num_vectors:
+            raise ValueError(f"Rows {start}-{start + len(ids)} are out of range for {self.num_vectors} vectors")
+
+        self._vectors[start: start + len(ids)] = vectors
+
+        # Write the part atomically so an interrupted write never leaves a truncated part behind
+        part = self.parts / f"{start:012d}.jsonl"
+        with open(part.with_suffix(".tmp"), "w", encoding="utf-8") as f:
+            for vec_id, metadata in zip(ids, metadatas):
+                f.write(json.dumps({"id": str(vec_id), **metadata}) + "\n")
+        os.replace(part.with_suffix(".tmp"), part)
+
+    def close(self):
+        """Flush the vectors and join the metadata parts into metadata.jsonl"""
+        self._vectors.flush()
+        del self._vectors
+
+        rows = 0
+        with open(self.path / "metadata.jsonl", "w", encoding="utf-8") as out:
+            for part in sorted(self.parts.glob("*.jsonl")):
+                if int(part.stem) != rows:
+                    raise ValueError(f"Index at {self.path} is missing rows {rows}-{int(part.stem)}")
+                with open(part, "r", encoding="utf-8") as f:
+                    for line in f:
+                        out.write(line)
+                        rows += 1
+
+        if rows != self.num_vectors:
+            raise ValueError(f"Index at {self.path} has {rows} of {self.num_vectors} metadata rows")
+        shutil.rmtree(self.parts)
+
+
+_index = None
+
+
+def get_index():
+    """
+    Get the Pinecone index, initializing the client on first use
+    :return: Pinecone index
+    """
+    global _index
+    if _index is None:
+        import pinecone
+
+        pinecone.init(api_key=os.getenv("PINECONE_API_KEY"), environment="us-west4-gcp")
+        _index = pinecone.Index("rabbithole")
+    return _index
+
+
+_local_index: LocalIndex | None = None
+
+
+def get_local_index() -> LocalIndex:
+    """
+    Get the local index, memory-mapping it on first use
+    :return: Local index
+    """
+    global _local_index
+    if _local_index is None:
+        _local_index = LocalIndex(LOCAL_INDEX_DIR)
+    return _local_index
+
+
+_ann_index = None
+
+
+def get_ann_index():
+    """
+    Get the IVF-PQ index stored next to the local index, loading it on first use
+    :return: IVF-PQ index
+    """
+    global _ann_index
+    if _ann_index is None:
+        from rabbithole.ann import IVFPQIndex
+
+        _ann_index = IVFPQIndex.load(Path(LOCAL_INDEX_DIR) / "ivfpq", exact=get_local_index())
+    return _ann_index
+
+
+def _query_pinecone(vectors, top_k: int, namespace: str) -> list[list[dict]]:
+    """
+    Query Pinecone one vector at a time, caching the matches of every vector
+    :param vectors: Query vectors
+    :param top_k: Number of matches per query
+    :param namespace: Pinecone namespace to query
+    :return: Matches ({"id", "score", "metadata"}) for every query vector
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    cache = get_cache()
+    keys = [content_hash("pinecone", namespace, str(top_k), vector.tobytes()) for vector in vectors]
+    cached = cache.get_many("pinecone", keys)
+
+    results = []
+    for key, vector in zip(keys, vectors):
+        if key not in cached:
+            with span("pinecone.query", top_k=top_k), limit("pinecone"):
+                result = get_index().query(
+                    vector=vector.tolist(),
+                    top_k=top_k,
+                    include_values=False,
+                    include_metadata=True,
+                    namespace=namespace
+                )
+            matches = [
+                {"id": match.get("id"), "score": match.get("score"), "metadata": dict(match.get("metadata") or {})}
+                for match in result.get("matches", [])
+            ]
+            cached[key] = json.dumps(matches).encode("utf-8")
+            cache.set("pinecone", key, cached[key])
+        results.append(json.loads(cached[key]))
+    return results
+
+
+def query(vectors, top_k: int, namespace: str = "wikipedia") -> list[list[dict]]:
+    """
+    Query the configured vector store with a batch of vectors
+    :param vectors: Query vectors
+    :param top_k: Number of matches per query
+    :param namespace: Pinecone namespace to query
+    :return: Matches ({"id", "score", "metadata"}) for every query vector
+    """
+    with span("vecstore.query", backend=VECSTORE_BACKEND, vectors=len(vectors), top_k=top_k):
+        if VECSTORE_BACKEND == "local":
+            return get_local_index().query(vectors, top_k=top_k)
+
+        if VECSTORE_BACKEND == "ivfpq":
+            return get_ann_index().query(vectors, top_k=top_k)
+
+        if VECSTORE_BACKEND == "pinecone":
+            return _query_pinecone(vectors, top_k=top_k, namespace=namespace)
+
+    raise ValueError(f"Unsupported vector store backend: {VECSTORE_BACKEND}")
@@ -1,38 +1,264 @@
 """rabbithole.wikipedia module"""
 
-from datasets import load_dataset
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from datasets import load_dataset, load_dataset_builder
 from tqdm import tqdm
 
-from rabbithole.vecstore import index
+from rabbithole.ann import build_ivfpq
+from rabbithole.ratelimit import limit, retry
+from rabbithole.vecstore import LOCAL_INDEX_DIR, LocalIndexWriter, get_index
+
+WIKIPEDIA_DATASET = "Cohere/wikipedia-22-12-simple-embeddings"
+WIKIPEDIA_EMBEDDING_DIM = 768
+
+
+class PineconeSink:
+    """Upsert batches into a Pinecone-compatible index"""
+
+    def __init__(self, index=None, namespace: str = "wikipedia"):
+        """
+        :param index: Index with an upsert(vectors, namespace) method. Defaults to the Pinecone index
+        :param namespace: Namespace to upsert into
+        """
+        self.index = index
+        self.namespace = namespace
+
+    def write(self, start: int, rows: list[dict]):
+        """
+        Upsert a batch of dataset rows
+        :param start: Position of the first row in the dataset
+        :param rows: Dataset rows with "id", "emb", "title" and "url"
+        """
+        vectors = [
+            (
+                str(row["id"]),  # Vector ID
+                row["emb"],  # Dense vector values
+                {"title": row["title"], "url": row["url"]}  # Vector metadata
+            )
+            for row in rows
+        ]
+        with limit("pinecone"):
+            (self.index or get_index()).upsert(vectors=vectors, namespace=self.namespace)
+
+    def close(self):
+        pass
+
+
+class LocalIndexSink:
+    """Write batches into a local memory-mapped index"""
+
+    def __init__(self, path: str, num_vectors: int, dim: int = WIKIPEDIA_EMBEDDING_DIM, dtype: str = "float16"):
+        self.writer = LocalIndexWriter(path, num_vectors=num_vectors, dim=dim, dtype=dtype)
+
+    def write(self, start: int, rows: list[dict]):
+        """
+        Write a batch of dataset rows at their position in the dataset
+        :param start: Position of the first row in the dataset
+        :param rows: Dataset rows with "id", "emb", "title" and "url"
+        """
+        self.writer.write(
+            start,
+            ids=[row["id"] for row in rows],
+            vectors=[row["emb"] for row in rows],
+            metadatas=[{"title": row["title"], "url": row["url"]} for row in rows],
+        )
+
+    def close(self):
+        self.writer.close()
+
+
+class Checkpoint:
+    """
+    Set of completed batches, saved to a JSON file after every batch
+
+    The file also records the run settings, so a checkpoint is never resumed with a different batch layout.
+    """
+
+    def __init__(self, path: str | Path, settings: dict):
+        self.path = Path(path)
+        self.settings = settings
+        self.done: set[int] = set()
+        self._lock = threading.Lock()
+
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("settings") != settings:
+                raise ValueError(
+                    f"Checkpoint {self.path} was written with {state.get('settings')}, not {settings}. "
+                    "Delete it to start over."
+                )
+            self.done = set(state["done"])
+
+    def contiguous(self) -> int:
+        """
+        Get the number of leading batches that are all done
+        :return: Index of the first batch not done
+        """
+        batch = 0
+        while batch in self.done:
+            batch += 1
+        return batch
+
+    def mark_done(self, batch: int):
+        """
+        Record a completed batch
+        :param batch: Batch index
+        """
+        with self._lock:
+            self.done.add(batch)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temp = self.path.with_suffix(".tmp")
+            with open(temp, "w", encoding="utf-8") as f:
+                json.dump({"settings": self.settings, "done": sorted(self.done)}, f)
+            os.replace(temp, self.path)
 
 
-def prepare_wikipedia_collection(batch_size: int = 500):
+def batched(rows: Iterable[dict], batch_size: int) -> Iterator[list[dict]]:
+    """
+    Group rows into lists of batch_size
+    :param rows: Rows to group
+    :param batch_size: Number of rows per batch
+    :return: Iterator of batches. The last one may be shorter
+    """
+    rows = iter(rows)
+    while batch := list(islice(rows, batch_size)):
+        yield batch
+
+
+def bulk_load(rows: Iterable[dict], sink, batch_size: int = 500, workers: int = 8,
+              checkpoint: Checkpoint | None = None, max_retries: int = 5, total: int | None = None) -> dict:
+    """
+    Write rows to a sink in concurrent batches, skipping and recording completed batches
+    :param rows: Rows to write, in a stable order. When resuming, rows of completed leading batches
+    are expected to be skipped by the caller (see Checkpoint.contiguous) and are not counted here
+    :param sink: Sink with write(start, rows) and close() methods
+    :param batch_size: Number of rows per batch
+    :param workers: Number of batches written at once
+    :param checkpoint: Checkpoint to skip and record completed batches
+    :param max_retries: Number of retries of a failed batch
+    :param total: Total number of rows, for the progress bar
+    :return: {"vectors", "seconds", "vectors_per_second", "failed"} statistics of this run
+
+    Failed batches are reported and left out of the checkpoint, so the next run retries them.
+    The sink is only closed when every batch succeeded.
+    """
+    first_batch = checkpoint.contiguous() if checkpoint else 0
+    in_flight = threading.BoundedSemaphore(workers * 2)
+    failed: list[int] = []
+    written = 0
+    lock = threading.Lock()
+
+    def write(batch_index: int, batch: list[dict]):
+        nonlocal written
+        try:
+            retry(sink.write, batch_index * batch_size, batch, max_retries=max_retries)
+        except Exception as e:
+            print(f"Batch {batch_index} failed: {e}")
+            with lock:
+                failed.append(batch_index)
+            return
+        finally:
+            in_flight.release()
+
+        if checkpoint:
+            checkpoint.mark_done(batch_index)
+        with lock:
+            written += len(batch)
+        pbar.update(len(batch))
+
+    start_time = time.perf_counter()
+    with tqdm(total=total, initial=first_batch * batch_size, desc="Writing vectors", unit="vectors") as pbar, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        futures: list[Future] = []
+        for batch_index, batch in enumerate(batched(rows, batch_size), start=first_batch):
+            if checkpoint and batch_index in checkpoint.done:
+                pbar.update(len(batch))
+                continue
+            # Bound the number of batches held in memory
+            in_flight.acquire()
+            futures.append(executor.submit(write, batch_index, batch))
+        for future in futures:
+            future.result()
+
+    seconds = time.perf_counter() - start_time
+    if not failed:
+        sink.close()
+
+    stats = {"vectors": written, "seconds": seconds, "vectors_per_second": written / seconds if seconds else 0.0,
+             "failed": sorted(failed)}
+    print(f"Wrote {written} vectors in {seconds:.1f}s ({stats['vectors_per_second']:.0f} vectors/sec)")
+    if failed:
+        print(f"{len(failed)} batches failed: {sorted(failed)}. Run again to resume.")
+    return stats
+
+
+def prepare_wikipedia_collection(batch_size: int = 500, target: str = "pinecone",
+                                 local_dir: str = LOCAL_INDEX_DIR, dtype: str = "float16",
+                                 workers: int = 8, checkpoint_path: str | None = None) -> dict:
     """
     Prepare the wikipedia collection
     :param batch_size: Batch size to use when adding documents to the collection
-    :return: The wikipedia collection
+    :param target: Where to write the collection: "pinecone", "local" or "ivfpq".
+    "ivfpq" writes the local index and then builds the IVF-PQ index from it
+    :param local_dir: Directory of the local index (local targets only)
+    :param dtype: Storage dtype of the local index: "float16" or "float32" (local targets only)
+    :param workers: Number of batches written at once
+    :param checkpoint_path: Progress file. Defaults to <local_dir>/<target>.checkpoint.json.
+    An interrupted run resumes from it
+    :return: Load statistics
 
     NOTE: Only needs to be run once to prepare the collection for the first time
     """
-    wikipedia_dataset = load_dataset("Cohere/wikipedia-22-12-simple-embeddings", split="train", streaming=False)
-    print(f"Loaded Wikipedia dataset: {wikipedia_dataset.info}\n")
-
-    total_rows = len(wikipedia_dataset)
-    with tqdm(total=total_rows, desc='Processing batches', unit='vectors') as pbar:
-        for i in range(0, total_rows, batch_size):
-            batch_data = wikipedia_dataset[i: i + batch_size]
-            vectors = [
-                (
-                    str(emb_id),  # Vector ID
-                    emb,  # Dense vector values
-                    {"title": title, "url": url}  # Vector metadata
-                )
-                for emb_id, emb, title, url in
-                zip(batch_data["id"], batch_data["emb"], batch_data["title"], batch_data["url"])
-            ]
-            index.upsert(vectors=vectors, namespace="wikipedia")
-            pbar.update(batch_size)
+    if target not in ("pinecone", "local", "ivfpq"):
+        raise ValueError(f"Unsupported target: {target}")
+
+    total_rows = load_dataset_builder(WIKIPEDIA_DATASET).info.splits["train"].num_examples
+    print(f"Streaming {total_rows} vectors from {WIKIPEDIA_DATASET}\n")
+
+    if target == "pinecone":
+        sink = PineconeSink()
+    else:
+        sink = LocalIndexSink(local_dir, num_vectors=total_rows, dtype=dtype)
+
+    checkpoint = Checkpoint(
+        checkpoint_path or os.path.join(local_dir, f"{target}.checkpoint.json"),
+        settings={"dataset": WIKIPEDIA_DATASET, "target": target, "batch_size": batch_size,
+                  "dtype": dtype if target != "pinecone" else None},
+    )
+
+    # Stream the dataset, skipping the leading batches a previous run completed
+    dataset = load_dataset(WIKIPEDIA_DATASET, split="train", streaming=True)
+    dataset = dataset.skip(checkpoint.contiguous() * batch_size)
+
+    stats = bulk_load(dataset, sink, batch_size=batch_size, workers=workers, checkpoint=checkpoint,
+                      total=total_rows)
+
+    if target == "ivfpq" and not stats["failed"]:
+        build_ivfpq(local_dir)
+    return stats
 
 
 if __name__ == "__main__":
-    prepare_wikipedia_collection()
+    parser = argparse.ArgumentParser(description="Prepare the Wikipedia keyword collection")
+    parser.add_argument("--target", choices=["pinecone", "local", "ivfpq"], default="pinecone")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--local-dir", default=LOCAL_INDEX_DIR)
+    parser.add_argument("--dtype", choices=["float16", "float32"], default="float16")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--checkpoint", default=None, help="Progress file used to resume interrupted runs")
+    args = parser.parse_args()
+
+    prepare_wikipedia_collection(
+        batch_size=args.batch_size, target=args.target, local_dir=args.local_dir, dtype=args.dtype,
+        workers=args.workers, checkpoint_path=args.checkpoint
+    )
@@ -0,0 +1,39 @@
+"""Shared setup of the tests: offline fakes stand in for every provider"""
+
+import os
+import random
+import tempfile
+
+import pytest
+
+# Keep the fakes unthrottled, and the tests isolated from the user's cache
+for _provider in ("COHERE", "PINECONE", "OPENAI", "WHISPER"):
+    os.environ.setdefault(f"RABBITHOLE_{_provider}_RPS", "100000")
+    os.environ.setdefault(f"RABBITHOLE_{_provider}_BURST", "100000")
+    os.environ.setdefault(f"RABBITHOLE_{_provider}_CONCURRENCY", "64")
+os.environ["RABBITHOLE_CACHE_DIR"] = tempfile.mkdtemp(prefix="rabbithole-tests-")
+
+WORDS = ("learning model data network theory function system energy matrix vector graph process cell protein "
+         "market price law court history empire language grammar planet orbit field force wave particle").split()
+
+
+def _make_text(num_words: int, seed: int = 0) -> str:
+    """Synthetic text with headings, paragraphs and sentences"""
+    rng = random.Random(seed)
+    sections = []
+    for number in range(0, num_words, 400):
+        sentences = [" ".join(rng.choices(WORDS, k=12)).capitalize() + "." for _ in range(min(400, num_words) // 12)]
+        paragraphs = [" ".join(sentences[i:i + 5]) for i in range(0, len(sentences), 5)]
+        sections.append(f"Section {number // 400 + 1} {rng.choice(WORDS)}\n\n" + "\n\n".join(paragraphs))
+    return "\n\n".join(sections)
+
+
+@pytest.fixture
+def make_text():
+    """Function making a synthetic text of a number of words, different for every seed"""
+    return _make_text
+
+
+@pytest.fixture
+def text() -> str:
+    return _make_text(3_000)
@@ -0,0 +1,76 @@
+"""Tests of rabbithole.bundle"""
+
+import numpy as np
+import pytest
+from langchain.schema import Document
+
+from rabbithole.bundle import bundle_bytes, read_bundle, save_bundle
+from rabbithole.fakes import FakeEmbeddings
+from rabbithole.incremental import FileRecord, SessionGraph
+from rabbithole.pipeline import STAGES
+
+
+@pytest.fixture
+def graph() -> SessionGraph:
+    embeddings = FakeEmbeddings(dim=8)
+    graph = SessionGraph(STAGES)
+    for name, texts in (("a.txt", ["Graphs and trees.", "Ünïcödé text — with dashes."]),
+                        ("b.txt", ["Prices and markets."]), ("empty.txt", [])):
+        documents = [Document(page_content=text, metadata={"source": name, "chunk": i, "tokens": len(text.split())})
+                     for i, text in enumerate(texts)]
+        graph.records[name] = FileRecord(name=name, digest=f"digest of {name}", settings={"summary_mode": "refine"},
+                                         results={
+                                             "load": documents,
+                                             "embed": np.asarray(embeddings.embed_documents(texts)).reshape(-1, 8),
+                                             "keywords": ["Graph"] if texts else [],
+                                             "summarize": f"Summary of {name}",
+                                         })
+    # A file whose embedding failed
+    graph.records["c.txt"] = FileRecord(name="c.txt", digest="digest of c.txt", settings={},
+                                        results={"load": [Document(page_content="Orbits.", metadata={})]},
+                                        errors={"embed": "rate limited"})
+    graph.set_corpus_keywords({"a.txt": ["Tree"], "b.txt": ["Market"]})
+    graph.set_plan({"plan": [{"Document 1": {"summary": "a"}}]}, {"planner": "ordering"})
+    return graph
+
+
+def assert_same_graph(read: SessionGraph, graph: SessionGraph, dtype: str):
+    assert list(read.records) == list(graph.records)
+    for name, record in graph.records.items():
+        copy = read.records[name]
+        assert (copy.digest, copy.settings, copy.errors) == (record.digest, record.settings, record.errors)
+        assert [(doc.page_content, doc.metadata) for doc in copy.results["load"]] == \
+               [(doc.page_content, doc.metadata) for doc in record.results["load"]]
+        assert set(copy.results) == set(record.results)
+        for stage in set(record.results) - {"load", "embed"}:
+            assert copy.results[stage] == record.results[stage]
+        if "embed" in record.results and len(record.results["embed"]):
+            assert copy.results["embed"].dtype == np.dtype(dtype)
+            np.testing.assert_allclose(copy.results["embed"], record.results["embed"], atol=1e-3)
+    assert read.plan == graph.plan
+    assert not read.plan_stale({"planner": "ordering"})
+    assert read.keywords() == graph.keywords()
+
+
+@pytest.mark.parametrize("dtype", ["float16", "float32"])
+def test_save_and_read(graph, tmp_path, dtype):
+    path = tmp_path / "session.rhb"
+    save_bundle(graph, path, dtype=dtype)
+
+    assert_same_graph(read_bundle(path), graph, dtype)
+
+
+def test_read_bundle_bytes(graph):
+    read = read_bundle(bundle_bytes(graph, dtype="float32"))
+
+    assert_same_graph(read, graph, "float32")
+    np.testing.assert_array_equal(read.records["a.txt"].results["embed"], graph.records["a.txt"].results["embed"])
+    assert read.records["a.txt"].complete(STAGES)
+    assert not read.records["c.txt"].complete(STAGES)
+
+
+def test_read_something_else():
+    with pytest.raises(ValueError, match="too short"):
+        read_bundle(b"RH")
+    with pytest.raises(ValueError, match="Not a RabbitHole bundle"):
+        read_bundle(b"\0" * 64)
@@ -0,0 +1,61 @@
+"""Tests of rabbithole.chunking"""
+
+from rabbithole.chunking import HEADING, TokenChunker, count_tokens, join_chunks, truncate_tokens
+from rabbithole.loader import split_stream
+
+
+def test_chunks_fit_the_window_and_cover_the_text(text):
+    chunker = TokenChunker(chunk_size=200, chunk_overlap=20)
+    chunks = list(chunker.split([text]))
+
+    assert len(chunks) > 1
+    assert all(chunk.end - chunk.start <= 200 for chunk in chunks)
+    assert chunks[0].start == 0
+    # Every chunk starts at or before the end of the previous one
+    assert all(chunk.start <= previous.end for previous, chunk in zip(chunks, chunks[1:]))
+    # Chunks after a heading start at it and repeat nothing
+    assert all(chunk.text.startswith("Section") and chunk.overlap == 0 for chunk in chunks
+               if chunk.boundary == HEADING)
+
+
+def test_split_texts_as_they_arrive(text):
+    chunker = TokenChunker(chunk_size=200, chunk_overlap=20)
+    pages = text.split("\n\n")
+
+    streamed = list(chunker.split(pages, separator="\n\n"))
+    whole = list(chunker.split(["\n\n".join(pages)]))
+    assert "".join(chunk.text[chunk.overlap:] for chunk in streamed) == text
+    assert "".join(chunk.text[chunk.overlap:] for chunk in whole) == text
+
+
+def test_join_chunks_reads_like_the_file(text):
+    documents = list(split_stream([text], TokenChunker(chunk_size=200, chunk_overlap=20), "a.txt"))
+
+    joined = join_chunks(documents, chunk_size=100_000)
+    assert len(joined) == 1
+    assert joined[0].page_content == text
+    assert joined[0].metadata["tokens"] == documents[-1].metadata["offset"] + documents[-1].metadata["tokens"]
+    assert joined[0].metadata["chunks"] == list(range(len(documents)))
+
+
+def test_join_chunks_fit_the_window(text):
+    documents = list(split_stream([text], TokenChunker(chunk_size=200, chunk_overlap=20), "a.txt"))
+
+    joined = join_chunks(documents, chunk_size=600)
+    assert 1 < len(joined) < len(documents)
+    assert all(doc.metadata["tokens"] <= 600 for doc in joined)
+    assert "".join(doc.page_content for doc in joined) == text
+    assert [chunk for doc in joined for chunk in doc.metadata["chunks"]] == list(range(len(documents)))
+
+
+def test_join_chunks_without_token_metadata():
+    from langchain.schema import Document
+
+    documents = [Document(page_content="first"), Document(page_content="second")]
+    assert join_chunks(documents) is documents
+
+
+def test_truncate_tokens(text):
+    assert truncate_tokens(text, 10 ** 6) == text
+    assert 0 < count_tokens(truncate_tokens(text, 50)) <= 50
+    assert text.startswith(truncate_tokens(text, 50))
@@ -0,0 +1,57 @@
+"""Tests of rabbithole.dedup"""
+
+import pytest
+from langchain.schema import Document
+
+from rabbithole.dedup import Deduplicator, SharedDeduplicator, clear_upload
+
+
+def chunk(text: str, source: str) -> Document:
+    return Document(page_content=text, metadata={"source": source, "tokens": len(text.split())})
+
+
+@pytest.fixture
+def texts(make_text) -> list[str]:
+    return [make_text(200, seed=seed) for seed in range(3)]
+
+
+def test_repeats_are_dropped_within_a_file_and_merged_across_files(texts):
+    deduplicator = Deduplicator()
+
+    assert deduplicator.add(chunk(texts[0], "a.txt")) is not None
+    assert deduplicator.add(chunk(texts[1], "a.txt")) is not None
+    assert deduplicator.add(chunk(texts[0] + " Again.", "a.txt")) is None
+
+    merged = deduplicator.add(chunk(texts[1], "b.txt"))
+    assert merged.page_content == texts[1]
+    assert merged.metadata["duplicate_of"]["source"] == "a.txt"
+    assert merged.metadata["duplicate_of"]["chunk"] == 1
+    assert merged.metadata["chunk"] == 0
+
+    assert deduplicator.report("a.txt")["dropped"] == 1
+    assert deduplicator.report("b.txt")["merged"] == 1
+    assert deduplicator.report()["kept"] == 2
+
+
+def test_shared_deduplicators_compare_the_files_of_an_upload(tmp_path, texts):
+    path = tmp_path / "dedup.sqlite"
+    first = SharedDeduplicator(path, "upload-1")
+    second = SharedDeduplicator(path, "upload-1")
+    other_upload = SharedDeduplicator(path, "upload-2")
+
+    assert first.add(chunk(texts[0], "a.txt")) is not None
+    merged = second.add(chunk(texts[0], "b.txt"))
+    assert merged.page_content == texts[0]
+    assert merged.metadata["duplicate_of"] == {"source": "a.txt", "chunk": 0, "similarity": 1.0}
+    # A file repeating a chunk it already merged into drops the repeat
+    assert second.add(chunk(texts[0], "b.txt")) is None
+    assert other_upload.add(chunk(texts[0], "c.txt")) is not None
+
+    # A file processed again after a failed attempt starts over
+    first.forget("a.txt")
+    assert second.add(chunk(texts[1], "b.txt")) is not None
+    assert first.add(chunk(texts[0], "a.txt")) is not None
+
+    for deduplicator in (first, second, other_upload):
+        deduplicator.close()
+    assert clear_upload(path, "upload-1") > 0
@@ -0,0 +1,71 @@
+"""Tests of rabbithole.embedding"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from rabbithole.cache import Cache
+from rabbithole.embedding import EmbeddingService
+from rabbithole.fakes import FakeEmbeddings
+
+
+@pytest.fixture
+def client() -> FakeEmbeddings:
+    return FakeEmbeddings(dim=16, latency=0.05)
+
+
+@pytest.fixture
+def service(client, tmp_path) -> EmbeddingService:
+    return EmbeddingService(client=client, max_batch_size=4, cache=Cache(tmp_path))
+
+
+def test_embed_in_batches(service, client):
+    texts = [f"text {i}" for i in range(10)]
+
+    embeddings = service.embed(texts)
+    assert embeddings.shape == (10, 16)
+    assert embeddings.dtype == np.float32
+    np.testing.assert_array_equal(embeddings[3], client.embed("text 3"))
+    assert client.calls == 3 and client.texts == 10
+
+
+def test_identical_texts_are_embedded_once(service, client):
+    embeddings = service.embed(["a", "b", "a", "a"])
+    np.testing.assert_array_equal(embeddings[0], embeddings[2])
+    assert client.texts == 2
+
+    # Later requests read the cache
+    np.testing.assert_array_equal(service.embed(["b", "a"]), embeddings[[1, 0]])
+    assert client.texts == 2
+    assert service.cache.stats()["embedding"] == {"hits": 2, "misses": 2}
+
+
+def test_concurrent_requests_share_the_texts_in_flight(service, client):
+    texts = [f"text {i}" for i in range(8)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(service.embed, [texts, texts[::-1], texts[2:6], texts]))
+
+    assert client.texts == len(texts)
+    np.testing.assert_array_equal(results[1], results[0][::-1])
+    np.testing.assert_array_equal(results[2], results[0][2:6])
+    assert not service._inflight
+
+
+def test_failures_reach_every_waiting_request(service, client):
+    client.error_rate = 1.0
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(service.embed, ["a", "b"]) for _ in range(2)]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="injected failure"):
+                future.result()
+    assert not service._inflight
+
+    # Failed texts are sent again by the next request
+    client.error_rate = 0.0
+    assert service.embed(["a", "b"]).shape == (2, 16)
+
+
+def test_embed_nothing(service, client):
+    assert service.embed([]).shape == (0, 0)
+    assert client.calls == 0
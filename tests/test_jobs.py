@@ -0,0 +1,84 @@
+"""Tests of rabbithole.jobs"""
+
+import pytest
+
+from rabbithole.jobs import DONE, FAILED, QUEUED, RUNNING, JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path) -> JobQueue:
+    return JobQueue(tmp_path / "jobs.sqlite")
+
+
+def test_submit_returns_the_existing_job(queue):
+    job_id = queue.submit("a.txt", b"contents", {"summary_mode": "refine"})
+
+    assert queue.submit("a.txt", b"contents", {"summary_mode": "refine"}) == job_id
+    assert queue.submit("a.txt", b"contents", {"summary_mode": "map_reduce"}) != job_id
+    assert queue.submit("a.txt", b"other contents", {"summary_mode": "refine"}) != job_id
+
+
+def test_claim_and_finish(queue):
+    job_id = queue.submit("a.txt", b"contents", {})
+    job, data = queue.claim("worker-1")
+
+    assert (job.job_id, job.status, job.worker, job.attempts, data) == (job_id, RUNNING, "worker-1", 1, b"contents")
+    assert queue.claim("worker-2") is None
+
+    assert queue.finish(job_id, "worker-1", {"keywords": ["graph"]})
+    job = queue.get([job_id])[job_id]
+    assert job.finished_ok and job.finished is not None
+    assert queue.result(job_id) == {"keywords": ["graph"]}
+
+
+def test_finish_with_an_error(queue):
+    job_id = queue.submit("a.txt", b"contents", {})
+    queue.claim("worker-1")
+
+    assert queue.finish(job_id, "worker-1", None, error="out of memory")
+    job = queue.get([job_id])[job_id]
+    assert job.status == FAILED and job.errors == {"job": "out of memory"}
+    # A failed job is queued again when its file is submitted again
+    assert queue.submit("a.txt", b"contents", {}) != job_id
+
+
+def test_requeue_stale_jobs(queue):
+    job_id = queue.submit("a.txt", b"contents", {})
+    queue.claim("worker-1")
+
+    assert queue.requeue_stale(stale_seconds=60) == 0
+    assert queue.requeue_stale(stale_seconds=-1) == 1
+    job = queue.get([job_id])[job_id]
+    assert (job.status, job.worker, job.finished) == (QUEUED, None, None)
+
+    # The worker that stopped sending heartbeats no longer holds the job
+    job, _ = queue.claim("worker-2")
+    assert job.attempts == 2
+    assert not queue.finish(job_id, "worker-1", {"keywords": ["stale"]})
+    assert queue.finish(job_id, "worker-2", {"keywords": ["fresh"]})
+    assert queue.get([job_id])[job_id].status == DONE
+    assert queue.result(job_id) == {"keywords": ["fresh"]}
+
+
+def test_requeue_stale_fails_after_max_attempts(queue):
+    job_id = queue.submit("a.txt", b"contents", {})
+    queue.claim("worker-1")
+
+    assert queue.requeue_stale(stale_seconds=-1, max_attempts=1) == 1
+    job = queue.get([job_id])[job_id]
+    assert job.status == FAILED and job.errors == {"job": "worker stopped"}
+    assert job.finished is not None
+    # Failed jobs are pruned like the others
+    assert queue.prune(max_age=-1) == 1
+
+
+def test_heartbeat_records_stages(queue):
+    job_id = queue.submit("a.txt", b"contents", {})
+    queue.claim("worker-1")
+
+    queue.heartbeat(job_id, "load", elapsed=1.5)
+    queue.heartbeat(job_id, "summarize", error="rate limited")
+    job = queue.get([job_id])[job_id]
+    assert job.stages == {"load": 1.5}
+    assert job.errors == {"summarize": "rate limited"}
+    assert queue.counts() == {RUNNING: 1}
@@ -0,0 +1,77 @@
+"""Tests of rabbithole.keywords"""
+
+import random
+from collections import Counter
+from math import log
+
+import numpy as np
+import pytest
+
+from rabbithole.keywords import score_corpus_keywords, score_keywords
+
+TITLES = [f"Title {i}" for i in range(40)]
+
+
+def make_results(num_chunks: int, seed: int) -> list[list[dict]]:
+    """Matches of every chunk, with titles shared by many chunks, scores, and matches without metadata"""
+    rng = random.Random(seed)
+    results = []
+    for _ in range(num_chunks):
+        matches = []
+        for _ in range(rng.randint(0, 12)):
+            title = TITLES[min(int(rng.expovariate(0.15)), len(TITLES) - 1)]
+            score = round(rng.uniform(0.2, 0.9), 2) if rng.random() > 0.05 else None
+            matches.append({"score": score, "metadata": {"title": title}} if rng.random() > 0.05 else {"score": score})
+        results.append(matches)
+    return results
+
+
+def reference_keywords(results: list[list[dict]], owners: list[int], num_files: int, n: int,
+                       weighted: bool) -> list[list[str]]:
+    """TF-IDF over every chunk of every file, one match at a time"""
+    chunk_matches = [[match for match in matches if match.get("metadata")] for matches in results]
+    document_frequency = Counter(title for matches in chunk_matches
+                                 for title in {match["metadata"]["title"] for match in matches})
+    first_seen = {}
+    for matches in chunk_matches:
+        for match in matches:
+            first_seen.setdefault(match["metadata"]["title"], len(first_seen))
+
+    weights = [Counter() for _ in range(num_files)]
+    for matches, owner in zip(chunk_matches, owners):
+        total = sum(match["score"] or 0.0 for match in matches)
+        for match in matches:
+            if weighted:
+                tf = (match["score"] or 0.0) / total if total else 0.0
+            else:
+                tf = 1 / len(matches)
+            title = match["metadata"]["title"]
+            weights[owner][title] += tf * log(len(results) / document_frequency[title])
+    return [sorted(weight, key=lambda title: (-weight[title], first_seen[title]))[:n] for weight in weights]
+
+
+@pytest.mark.parametrize("weighted", [False, True])
+@pytest.mark.parametrize("seed", range(5))
+def test_score_corpus_keywords_matches_the_reference(seed, weighted):
+    results = make_results(60, seed)
+    owners = sorted(random.Random(seed).choices(range(4), k=len(results)))
+
+    keywords = score_corpus_keywords(results, np.asarray(owners), 4, n=8, weighted=weighted)
+    assert keywords == reference_keywords(results, owners, 4, n=8, weighted=weighted)
+
+
+@pytest.mark.parametrize("weighted", [False, True])
+def test_one_file_is_ranked_like_score_keywords(weighted):
+    results = make_results(30, seed=7)
+
+    keywords = score_corpus_keywords(results, np.zeros(len(results), dtype=np.int64), 1, n=10, weighted=weighted)
+    assert keywords == [score_keywords(results, n=10, weighted=weighted)]
+    assert keywords == reference_keywords(results, [0] * len(results), 1, n=10, weighted=weighted)
+
+
+def test_files_without_matches():
+    results = [[{"score": 0.5, "metadata": {"title": "Graph"}}], [], [{"score": 0.5}]]
+
+    assert score_corpus_keywords(results, np.arange(3), 3) == [["Graph"], [], []]
+    assert score_corpus_keywords([], np.zeros(0, dtype=np.int64), 2) == [[], []]
+    assert score_corpus_keywords(results, np.arange(3), 3, n=0) == [[], [], []]
@@ -0,0 +1,82 @@
+"""Tests of rabbithole.pipeline"""
+
+from collections import defaultdict
+
+import pytest
+
+from rabbithole.cache import Cache
+from rabbithole.embedding import EmbeddingService
+from rabbithole.fakes import FakeEmbeddings, FakeLLM
+from rabbithole.jobs import NamedBytesIO
+from rabbithole.pipeline import STAGES, Pipeline, StageEvent
+from rabbithole.summarize import summarize_document
+
+
+@pytest.fixture
+def client() -> FakeEmbeddings:
+    return FakeEmbeddings(dim=16)
+
+
+@pytest.fixture
+def pipeline(client, tmp_path) -> Pipeline:
+    service = EmbeddingService(client=client, cache=Cache(tmp_path))
+    return Pipeline(max_workers=4, embed=service.embed, keywords=lambda embeddings: [f"{len(embeddings)} chunks"],
+                    summarize=lambda document: summarize_document(document, mode="map_reduce", llm=FakeLLM()),
+                    embed_batch_size=2)
+
+
+def events_by_file(events: list[StageEvent]) -> dict[str, dict[str, StageEvent]]:
+    by_file = defaultdict(dict)
+    for event in events:
+        assert event.stage not in by_file[event.file_name]
+        by_file[event.file_name][event.stage] = event
+    return by_file
+
+
+def test_every_stage_of_every_file(pipeline, make_text):
+    files = [NamedBytesIO(make_text(3_000, seed=seed).encode("utf-8"), f"{seed}.txt") for seed in range(3)]
+
+    events = list(pipeline.run(files))
+    by_file = events_by_file(events)
+    assert set(by_file) == {"0.txt", "1.txt", "2.txt"}
+    for name, stages in by_file.items():
+        assert set(stages) == set(STAGES)
+        assert all(event.ok for event in stages.values())
+        documents = stages["load"].result
+        assert len(documents) > 1 and all(doc.metadata["source"] == name for doc in documents)
+        assert stages["embed"].result.shape == (len(documents), 16)
+        assert stages["keywords"].result == [f"{len(documents)} chunks"]
+        assert stages["summarize"].result
+
+        # Dependent stages finish after the stages they depend on
+        order = [event.stage for event in events if event.file_name == name]
+        assert order.index("load") < order.index("embed") < order.index("keywords")
+        assert order.index("load") < order.index("summarize")
+
+
+def test_repeated_chunks_are_embedded_once(pipeline, client, text):
+    files = [NamedBytesIO(text.encode("utf-8"), "a.txt"), NamedBytesIO(text.encode("utf-8"), "b.txt")]
+
+    by_file = events_by_file(list(pipeline.run(files)))
+    chunks = len(by_file["a.txt"]["load"].result)
+    assert len(by_file["b.txt"]["load"].result) == chunks
+    reports = [by_file[name]["load"].details["dedup"] for name in ("a.txt", "b.txt")]
+    assert sum(report["merged"] for report in reports) == chunks
+    assert sum(report["dropped"] for report in reports) == 0
+    assert client.texts == chunks
+
+
+def test_failed_stages_skip_their_dependents(text):
+    def embed(texts: list[str]):
+        raise RuntimeError("embedding failed")
+
+    pipeline = Pipeline(max_workers=2, embed=embed, keywords=lambda embeddings: ["never"],
+                        summarize=lambda document: f"{len(document)} chunks", dedup=False)
+    files = [NamedBytesIO(text.encode("utf-8"), "a.txt"), NamedBytesIO(b"\0", "b.unknown")]
+
+    by_file = events_by_file(list(pipeline.run(files)))
+    assert set(by_file["a.txt"]) == {"load", "embed", "summarize"}
+    assert isinstance(by_file["a.txt"]["embed"].error, RuntimeError)
+    assert by_file["a.txt"]["summarize"].ok
+    assert set(by_file["b.unknown"]) == {"load"}
+    assert isinstance(by_file["b.unknown"]["load"].error, ValueError)
@@ -0,0 +1,48 @@
+"""Tests of rabbithole.streaming"""
+
+import json
+
+import pytest
+
+from rabbithole.streaming import PlanParser
+
+PLAN = {"plan": [
+    {"Document 1": {"summary": "Graphs {and} trees", "keywords": ["graph", "tree \"root\""]}},
+    {"Document 2": {"summary": "Escapes \\ and ] brackets [", "prerequisites": []}},
+    {"Document 3": {"summary": "Last", "keywords": []}},
+]}
+
+
+def feed(parser: PlanParser, text: str, size: int) -> list[list[dict]]:
+    """Feed a response in pieces of a number of characters, returning the entries completed by each piece"""
+    return [parser.feed(text[start:start + size]) for start in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 7, 10_000])
+def test_entries_are_returned_as_they_complete(size):
+    text = "```json\n" + json.dumps(PLAN, indent=2) + "\n```"
+    parser = PlanParser()
+
+    completed = feed(parser, text, size)
+    assert [entry for entries in completed for entry in entries] == PLAN["plan"]
+    assert parser.result() == PLAN
+
+    # The first entry is complete before the second one starts
+    end_of_first = text.index("\n    }", text.index("Document 1")) + len("\n    }")
+    first_piece = next(i for i, entries in enumerate(completed) if entries)
+    assert first_piece == (end_of_first - 1) // size
+
+
+def test_malformed_entries_are_skipped():
+    parser = PlanParser()
+    parser.feed('{"plan": [{"Document 1": {"summary": "ok"}}, {"Document 2": {"summary": tbd}}, ')
+
+    assert parser.entries == [{"Document 1": {"summary": "ok"}}]
+    # The response was cut off, so the plan is made of the entries parsed so far
+    assert parser.result() == {"plan": [{"Document 1": {"summary": "ok"}}]}
+
+
+def test_no_plan():
+    parser = PlanParser()
+    assert parser.feed("I cannot make a plan without documents.") == []
+    assert parser.result() == {"plan": []}